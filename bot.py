@@ -18,25 +18,53 @@ Preserved Features:
 """
 
 import logging
+import logging.handlers
 import json
+import marshal
 import os
 import io
 import asyncio
 import time
 import threading
+from http import HTTPStatus
 import re
+import functools
+import hashlib
+import contextlib
+import uuid
+import zlib
+import socket
+import sqlite3
+import hmac
+import secrets
+import httpx
+import signal
+import contextvars
+import collections
+import itertools
+import heapq
+import sys
+import cProfile
+import pstats
+import csv
+import traceback
+import tracemalloc
+import gc
+import gzip
+import tempfile
 from datetime import datetime, timedelta
 from telegram import (
     Update, ChatMember, InlineKeyboardButton, InlineKeyboardMarkup, 
     BotCommandScopeChat, ChatJoinRequest
 )
 from telegram.constants import ChatType, ParseMode
-from telegram.error import TelegramError, BadRequest, Forbidden
+from telegram.error import TelegramError, BadRequest, Forbidden, RetryAfter, TimedOut
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, ContextTypes, ChatMemberHandler, 
     CallbackQueryHandler, MessageHandler, filters, Application, ChatJoinRequestHandler,
-    MessageReactionHandler
+    MessageReactionHandler, BaseUpdateProcessor, TypeHandler, ExtBot
 )
+from telegram.request import HTTPXRequest, BaseRequest
 
 # --- 1. LOGGING & SETUP ---
 logging.basicConfig(
@@ -45,23 +73,306 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# --- 2. FLASK KEEPALIVE SERVER ---
-try:
-    from flask import Flask
-    def _start_keepalive():
-        port = int(os.environ.get("PORT", "8080"))
-        app = Flask(__name__)
-        @app.route('/')
-        def index(): return "Bot Running - v14.0 All Features", 200
-        
-        def run():
-            app.run(host="0.0.0.0", port=port, use_reloader=False)
-        
-        t = threading.Thread(target=run, daemon=True)
-        t.start()
-except ImportError:
-    def _start_keepalive(): pass
-_start_keepalive()
+# --- 1b. METRICS (Prometheus text format) ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Metrics:
+    """
+    Tiny in-process metrics registry.
+    Written from the bot loop and worker threads (saves, the stall watchdog),
+    read on the loop by the health server's /metrics.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}    # (name, labels) -> value
+        self.gauges = {}      # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self.buckets = {}     # name -> custom bucket bounds (default LATENCY_BUCKETS)
+        self.collectors = []  # Callables refreshing gauges at scrape time
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        bounds = self.buckets.get(name, LATENCY_BUCKETS)
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * (len(bounds) + 2)
+            for i, bound in enumerate(bounds):
+                if value <= bound: h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def collector(self, fn):
+        self.collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _fmt(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items: return ""
+        # Label values escaped per the text exposition format: \\, \" and \n
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+    def render(self):
+        for fn in self.collectors:
+            try: fn()
+            except Exception as e: logger.error(f"Metrics collector {fn.__name__} failed: {e}")
+
+        lines = []
+        with self._lock:
+            for kind, store in (("counter", self.counters), ("gauge", self.gauges)):
+                seen = set()
+                for (name, labels), value in sorted(store.items()):
+                    if name not in seen:
+                        lines.append(f"# TYPE {name} {kind}")
+                        seen.add(name)
+                    lines.append(f"{name}{self._fmt(labels)} {value}")
+            seen = set()
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} histogram")
+                    seen.add(name)
+                for i, bound in enumerate(self.buckets.get(name, LATENCY_BUCKETS)):
+                    lines.append(f"{name}_bucket{self._fmt(labels, [('le', bound)])} {h[i]}")
+                lines.append(f"{name}_bucket{self._fmt(labels, [('le', '+Inf')])} {h[-1]}")
+                lines.append(f"{name}_sum{self._fmt(labels)} {h[-2]}")
+                lines.append(f"{name}_count{self._fmt(labels)} {h[-1]}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+# Per-update timing breakdown, filled by MetricsRequest and TimedLock
+HANDLER_STATS = contextvars.ContextVar("HANDLER_STATS", default=None)
+SLOW_HANDLER_SECONDS = float(os.environ.get("SLOW_HANDLER_MS", "1000")) / 1000
+
+class TimedLock(asyncio.Lock):
+    """asyncio.Lock that records wait and hold time."""
+    _acquired_at = 0.0
+
+    async def acquire(self):
+        started = time.perf_counter()
+        await super().acquire()
+        self._acquired_at = time.perf_counter()
+        METRICS.observe("bot_data_lock_wait_seconds", self._acquired_at - started)
+        return True
+
+    def release(self):
+        held = time.perf_counter() - self._acquired_at
+        super().release()
+        METRICS.observe("bot_data_lock_hold_seconds", held)
+        stats = HANDLER_STATS.get()
+        if stats is not None: stats["lock"] += held
+
+def process_rss_bytes():
+    """Current resident memory of this process (Linux /proc, falls back to peak RSS)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        try:
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except Exception:
+            return 0
+
+# --- 2. HEALTH & KEEPALIVE SERVER (asyncio) ---
+# Served from the bot's own event loop: if the loop stalls, /healthz stops
+# answering and the platform restarts the bot.
+HEALTH = {
+    "started_at": time.time(),
+    "loop_lag": 0.0,          # Seconds, last measurement
+    "last_update": 0.0,       # Unix time of the last update received
+    "last_save": 0.0,         # Unix time of the last successful save
+    "last_check_demos": 0.0,  # Unix time of the last finished check_demos run
+    "check_demos_running": False,
+    "check_demos_heartbeat": 0.0,  # Unix time of the last progress of the running check_demos run
+}
+HEALTH_MAX_LAG = float(os.environ.get("HEALTH_MAX_LAG", "5"))
+LAG_PROBE_INTERVAL = 0.5
+
+async def monitor_loop_lag():
+    """Measures how late the loop wakes up from a short sleep."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LAG_PROBE_INTERVAL)
+        lag = max(0.0, loop.time() - started - LAG_PROBE_INTERVAL)
+        HEALTH["loop_lag"] = lag
+        WATCHDOG["beat"] = time.monotonic()
+        METRICS.observe("bot_event_loop_lag_seconds", lag)
+
+# Stall watchdog: a helper thread notices when monitor_loop_lag stops beating
+# for STALL_THRESHOLD seconds, samples the loop thread's stack until it beats
+# again, then logs the most frequent stacks and sends them to LOG_CHANNEL_ID
+# (at most once per STALL_REPORT_INTERVAL).
+STALL_THRESHOLD = float(os.environ.get("STALL_THRESHOLD", "1"))  # seconds; 0 disables
+STALL_REPORT_INTERVAL = float(os.environ.get("STALL_REPORT_INTERVAL", "300"))
+STALL_SAMPLE_INTERVAL = 0.05
+WATCHDOG = {"beat": 0.0, "last_report": 0.0, "stalls": 0}
+METRICS.buckets["bot_event_loop_stall_seconds"] = (0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+class StallWatchdog(threading.Thread):
+    def __init__(self, loop):
+        super().__init__(name="stall-watchdog", daemon=True)
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.stopped = threading.Event()
+
+    def stack(self):
+        frame = sys._current_frames().get(self.loop_thread)
+        return tuple(traceback.format_stack(frame)[-25:]) if frame is not None else ()
+
+    def run(self):
+        limit = LAG_PROBE_INTERVAL + STALL_THRESHOLD
+        WATCHDOG["beat"] = time.monotonic()
+        while not self.stopped.wait(STALL_SAMPLE_INTERVAL):
+            beat = WATCHDOG["beat"]
+            if time.monotonic() - beat < limit: continue
+            # Stalled: sample until the loop beats again
+            stacks = collections.Counter()
+            while WATCHDOG["beat"] == beat and not self.stopped.is_set():
+                stacks[self.stack()] += 1
+                time.sleep(STALL_SAMPLE_INTERVAL)
+            self.finish(time.monotonic() - beat - LAG_PROBE_INTERVAL, stacks)
+
+    def finish(self, stalled, stacks):
+        WATCHDOG["stalls"] += 1
+        METRICS.inc("bot_event_loop_stalls_total")
+        METRICS.observe("bot_event_loop_stall_seconds", stalled)
+        samples = sum(stacks.values())
+        lines = [f"EVENT LOOP STALL - {stalled:.2f}s, {samples} stack samples", ""]
+        for stack, n in stacks.most_common(3):
+            lines.append(f"--- {n}/{samples} samples ---")
+            lines.append("".join(stack))
+        report = "\n".join(lines)
+        logger.warning(report)
+        now = time.monotonic()
+        if LOG_CHANNEL_ID and now - WATCHDOG["last_report"] >= STALL_REPORT_INTERVAL and APP is not None:
+            WATCHDOG["last_report"] = now
+            asyncio.run_coroutine_threadsafe(send_stall_report(APP.bot, stalled, report), self.loop)
+
+async def send_stall_report(bot, stalled, report):
+    try:
+        f = io.BytesIO(report.encode("utf-8"))
+        f.name = f"stall_{int(time.time())}.txt"
+        await bot.send_document(
+            LOG_CHANNEL_ID, document=f,
+            caption=f"🧊 Event loop stalled for {stalled:.1f}s (worker {WORKER_INDEX}). Stacks attached."
+        )
+    except Exception as e:
+        logger.error(f"Stall report failed: {e}")
+
+def health_report():
+    now = time.time()
+    ago = lambda ts: round(now - ts, 1) if ts else None
+    problems = []
+    if HEALTH["loop_lag"] > HEALTH_MAX_LAG: problems.append("event loop lagging")
+    # Allow a few missed check_demos runs before failing
+    stale_after = 5 * DEMO_CHECK_INTERVAL
+    if IS_LEADER and now - HEALTH["started_at"] > stale_after:
+        # A long expiry wave is fine as long as it keeps making progress
+        if HEALTH["check_demos_running"]:
+            if now - HEALTH["check_demos_heartbeat"] > stale_after: problems.append("check_demos stuck")
+        elif now - HEALTH["last_check_demos"] > stale_after:
+            problems.append("check_demos stalled")
+    return {
+        "status": "ok" if not problems else "unhealthy",
+        "problems": problems,
+        "uptime": round(now - HEALTH["started_at"], 1),
+        "worker": f"{WORKER_INDEX}/{WORKER_COUNT}",
+        "leader": IS_LEADER,
+        "event_loop_lag": round(HEALTH["loop_lag"], 4),
+        "event_loop_stalls": WATCHDOG["stalls"],
+        "last_update_ago": ago(HEALTH["last_update"]),
+        "last_save_ago": ago(HEALTH["last_save"]),
+        "last_check_demos_ago": ago(HEALTH["last_check_demos"]),
+        "check_demos_running": HEALTH["check_demos_running"],
+    }
+
+async def handle_http(method, path, headers, body):
+    """Routes one request. Returns (status, content type, body)."""
+    if method == "GET" and path == "/":
+        return 200, "text/plain", "Bot Running - v14.0 All Features"
+    if method == "GET" and path in ("/health", "/healthz"):
+        report = health_report()
+        return (200 if report["status"] == "ok" else 503), "application/json", json.dumps(report)
+    if method == "GET" and path == "/metrics":
+        return 200, "text/plain; version=0.0.4; charset=utf-8", METRICS.render()
+    if method == "POST" and WEBHOOK_MODE and path == WEBHOOK_PATH:
+        status, text = receive_webhook_update(
+            headers.get("x-telegram-bot-api-secret-token", ""), len(body), body,
+            forwarded="x-bot-forwarded" in headers,
+        )
+        return status, "text/plain", text
+    return 404, "text/plain", "Not Found"
+
+class HealthServer:
+    """Minimal HTTP/1.1 server (one request per connection) on asyncio streams."""
+    READ_TIMEOUT = 10
+
+    def __init__(self, port, handler=None):
+        self.port = port
+        self.handler = handler or handle_http  # multibot.py routes to several bots
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "0.0.0.0", self.port)
+        logger.info(f"Health server listening on :{self.port}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        status, ctype, payload = 400, "text/plain", "Bad Request"
+        try:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.READ_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                return
+            lines = head.decode("latin-1").split("\r\n")
+            method, target = lines[0].split(" ")[:2]
+            headers = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    k, v = line.split(":", 1)
+                    headers[k.strip().lower()] = v.strip()
+            length = int(headers.get("content-length") or 0)
+            if length > WEBHOOK_MAX_BODY:
+                METRICS.inc("bot_webhook_requests_total", result="too_large")
+                status, payload = 413, "Payload Too Large"
+            else:
+                body = await asyncio.wait_for(reader.readexactly(length), self.READ_TIMEOUT) if length else b""
+                status, ctype, payload = await self.handler(method.upper(), target.split("?", 1)[0], headers, body)
+        except Exception as e:
+            logger.warning(f"Health server request failed: {e}")
+        finally:
+            try:
+                data = payload.encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                    f"Content-Type: {ctype}\r\nContent-Length: {len(data)}\r\n"
+                    f"Connection: close\r\n\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+                writer.close()
+            except Exception: pass
 
 # --- 3. CONFIGURATION & DEFAULTS ---
 DEFAULTS = {
@@ -78,9 +389,26 @@ SUPPORT_GROUP_ID = int(os.environ.get("SUPPORT_GROUP_ID", DEFAULTS["SUPPORT"]))
 MANDATORY_CHANNEL_ID = int(os.environ.get("MANDATORY_CHANNEL_ID", DEFAULTS["MAIN_CH"]))
 LOG_CHANNEL_ID = int(os.environ.get("LOG_CHANNEL_ID", DEFAULTS["LOG_CH"]))
 MONGO_URL = os.environ.get("MONGO_URL", None) 
+MONGO_COLLECTION = os.environ.get("MONGO_COLLECTION", "bot_settings")
+# Alternative Bot API server (local telegram-bot-api, or tools/fake_api.py for load tests)
+TELEGRAM_API_BASE_URL = os.environ.get("TELEGRAM_API_BASE_URL", "").rstrip("/")
 
 MANDATORY_CHANNEL_LINK = os.environ.get("MANDATORY_CHANNEL_LINK", "https://t.me/YourChannel")
 DATA_FILE = os.environ.get("DATA_FILE", "bot_data.json")
+PORT = int(os.environ.get("PORT", "8080"))  # 0: no own health server (multibot.py serves it)
+DEMO_CHECK_INTERVAL = int(os.environ.get("DEMO_CHECK_INTERVAL", "60"))
+DEMO_DURATION = int(os.environ.get("DEMO_DURATION", str(3 * 3600)))
+DEMO_HOURS = f"{DEMO_DURATION / 3600:g}"
+
+# Update delivery: "polling" (default) or "webhook" on the keep-alive PORT.
+# Behind Render/Koyeb the public HTTPS URL is picked up from the platform env.
+WEBHOOK_MODE = os.environ.get("UPDATE_MODE", "polling").lower() == "webhook"
+WEBHOOK_PATH = "/" + os.environ.get("WEBHOOK_PATH", "/webhook").strip("/")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_MAX_BODY = int(os.environ.get("WEBHOOK_MAX_BODY", str(1024 * 1024)))
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL") or os.environ.get("RENDER_EXTERNAL_URL") or (
+    f"https://{os.environ['KOYEB_PUBLIC_DOMAIN']}" if os.environ.get("KOYEB_PUBLIC_DOMAIN") else ""
+)
 
 # --- 4. DATABASE & MEMORY ---
 DB = {
@@ -93,17 +421,21 @@ DB = {
     "USER_TOPICS": {}, 
     "PENDING_REQUESTS": {},
     "LINK_MAP": {},      # invite_link -> {"u": user_id, "b": batch_id}
-    "CUSTOM_WELCOMES": {} # NEW: batch_id -> "Msg"
+    "CUSTOM_WELCOMES": {}, # NEW: batch_id -> "Msg"
+    "PENDING_DELETES": {}, # worker index -> {chat_id: {due bucket: [message ids]}} (all string keys)
+    "FREE_MEMBERS": {},    # user_id -> [free batch ids the user is in], for the mandatory-channel auto-kick
+    "LEFT_MANDATORY": {},  # user_id -> time the user left the Mandatory Channel (auto-kick pending)
+    "ROLLUPS": {}          # worker index -> {"h"/"d": {batch_id: {event: {period: count}}}} (all string keys)
 }
 
 # Runtime Memory
 MESSAGE_MAP = {} 
 ADMIN_WIZARD = {} 
 BROADCAST_STATE = {} 
-TOPIC_CREATION_LOCK = set()
 SPAM_CACHE = {} # NEW: For Anti-Spam
+BATCH_MENUS = {} # "free"/"paid" -> cached menu pages [(text, markup)]
 
-data_lock = asyncio.Lock()
+data_lock = TimedLock()
 
 # MongoDB Setup
 mongo_client = None
@@ -115,46 +447,68 @@ if MONGO_URL:
         import certifi
         mongo_client = MongoClient(MONGO_URL, tlsCAFile=certifi.where())
         mongo_db = mongo_client.get_database("telegram_bot_db")
-        mongo_collection = mongo_db.get_collection("bot_settings")
+        mongo_collection = mongo_db.get_collection(MONGO_COLLECTION)
         logger.info("✅ Connected to MongoDB Atlas")
     except Exception as e:
         logger.error(f"❌ MongoDB Connection Failed: {e}")
         MONGO_URL = None
 
 # --- 5. PERSISTENCE FUNCTIONS ---
+def timed(metric):
+    """Records the wall time of a sync function into a histogram."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try: return fn(*args, **kwargs)
+            finally: METRICS.observe(metric, time.perf_counter() - started)
+        return wrapper
+    return deco
+
+# Top-level DB keys whose dict keys are ints in memory but strings in JSON
+INT_KEYED = ["CUSTOM_WELCOMES", "FREE_CHANNELS", "PAID_CHANNELS", "ALL_CHATS", "USER_TOPICS", "USER_DATA", "PENDING_REQUESTS", "FREE_MEMBERS", "LEFT_MANDATORY"]
+
+def decode_value(key, value):
+    """Converts one loaded top-level value back to its in-memory form."""
+    # Load Admins robustly (Convert to list of ints)
+    if key == "ADMIN_IDS": return [int(x) for x in value if str(x).isdigit()]
+    # Convert string keys back to integers for dictionaries
+    if key in INT_KEYED: return {int(i): v for i, v in value.items()}
+    return value
+
+def encode_value(key, data=None):
+    """JSON-ready form of one top-level DB value (of `data`, default DB)."""
+    value = (DB if data is None else data)[key]
+    if key in INT_KEYED: return {str(k): v for k, v in value.items()}
+    return value
+
+def apply_loaded(loaded):
+    """Copies a loaded snapshot into DB."""
+    for k, v in loaded.items():
+        if k in DB: DB[k] = decode_value(k, v)
+
+    if OWNER_ID not in DB["ADMIN_IDS"]: DB["ADMIN_IDS"].append(OWNER_ID)
+
+    # Sync lists to ALL_CHATS for legacy support
+    for cid, name in DB["FREE_CHANNELS"].items():
+        if cid not in DB["ALL_CHATS"]: DB["ALL_CHATS"][cid] = name
+    for cid, name in DB["PAID_CHANNELS"].items():
+        if cid not in DB["ALL_CHATS"]: DB["ALL_CHATS"][cid] = name
+    BATCH_MENUS.clear()
+
+@timed("bot_load_seconds")
 def load_data():
-    global DB
-    
+    # Multi-worker mode reads through the shared store
+    if SHARED_STATE is not None:
+        load_shared_state()
+        return
+
     # Try loading from MongoDB first
     if MONGO_URL and mongo_collection is not None:
         try:
             data = mongo_collection.find_one({"_id": "main_settings"})
             if data and "data" in data:
-                loaded = data["data"]
-                
-                # Load Admins robustly (Convert to list of ints)
-                if "ADMIN_IDS" in loaded:
-                    DB["ADMIN_IDS"] = [int(x) for x in loaded["ADMIN_IDS"] if str(x).isdigit()]
-
-                if "BLOCKED_USERS" in loaded: DB["BLOCKED_USERS"] = loaded["BLOCKED_USERS"]
-                if "LINK_MAP" in loaded: DB["LINK_MAP"] = loaded["LINK_MAP"]
-                # NEW: Load Custom Welcomes
-                if "CUSTOM_WELCOMES" in loaded: 
-                    DB["CUSTOM_WELCOMES"] = {int(k): v for k, v in loaded["CUSTOM_WELCOMES"].items()}
-                
-                # Convert string keys back to integers for dictionaries
-                for k in ["FREE_CHANNELS", "PAID_CHANNELS", "ALL_CHATS", "USER_TOPICS", "USER_DATA", "PENDING_REQUESTS"]:
-                    if k in loaded:
-                        DB[k] = {int(i): v for i, v in loaded[k].items()}
-                
-                if OWNER_ID not in DB["ADMIN_IDS"]: DB["ADMIN_IDS"].append(OWNER_ID)
-                
-                # Sync lists to ALL_CHATS for legacy support
-                for cid, name in DB["FREE_CHANNELS"].items():
-                    if cid not in DB["ALL_CHATS"]: DB["ALL_CHATS"][cid] = name
-                for cid, name in DB["PAID_CHANNELS"].items():
-                    if cid not in DB["ALL_CHATS"]: DB["ALL_CHATS"][cid] = name
-                    
+                apply_loaded(data["data"])
                 logger.info("✅ Database loaded from MongoDB.")
                 return
         except Exception as e:
@@ -167,67 +521,1006 @@ def load_data():
 
     try:
         with open(DATA_FILE, "r") as f:
-            loaded = json.load(f)
-            
-            # Robust Admin ID Loading
-            if "ADMIN_IDS" in loaded: 
-                DB["ADMIN_IDS"] = [int(x) for x in loaded["ADMIN_IDS"] if str(x).isdigit()]
-                
-            if "BLOCKED_USERS" in loaded: DB["BLOCKED_USERS"] = loaded["BLOCKED_USERS"]
-            if "LINK_MAP" in loaded: DB["LINK_MAP"] = loaded["LINK_MAP"]
-            if "CUSTOM_WELCOMES" in loaded: 
-                DB["CUSTOM_WELCOMES"] = {int(k): v for k, v in loaded["CUSTOM_WELCOMES"].items()}
-            
-            for k in ["FREE_CHANNELS", "PAID_CHANNELS", "ALL_CHATS", "USER_TOPICS", "USER_DATA", "PENDING_REQUESTS"]:
-                if k in loaded:
-                    DB[k] = {int(i): v for i, v in loaded[k].items()}
-
-            if OWNER_ID not in DB["ADMIN_IDS"]: DB["ADMIN_IDS"].append(OWNER_ID)
-            
-            # Sync legacy
-            for cid, name in DB["FREE_CHANNELS"].items():
-                if cid not in DB["ALL_CHATS"]: DB["ALL_CHATS"][cid] = name
-            for cid, name in DB["PAID_CHANNELS"].items():
-                if cid not in DB["ALL_CHATS"]: DB["ALL_CHATS"][cid] = name
-                
-            logger.info("Database loaded from Local File.")
+            apply_loaded(json.load(f))
+        logger.info("Database loaded from Local File.")
     except Exception as e:
         logger.error(f"Local Load Error: {e}")
 
-def save_data_sync():
-    try:
-        to_save = {
-            "ADMIN_IDS": DB["ADMIN_IDS"],
-            "BLOCKED_USERS": DB["BLOCKED_USERS"],
-            "LINK_MAP": DB["LINK_MAP"],
-            "CUSTOM_WELCOMES": {str(k): v for k, v in DB["CUSTOM_WELCOMES"].items()},
-            "FREE_CHANNELS": {str(k): v for k, v in DB["FREE_CHANNELS"].items()},
-            "PAID_CHANNELS": {str(k): v for k, v in DB["PAID_CHANNELS"].items()},
-            "ALL_CHATS": {str(k): v for k, v in DB["ALL_CHATS"].items()},
-            "USER_DATA": {str(k): v for k, v in DB["USER_DATA"].items()},
-            "USER_TOPICS": {str(k): v for k, v in DB["USER_TOPICS"].items()},
-            "PENDING_REQUESTS": {str(k): v for k, v in DB["PENDING_REQUESTS"].items()}
-        }
+def build_snapshot():
+    """JSON-ready view of DB (dict keys converted to strings)."""
+    return {k: encode_value(k) for k in DB}
 
+# Saves copy DB on the loop and encode the copy in a worker thread. A single
+# large json/marshal C call holds the GIL for its whole run (~0.3 s per 100k
+# users) and would stall the loop from the thread just the same, so users
+# are copied, restored and encoded SNAPSHOT_CHUNK at a time.
+SNAPSHOT_CHUNK = 2000
+
+def freeze_db():
+    """
+    Consistent copy of DB as marshal blobs. Call on the loop under data_lock:
+    marshal copies the plain dict/list/str/number tree in C about 10x
+    faster than json.dumps, and no handler can mutate DB meanwhile.
+    """
+    started = time.perf_counter()
+    users = DB["USER_DATA"]
+    uids = list(users)
+    rest = {k: (None if k == "USER_DATA" else v) for k, v in DB.items()}
+    frozen = marshal.dumps(rest), [
+        (marshal.dumps(uids[i:i + SNAPSHOT_CHUNK]), marshal.dumps([users[u] for u in uids[i:i + SNAPSHOT_CHUNK]]))
+        for i in range(0, len(uids), SNAPSHOT_CHUNK)
+    ]
+    METRICS.observe("bot_snapshot_serialize_seconds", time.perf_counter() - started)
+    return frozen
+
+def thaw_snapshot(frozen):
+    """Worker thread: build_snapshot() of the DB copied by freeze_db()."""
+    rest, chunks = frozen
+    data = marshal.loads(rest)
+    users = {}
+    for uids, entries in chunks:
+        users.update(zip(map(str, marshal.loads(uids)), marshal.loads(entries)))
+    return {k: (users if k == "USER_DATA" else encode_value(k, data)) for k in data}
+
+def dumps_snapshot(snapshot):
+    """json.dumps(snapshot), encoding USER_DATA in chunks so no single call holds the GIL for long."""
+    parts = []
+    for key, value in snapshot.items():
+        if key == "USER_DATA":
+            items = list(value.items())
+            body = ", ".join(filter(None, (json.dumps(dict(items[i:i + SNAPSHOT_CHUNK]))[1:-1] for i in range(0, len(items), SNAPSHOT_CHUNK))))
+            parts.append(f"{json.dumps(key)}: {{{body}}}")
+        else:
+            parts.append(f"{json.dumps(key)}: {json.dumps(value)}")
+    return "{" + ", ".join(parts) + "}"
+
+@timed("bot_save_seconds")
+def write_snapshot(snapshot):
+    """
+    Writes a snapshot (build_snapshot() form) to MongoDB and the local file.
+    The snapshot must be a private copy (thaw_snapshot), so this is safe to
+    run in a thread while handlers keep mutating DB.
+    """
+    try:
         if MONGO_URL and mongo_collection is not None:
             try:
                 mongo_collection.replace_one(
                     {"_id": "main_settings"},
-                    {"_id": "main_settings", "data": to_save},
+                    {"_id": "main_settings", "data": snapshot},
                     upsert=True
                 )
             except Exception as e:
                 logger.error(f"MongoDB Save Error: {e}")
         
         with open(DATA_FILE, "w") as f:
-            json.dump(to_save, f, indent=4)
+            json.dump(snapshot, f, indent=4)
+            METRICS.set("bot_snapshot_bytes", f.tell())
+        HEALTH["last_save"] = time.time()
             
     except Exception as e:
+        METRICS.inc("bot_save_errors_total")
         logger.error(f"Save Error: {e}")
 
+def save_data_sync():
+    try:
+        if SHARED_STATE is not None:
+            if not write_shared_state(build_snapshot()): logger.warning("Shared state changed meanwhile; save skipped.")
+        else:
+            write_snapshot(build_snapshot())
+    except Exception as e:
+        METRICS.inc("bot_save_errors_total")
+        logger.error(f"Save Error: {e}")
+
+# Hot paths (join requests during promo spikes, member updates) mark DB dirty
+# instead of saving per update; flush_saves persists at most once every
+# SAVE_INTERVAL seconds, and once more on shutdown. Lazy changes (the
+# auto-delete queue) never trigger a save: they ride along with the next one.
+SAVE_INTERVAL = float(os.environ.get("SAVE_INTERVAL", "5"))
+SAVES = {"dirty": False, "lazy": False}
+
+def mark_dirty(lazy=False):
+    SAVES["lazy" if lazy else "dirty"] = True
+
+async def flush_saves(context=None, final=False):
+    """Job: saves DB if it was marked dirty since the last save (final: lazy changes too)."""
+    if SAVES["dirty"] or (final and SAVES["lazy"]): await save_data_async()
+
 async def save_data_async():
     async with data_lock:
-        await asyncio.to_thread(save_data_sync)
+        try:
+            # Any full save covers what was marked dirty before the copy
+            SAVES["dirty"] = SAVES["lazy"] = False
+            frozen = freeze_db()
+        except Exception as e:
+            METRICS.inc("bot_save_errors_total")
+            logger.error(f"Save Error: {e}")
+            return
+        if SHARED_STATE is None:
+            await asyncio.to_thread(lambda: write_snapshot(thaw_snapshot(frozen)))
+            return
+
+        # Multi-worker: compare-and-swap; on conflict pull the other workers'
+        # changes (ours are kept) and try again.
+        for attempt in range(3):
+            if await asyncio.to_thread(lambda: write_shared_state(thaw_snapshot(frozen))): return
+            METRICS.inc("bot_shared_state_conflicts_total")
+            await _pull_shared_state()
+            frozen = freeze_db()
+        METRICS.inc("bot_save_errors_total")
+        logger.error("Save Error: shared state kept changing, giving up for now.")
+
+# --- 5a. MULTI-WORKER SHARED STATE ---
+# With WORKER_COUNT > 1 every worker keeps DB in memory as a cache of one
+# versioned document (MongoDB, or DATA_FILE on a shared disk). Writes are
+# compare-and-swap; a conflicting writer pulls the others' changes with a
+# 3-way merge (per entry of every dict-valued key, set-wise for lists; local
+# edits win) and retries. Followers poll the version and merge changes in.
+WORKER_COUNT = int(os.environ.get("WORKER_COUNT", "1"))
+WORKER_INDEX = int(os.environ.get("WORKER_INDEX", "0"))
+WORKER_ID = os.environ.get("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+STATE_SYNC_INTERVAL = float(os.environ.get("STATE_SYNC_INTERVAL", "5"))
+
+SYNC = {"version": "", "base": {}}  # base: merge_base() of the last synced document
+PER_WORKER_KEYS = ("PENDING_DELETES", "ROLLUPS")  # {worker index: ...}; each worker writes only its own slot
+MERGE_DEPTH = {"PENDING_REQUESTS": 2}  # levels of dict entries merged one by one (default 1: per user, per link, ...)
+STATE_RELOAD_HOOKS = []  # Called after other workers' changes were merged in
+
+def fingerprint(value):
+    return hashlib.blake2b(json.dumps(value).encode("utf-8"), digest_size=8).digest()
+
+def snapshot_fingerprints(data):
+    return {
+        "keys": {k: fingerprint(v) for k, v in data.items() if k != "USER_DATA"},
+        "users": {uid: fingerprint(e) for uid, e in data.get("USER_DATA", {}).items()},
+    }
+
+def fingerprint_tree(value, depth):
+    """Fingerprints per dict entry `depth` levels deep; lists as sets of their JSON items."""
+    if depth > 0 and isinstance(value, dict): return {str(k): fingerprint_tree(v, depth - 1) for k, v in value.items()}
+    if depth > 0 and isinstance(value, list): return frozenset(json.dumps(x) for x in value)
+    return fingerprint(value)
+
+def merge_base(data):
+    """What merge_remote_state compares against: fingerprint trees of a snapshot."""
+    return {k: fingerprint_tree(v, MERGE_DEPTH.get(k, 1)) for k, v in data.items()}
+
+class FileSharedState:
+    """DATA_FILE on a disk shared by all workers; flock-guarded (POSIX only), version in a sidecar file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.version_path = path + ".version"
+        self.lock_path = path + ".lock"
+
+    @contextlib.contextmanager
+    def _locked(self):
+        import fcntl  # POSIX only; imported here so single-worker bots still run on Windows
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try: yield
+            finally: fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def read_version(self):
+        try:
+            with open(self.version_path) as f: return f.read().strip()
+        except FileNotFoundError:
+            return ""
+
+    def read(self):
+        with self._locked():
+            try:
+                with open(self.path) as f: data = json.load(f)
+            except FileNotFoundError:
+                data = {}
+            return self.read_version(), data
+
+    def save(self, expected, data, payload):
+        with self._locked():
+            if self.read_version() != expected: return None
+            version = uuid.uuid4().hex
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f: f.write(payload)
+            os.replace(tmp, self.path)
+            with open(self.version_path, "w") as f: f.write(version)
+            return version
+
+class MongoSharedState:
+    """The main_settings document, guarded by a version field."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def read_version(self):
+        doc = self.collection.find_one({"_id": "main_settings"}, {"version": 1})
+        return (doc or {}).get("version", "")
+
+    def read(self):
+        doc = self.collection.find_one({"_id": "main_settings"}) or {}
+        return doc.get("version", ""), doc.get("data", {})
+
+    def save(self, expected, data, payload):
+        version = uuid.uuid4().hex
+        match = {"_id": "main_settings", "version": expected} if expected else {"_id": "main_settings", "version": {"$exists": False}}
+        try:
+            res = self.collection.replace_one(match, {"_id": "main_settings", "version": version, "data": data}, upsert=True)
+        except Exception as e:
+            # Upsert hit the existing (newer) document: a conflict, not an error
+            if "duplicate key" in str(e).lower(): return None
+            raise
+        return version if (res.matched_count or res.upserted_id) else None
+
+SHARED_STATE = None
+if WORKER_COUNT > 1:
+    SHARED_STATE = MongoSharedState(mongo_collection) if (MONGO_URL and mongo_collection is not None) else FileSharedState(DATA_FILE)
+
+def write_shared_state(data):
+    """Thread-side CAS write of a snapshot copy. Returns False if another worker wrote first."""
+    payload = dumps_snapshot(data)
+    version = SHARED_STATE.save(SYNC["version"], data, payload)
+    if version is None: return False
+    SYNC["version"] = version
+    SYNC["base"] = merge_base(data)
+    METRICS.set("bot_snapshot_bytes", len(payload))
+    HEALTH["last_save"] = time.time()
+    return True
+
+def load_shared_state():
+    version, data = SHARED_STATE.read()
+    apply_loaded(data)
+    SYNC["version"] = version
+    # Base is the normalized view (defaults, owner admin), not the raw document
+    SYNC["base"] = merge_base(build_snapshot())
+    logger.info(f"✅ Database loaded from shared store (worker {WORKER_INDEX}/{WORKER_COUNT}, version {version or 'none'}).")
+
+_MISSING = object()
+
+def merge_entry(container, ckey, rvalue, base, depth, conv=str, decode=None):
+    """
+    3-way merge of container[ckey] (local) with rvalue (remote, JSON form)
+    against base (its fingerprint tree at the last sync, None if absent;
+    _MISSING stands for "no entry"). Dicts are merged entry by entry `depth`
+    levels deep (child keys converted with conv), lists as sets; otherwise
+    a value changed here is kept and an unchanged one takes the remote value
+    (decoded with decode). Returns the number of entries taken from remote.
+    """
+    local = container.get(ckey, _MISSING)
+    sides = [v for v in (local, rvalue) if v is not _MISSING]
+    if depth > 0 and isinstance(base, (dict, type(None))) and sides and all(isinstance(v, dict) for v in sides):
+        # A missing or new dict merges like an empty one, so entries added inside it on either side survive
+        lmap = {} if local is _MISSING else local
+        rmap = {} if rvalue is _MISSING else rvalue
+        base = base or {}
+        taken = 0
+        for skey, rentry in rmap.items():
+            taken += merge_entry(lmap, conv(skey), rentry, base.get(skey), depth - 1)
+        for lkey in [k for k in lmap if str(k) not in rmap]:
+            taken += merge_entry(lmap, lkey, _MISSING, base.get(str(lkey)), depth - 1)
+        if len(sides) < 2 and not lmap: container.pop(ckey, None)
+        elif local is _MISSING: container[ckey] = lmap
+        return taken
+    if depth > 0 and isinstance(local, list) and isinstance(rvalue, list) and isinstance(base, frozenset):
+        ritems = {json.dumps(x) for x in rvalue}
+        litems = {json.dumps(x) for x in local}
+        merged = [x for x in local if json.dumps(x) not in base - ritems]
+        merged += [x for x in rvalue if json.dumps(x) not in base and json.dumps(x) not in litems]
+        if merged == local: return 0
+        container[ckey] = decode(merged) if decode else merged
+        return 1
+
+    if local is not _MISSING and local == rvalue: return 0
+    if (None if local is _MISSING else fingerprint_tree(local, depth)) != base: return 0  # Changed here
+    if rvalue is _MISSING:
+        del container[ckey]  # Deleted by another worker
+    else:
+        container[ckey] = decode(rvalue) if decode else rvalue
+    return 1
+
+def merge_remote_state(remote):
+    """
+    3-way merge of another worker's snapshot into DB against SYNC["base"],
+    entry by entry: anything we changed since the last sync is kept,
+    everything else takes the remote value. Returns the number of entries
+    taken from remote.
+    """
+    base = SYNC["base"]
+    taken = 0
+    for key, rvalue in remote.items():
+        if key not in DB: continue
+        if key in PER_WORKER_KEYS:
+            if encode_value(key) == rvalue: continue
+            # Per-worker slots: ours is authoritative locally, the rest come from remote
+            mine = str(WORKER_INDEX)
+            DB[key] = {**{w: v for w, v in rvalue.items() if w != mine}, mine: DB[key].get(mine, {})}
+            taken += 1
+            continue
+        taken += merge_entry(DB, key, rvalue, base.get(key), MERGE_DEPTH.get(key, 1),
+                             conv=int if key in INT_KEYED else str, decode=lambda v, k=key: decode_value(k, v))
+    return taken
+
+async def _pull_shared_state():
+    """Merges the shared document into DB. Caller holds data_lock."""
+    version, remote = await asyncio.to_thread(SHARED_STATE.read)
+    if version == SYNC["version"]: return 0
+    base = await asyncio.to_thread(merge_base, remote)
+    taken = merge_remote_state(remote)
+    SYNC["version"], SYNC["base"] = version, base
+    METRICS.inc("bot_shared_state_merges_total")
+    if taken:
+        for hook in STATE_RELOAD_HOOKS:
+            try: hook()
+            except Exception as e: logger.error(f"State reload hook failed: {e}")
+    return taken
+
+async def refresh_shared_state():
+    """Read-through on a cache miss: pulls other workers' changes now. Returns True if anything changed."""
+    if SHARED_STATE is None: return False
+    try:
+        if await asyncio.to_thread(SHARED_STATE.read_version) == SYNC["version"]: return False
+        async with data_lock:
+            return await _pull_shared_state() > 0
+    except Exception as e:
+        logger.error(f"Shared state refresh failed: {e}")
+        return False
+
+async def sync_shared_state(context: ContextTypes.DEFAULT_TYPE):
+    """Job (all workers): invalidates the local cache when another worker saved."""
+    await refresh_shared_state()
+
+# Leader election: exactly one worker runs scheduled jobs
+LEASE_TTL = float(os.environ.get("LEASE_TTL", "30"))
+IS_LEADER = WORKER_COUNT <= 1
+
+class FileLease:
+    """Lease in a flock-guarded JSON file (local stand-in for MongoDB)."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def acquire(self, holder, ttl):
+        import fcntl  # POSIX only; make_lease() falls back to SqliteLease without it
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try: cur = json.loads(f.read() or "{}")
+                except ValueError: cur = {}
+                now = time.time()
+                if cur.get("holder") not in (None, holder) and cur.get("expires", 0) > now: return False
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps({"holder": holder, "expires": now + ttl}))
+                f.flush()
+                return True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+class SqliteLease:
+    """Lease row in a SQLite database (local stand-in for MongoDB)."""
+
+    def __init__(self, path):
+        self.path = path
+        with sqlite3.connect(self.path) as db:
+            db.execute("CREATE TABLE IF NOT EXISTS lease (name TEXT PRIMARY KEY, holder TEXT, expires REAL)")
+
+    def acquire(self, holder, ttl):
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            row = db.execute("SELECT holder, expires FROM lease WHERE name = 'leader'").fetchone()
+            if row and row[0] != holder and row[1] > now:
+                db.execute("COMMIT")
+                return False
+            db.execute("INSERT OR REPLACE INTO lease (name, holder, expires) VALUES ('leader', ?, ?)", (holder, now + ttl))
+            db.execute("COMMIT")
+            return True
+        finally:
+            db.close()
+
+class MongoLease:
+    """Lease document next to main_settings."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def acquire(self, holder, ttl):
+        now = time.time()
+        try:
+            self.collection.find_one_and_update(
+                {"_id": "leader_lease", "$or": [{"holder": holder}, {"expires": {"$lt": now}}]},
+                {"$set": {"holder": holder, "expires": now + ttl}},
+                upsert=True,
+            )
+            return True
+        except Exception as e:
+            if "duplicate key" in str(e).lower(): return False  # Held by another worker
+            raise
+
+def make_lease():
+    spec = os.environ.get("LEASE_BACKEND", "")
+    if spec.startswith("sqlite:"): return SqliteLease(spec[len("sqlite:"):])
+    if spec.startswith("file:"): return FileLease(spec[len("file:"):])
+    if MONGO_URL and mongo_collection is not None: return MongoLease(mongo_collection)
+    try: import fcntl  # noqa: F401
+    except ImportError: return SqliteLease(DATA_FILE + ".leader.db")  # No flock (Windows)
+    return FileLease(DATA_FILE + ".leader")
+
+LEASE = make_lease() if WORKER_COUNT > 1 else None
+
+async def renew_lease(context: ContextTypes.DEFAULT_TYPE):
+    """Job (all workers): acquires or renews the leader lease."""
+    global IS_LEADER
+    try:
+        leader = await asyncio.to_thread(LEASE.acquire, WORKER_ID, LEASE_TTL)
+    except Exception as e:
+        logger.error(f"Lease renewal failed: {e}")
+        leader = False
+    if leader != IS_LEADER:
+        logger.info(f"👑 Worker {WORKER_ID} is now {'LEADER' if leader else 'FOLLOWER'}")
+    IS_LEADER = leader
+    METRICS.set("bot_is_leader", int(leader))
+
+def leader_only(job):
+    """Wraps a scheduled job so only the leader worker runs it."""
+    @functools.wraps(job)
+    async def wrapper(context):
+        if IS_LEADER: return await job(context)
+    return wrapper
+
+def update_partition(key):
+    """Worker index that owns an ordering key (stable across processes)."""
+    return zlib.crc32(repr(key).encode()) % WORKER_COUNT
+
+# --- 5b. INSTRUMENTATION ---
+APP = None  # Set in main(); read by the metrics collector
+
+# Set by multibot.py before build_app(): {"interactive": httpx.AsyncClient, ...}
+# shared by every bot hosted in the process. Shared clients are closed by the host.
+SHARED_HTTP = {}
+
+# HTTP transports: getUpdates, interactive replies and bulk jobs (broadcasts,
+# posts, demo expiry waves, scans, uploads) each get their own connection pool,
+# so a broadcast cannot starve button answers. Pool size and pool timeout are
+# per pool; the rest is shared.
+HTTP_VERSION = os.environ.get("HTTP_VERSION", "1.1")  # "2" needs python-telegram-bot[http2]
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "5"))
+HTTP_WRITE_TIMEOUT = float(os.environ.get("HTTP_WRITE_TIMEOUT", "5"))
+HTTP_KEEPALIVE = float(os.environ.get("HTTP_KEEPALIVE", "30"))  # idle seconds before a pooled connection is closed
+HTTP_POOLS = {  # pool -> (connections, seconds to wait for a free connection)
+    "updates": (1, 1.0),
+    "interactive": (int(os.environ.get("HTTP_POOL_SIZE", "256")), float(os.environ.get("HTTP_POOL_TIMEOUT", "1"))),
+    "bulk": (int(os.environ.get("HTTP_BULK_POOL_SIZE", "16")), float(os.environ.get("HTTP_BULK_POOL_TIMEOUT", "30"))),
+}
+HTTP_REQUESTS = []  # every MetricsRequest, for the pool gauges
+
+class MetricsRequest(HTTPXRequest):
+    """
+    HTTPXRequest that counts outbound Bot API calls by method and result.
+    Connections are handed out by a semaphore the size of the pool, so the
+    wait for a free connection can be measured per pool.
+    """
+
+    def __init__(self, *args, pool="interactive", shared=None, **kwargs):
+        self._shared = shared  # read by _build_client during super().__init__
+        super().__init__(*args, **kwargs)
+        self.pool = pool
+        self.size = kwargs.get("connection_pool_size", 1)
+        self.in_use = 0
+        self.waiting = 0
+        self._slots = asyncio.Semaphore(self.size)
+        HTTP_REQUESTS.append(self)
+
+    def _build_client(self):
+        # A shared client (multibot.py) is used as-is; building our own would leak it
+        if self._shared is not None: return self._shared
+        return super()._build_client()
+
+    async def initialize(self):
+        if self._shared is None: await super().initialize()
+
+    async def shutdown(self):
+        if self._shared is None: await super().shutdown()
+
+    async def do_request(self, url, method, *args, **kwargs):
+        pool_timeout = kwargs.get("pool_timeout", BaseRequest.DEFAULT_NONE)
+        if pool_timeout is BaseRequest.DEFAULT_NONE: pool_timeout = self._client.timeout.pool
+        waited = time.perf_counter()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), pool_timeout)
+        except asyncio.TimeoutError:
+            METRICS.inc("bot_http_pool_timeouts_total", pool=self.pool)
+            raise TimedOut(f"Pool timeout: all {self.size} connections of the {self.pool} pool are busy") from None
+        finally:
+            self.waiting -= 1
+        METRICS.observe("bot_http_pool_wait_seconds", time.perf_counter() - waited, pool=self.pool)
+        self.in_use += 1
+        try: return await self._do_request(url, method, *args, **kwargs)
+        finally:
+            self.in_use -= 1
+            self._slots.release()
+
+    async def _do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        result = "network_error"
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            if code == 200: result = "ok"
+            elif code == 429:
+                result = "flood_wait"
+                try:
+                    retry_after = json.loads(payload).get("parameters", {}).get("retry_after", 0)
+                    METRICS.inc("bot_api_flood_wait_seconds_total", retry_after, method=api_method)
+                except Exception: pass
+            else: result = f"http_{code}"
+            return code, payload
+        finally:
+            elapsed = time.perf_counter() - started
+            METRICS.inc("bot_api_calls_total", method=api_method, result=result)
+            METRICS.observe("bot_api_seconds", elapsed, method=api_method)
+            stats = HANDLER_STATS.get()
+            if stats is not None:
+                stats["api"] += elapsed
+                stats["calls"] += 1
+
+def make_request(pool):
+    """MetricsRequest for one of HTTP_POOLS; falls back to HTTP/1.1 if HTTP/2 support is missing."""
+    size, pool_timeout = HTTP_POOLS[pool]
+    kwargs = dict(
+        pool=pool, shared=SHARED_HTTP.get(pool), connection_pool_size=size,
+        connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT,
+        write_timeout=HTTP_WRITE_TIMEOUT, pool_timeout=pool_timeout,
+        httpx_kwargs={"limits": httpx.Limits(max_connections=size, max_keepalive_connections=size, keepalive_expiry=HTTP_KEEPALIVE)},
+    )
+    try:
+        return MetricsRequest(http_version=HTTP_VERSION, **kwargs)
+    except RuntimeError as e:
+        logger.warning(f"HTTP/{HTTP_VERSION} unavailable ({e}); using HTTP/1.1")
+        return MetricsRequest(http_version="1.1", **kwargs)
+
+BULK_BOT = None  # Bot on the "bulk" pool, built in build_app()
+
+def bulk_bot(bot):
+    """The bot to use for bulk jobs (falls back to `bot` when not built, e.g. in benchmarks)."""
+    return BULK_BOT if BULK_BOT is not None else bot
+
+def instrument_handler(callback):
+    """
+    Wraps a handler callback to count updates and time them.
+    Splits wall time into Bot API time, data_lock hold time and the rest,
+    and logs a breakdown when the handler exceeds SLOW_HANDLER_MS.
+    """
+    name = getattr(callback, "__name__", "handler")
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        stats = {"api": 0.0, "lock": 0.0, "calls": 0}
+        token = HANDLER_STATS.set(stats)
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await callback(update, context)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_STATS.reset(token)
+            METRICS.inc("bot_updates_total", handler=name, status=status)
+            METRICS.observe("bot_handler_seconds", elapsed, handler=name)
+            METRICS.observe("bot_handler_api_seconds", stats["api"], handler=name)
+            METRICS.observe("bot_handler_lock_seconds", stats["lock"], handler=name)
+            if elapsed >= SLOW_HANDLER_SECONDS:
+                METRICS.inc("bot_slow_updates_total", handler=name)
+                logger.warning(
+                    f"🐢 Slow handler {name}: {elapsed * 1000:.0f} ms total | "
+                    f"API {stats['api'] * 1000:.0f} ms ({stats['calls']} calls) | "
+                    f"data_lock {stats['lock'] * 1000:.0f} ms | "
+                    f"other {max(0.0, elapsed - stats['api'] - stats['lock']) * 1000:.0f} ms"
+                )
+    return wrapper
+
+def instrument_app(app):
+    for handlers in app.handlers.values():
+        for h in handlers:
+            h.callback = instrument_handler(h.callback)
+
+# --- 5c. CONCURRENT UPDATE PROCESSING ---
+# Updates sharing a key (same user, including their support topic) run
+# strictly in order; unrelated keys run in parallel up to MAX_CONCURRENT_UPDATES.
+# With several workers the key also picks the worker, so both halves of a
+# conversation land where its MESSAGE_MAP (edit/reaction sync) lives.
+# Per-user state (ADMIN_WIZARD, BROADCAST_STATE, SPAM_CACHE) is only touched
+# by that user's own updates, so the key ordering is what keeps it consistent.
+# DB writes are serialized through data_lock in save_data_async.
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "16"))
+
+TOPIC_OWNERS = {}  # support topic id -> user id; reverse index of DB["USER_TOPICS"]
+
+def topic_owner(topic_id):
+    """User whose support topic this is, or None. Rebuilds the reverse index when it is stale."""
+    uid = TOPIC_OWNERS.get(topic_id)
+    if uid is None or DB["USER_TOPICS"].get(uid) != topic_id:
+        TOPIC_OWNERS.clear()
+        TOPIC_OWNERS.update((t, u) for u, t in DB["USER_TOPICS"].items())
+        uid = TOPIC_OWNERS.get(topic_id)
+    return uid
+
+def update_key(update):
+    """Ordering key for an update, or None if it can run unordered."""
+    if not isinstance(update, Update): return None
+    chat = update.effective_chat
+    msg = update.effective_message
+    if chat and chat.id == SUPPORT_GROUP_ID and msg and msg.message_thread_id:
+        owner = topic_owner(msg.message_thread_id)
+        return ("user", owner) if owner else ("topic", msg.message_thread_id)
+    if update.effective_user: return ("user", update.effective_user.id)
+    if chat: return ("chat", chat.id)
+    return None
+
+# Priority: free slots go to the most important waiting update first, and
+# under overload the least important classes are dropped instead of queued.
+# Classes, most important first; SHED_AT is the share of UPDATE_QUEUE_LIMIT
+# waiting updates at which a class is shed (None: never shed). Only private
+# updates from non-admins are ever shed; their senders get a "busy" notice.
+UPDATE_CLASSES = ("admin", "join", "callback", "chat", "message", "low")
+SHED_AT = {"admin": None, "join": None, "callback": None, "chat": None, "message": 1.0, "low": 0.5}
+UPDATE_QUEUE_LIMIT = int(os.environ.get("UPDATE_QUEUE_LIMIT", "1000"))
+SHED_NOTICE_INTERVAL = 600  # seconds between "busy" notices to one user
+SHED_NOTICES = {}  # user_id -> time of the last "busy" notice
+
+def update_class(update):
+    """
+    admins and the support group > join requests/member changes > callbacks
+    > other chats and channels > private messages > private reactions/edits.
+    """
+    if not isinstance(update, Update): return "chat"
+    user, chat = update.effective_user, update.effective_chat
+    if (user and is_admin(user.id)) or (chat and SUPPORT_GROUP_ID and chat.id == SUPPORT_GROUP_ID): return "admin"
+    if update.chat_join_request or update.chat_member or update.my_chat_member: return "join"
+    if update.callback_query: return "callback"
+    if chat is None or chat.type != ChatType.PRIVATE: return "chat"
+    if update.message_reaction or update.message_reaction_count or update.edited_message: return "low"
+    return "message"
+
+def notify_shed(update):
+    """Tells the sender of a dropped private message to resend it (at most once per SHED_NOTICE_INTERVAL)."""
+    user = update.effective_user if isinstance(update, Update) else None
+    if user is None: return
+    try: bot = update.get_bot()
+    except RuntimeError: return
+    now = time.time()
+    if now - SHED_NOTICES.get(user.id, 0) < SHED_NOTICE_INTERVAL: return
+    if len(SHED_NOTICES) > 10000:
+        for uid in [u for u, t in SHED_NOTICES.items() if now - t >= SHED_NOTICE_INTERVAL]: del SHED_NOTICES[uid]
+    SHED_NOTICES[user.id] = now
+    task = asyncio.create_task(_send_shed_notice(bot, user.id))
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+
+async def _send_shed_notice(bot, user_id):
+    try:
+        await PACER.wait(user_id)
+        await bot.send_message(user_id, "⏳ The bot is very busy right now and your last message was not delivered. Please send it again in a few minutes.")
+    except Exception as e:
+        logger.warning(f"Busy notice to {user_id} failed: {e}")
+
+class PriorityGate:
+    """Semaphore whose free slots are handed to the waiter with the lowest priority number (FIFO within one)."""
+
+    def __init__(self, slots):
+        self.free = slots
+        self._waiters = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+
+    async def acquire(self, priority):
+        if self.free > 0 and not self._waiters:
+            self.free -= 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # Handed a slot just as we were cancelled: pass it on
+            if fut.done() and not fut.cancelled(): self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.free += 1
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Concurrent update processor with per-key ordering.
+    The base semaphore only caps tasks in flight; the real concurrency
+    limit is taken AFTER the key lock, so a burst from one user can never
+    occupy slots that unrelated users need. Slots are granted by update
+    class (update_class) and low classes are shed when too many wait.
+    """
+
+    def __init__(self, max_concurrent):
+        super().__init__(max(4096, max_concurrent))
+        self.limit = max_concurrent
+        self._slots = PriorityGate(max_concurrent)
+        self._keys = {}  # key -> [asyncio.Lock, pending count]
+        self.pending = 0
+        self.running = 0
+        self.pending_by_class = collections.Counter()
+        self.running_by_class = collections.Counter()
+
+    def should_shed(self, cls):
+        share = SHED_AT[cls]
+        return share is not None and self.waiting >= UPDATE_QUEUE_LIMIT * share
+
+    async def do_process_update(self, update, coroutine):
+        cls = update_class(update)
+        if self.should_shed(cls):
+            coroutine.close()
+            METRICS.inc("bot_updates_shed_total", update_class=cls)
+            if cls == "message": notify_shed(update)
+            return
+        key = update_key(update)
+        self.pending += 1
+        self.pending_by_class[cls] += 1
+        try:
+            if key is None:
+                await self._run(coroutine, cls)
+                return
+            entry = self._keys.get(key)
+            if entry is None: entry = self._keys[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    await self._run(coroutine, cls)
+            finally:
+                entry[1] -= 1
+                if entry[1] == 0: self._keys.pop(key, None)
+        finally:
+            self.pending -= 1
+            self.pending_by_class[cls] -= 1
+
+    async def _run(self, coroutine, cls):
+        started = time.perf_counter()
+        await self._slots.acquire(UPDATE_CLASSES.index(cls))
+        METRICS.observe("bot_update_queue_wait_seconds", time.perf_counter() - started, update_class=cls)
+        self.running += 1
+        self.running_by_class[cls] += 1
+        try: await coroutine
+        finally:
+            self.running -= 1
+            self.running_by_class[cls] -= 1
+            self._slots.release()
+
+    @property
+    def waiting(self):
+        return self.pending - self.running
+
+    def waiting_in(self, cls):
+        return self.pending_by_class[cls] - self.running_by_class[cls]
+
+    async def initialize(self): pass
+
+    async def shutdown(self): pass
+
+UPDATE_PROCESSOR = KeyedUpdateProcessor(MAX_CONCURRENT_UPDATES) if MAX_CONCURRENT_UPDATES > 1 else None
+
+# --- 5d. WEBHOOK RECEIVER ---
+WORKER_PEERS = [u.strip().rstrip("/") for u in os.environ.get("WORKER_PEERS", "").split(",") if u.strip()]
+_PEER_CLIENT = None
+
+async def forward_update(owner, body, update):
+    """Hands an update to the worker that owns its partition; processes it here if that fails."""
+    global _PEER_CLIENT
+    try:
+        if _PEER_CLIENT is None: _PEER_CLIENT = httpx.AsyncClient(timeout=10)
+        r = await _PEER_CLIENT.post(
+            WORKER_PEERS[owner] + WEBHOOK_PATH, content=body,
+            headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET, "X-Bot-Forwarded": WORKER_ID,
+                     "Content-Type": "application/json"},
+        )
+        r.raise_for_status()
+        METRICS.inc("bot_webhook_forwarded_total", result="ok")
+    except Exception as e:
+        logger.warning(f"Forward to worker {owner} failed ({e}); processing locally.")
+        METRICS.inc("bot_webhook_forwarded_total", result="fallback")
+        await APP.update_queue.put(update)
+
+def receive_webhook_update(secret, content_length, body, forwarded=False):
+    """
+    Validates a webhook POST and queues the update for the application.
+    Runs on the bot loop (health server). Returns (status, body).
+    In multi-worker mode updates owned by another worker are forwarded to it.
+    """
+    if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+        METRICS.inc("bot_webhook_requests_total", result="forbidden")
+        return 403, "Forbidden"
+    if (content_length or len(body)) > WEBHOOK_MAX_BODY:
+        METRICS.inc("bot_webhook_requests_total", result="too_large")
+        return 413, "Payload Too Large"
+    if APP is None or not APP.running:
+        METRICS.inc("bot_webhook_requests_total", result="not_ready")
+        return 503, "Starting"
+    try:
+        update = Update.de_json(json.loads(body), APP.bot)
+    except Exception as e:
+        logger.warning(f"Rejected webhook payload: {e}")
+        METRICS.inc("bot_webhook_requests_total", result="bad_request")
+        return 400, "Bad Request"
+    if WORKER_COUNT > 1 and not forwarded:
+        key = update_key(update)
+        owner = update_partition(key) if key else WORKER_INDEX
+        if owner != WORKER_INDEX and owner < len(WORKER_PEERS):
+            task = asyncio.create_task(forward_update(owner, body, update))
+            BACKGROUND_TASKS.add(task)
+            task.add_done_callback(BACKGROUND_TASKS.discard)
+            return 200, "OK"
+    APP.update_queue.put_nowait(update)
+    METRICS.inc("bot_webhook_requests_total", result="ok")
+    return 200, "OK"
+
+async def run_webhook(app):
+    """
+    Runs the application without getUpdates; updates arrive via receive_webhook_update.
+    If no public URL is known the webhook is not registered, which allows
+    local testing by POSTing recorded update JSON to WEBHOOK_PATH.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try: loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError: pass
+
+    await start_app(app)
+    try: await stop.wait()
+    finally: await stop_app(app)
+
+async def start_app(app):
+    """
+    Initializes and starts the application inside an already running loop:
+    registers the webhook (webhook mode) or starts getUpdates polling.
+    Used by run_webhook and by multibot.py for every hosted bot.
+    """
+    await app.initialize()
+    await on_startup(app)
+    if not WEBHOOK_MODE:
+        await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    elif WORKER_INDEX != 0:
+        logger.info(f"Worker {WORKER_INDEX}: webhook is registered by worker 0.")
+    elif WEBHOOK_URL:
+        await app.bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        logger.info(f"Webhook registered at {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    else:
+        logger.warning(
+            f"No WEBHOOK_URL known - webhook NOT registered (local test mode). "
+            f"POST updates to {WEBHOOK_PATH} with the WEBHOOK_SECRET header."
+        )
+    await app.start()
+
+async def stop_app(app):
+    if app.updater and app.updater.running: await app.updater.stop()
+    if app.running: await app.stop()
+    await on_shutdown(app)
+    await app.shutdown()
+
+BACKGROUND_TASKS = set()
+HEALTH_SERVER = HealthServer(PORT)
+
+async def on_startup(app):
+    """post_init: starts services that live on the bot loop."""
+    if PORT: await HEALTH_SERVER.start()
+    if BULK_BOT is not None: await BULK_BOT.initialize()
+    task = asyncio.create_task(monitor_loop_lag())
+    BACKGROUND_TASKS.add(task)
+    if STALL_THRESHOLD > 0:
+        WATCHDOG["thread"] = StallWatchdog(asyncio.get_running_loop())
+        WATCHDOG["thread"].start()
+
+async def on_shutdown(app):
+    for task in BACKGROUND_TASKS: task.cancel()
+    BACKGROUND_TASKS.clear()
+    if "thread" in WATCHDOG: WATCHDOG.pop("thread").stopped.set()
+    if BULK_BOT is not None: await BULK_BOT.shutdown()
+    await HEALTH_SERVER.stop()
+    if _PEER_CLIENT is not None: await _PEER_CLIENT.aclose()
+    await flush_saves(final=True)
+
+async def mark_update_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    HEALTH["last_update"] = time.time()
+
+@METRICS.collector
+def _collect_runtime_gauges():
+    METRICS.set("bot_process_rss_bytes", process_rss_bytes())
+    METRICS.set("bot_structure_entries", len(DB["USER_DATA"]), structure="USER_DATA")
+    METRICS.set("bot_structure_entries", len(DB["LINK_MAP"]), structure="LINK_MAP")
+    METRICS.set("bot_structure_entries", len(MESSAGE_MAP), structure="MESSAGE_MAP")
+    METRICS.set("bot_structure_entries", len(SPAM_CACHE), structure="SPAM_CACHE")
+    METRICS.set("bot_pending_deletes", sum(
+        len(ids) for chats in DB["PENDING_DELETES"].values() for buckets in chats.values() for ids in buckets.values()
+    ))
+    if APP is not None:
+        METRICS.set("bot_update_queue_depth", APP.update_queue.qsize())
+        if APP.job_queue: METRICS.set("bot_job_queue_depth", len(APP.job_queue.jobs()))
+    for req in HTTP_REQUESTS:
+        METRICS.set("bot_http_pool_size", req.size, pool=req.pool)
+        METRICS.set("bot_http_pool_in_use", req.in_use, pool=req.pool)
+        METRICS.set("bot_http_pool_waiting", req.waiting, pool=req.pool)
+    if UPDATE_PROCESSOR is not None:
+        METRICS.set("bot_updates_in_progress", UPDATE_PROCESSOR.running)
+        METRICS.set("bot_updates_waiting", UPDATE_PROCESSOR.waiting)
+        for cls in UPDATE_CLASSES:
+            METRICS.set("bot_updates_waiting_by_class", UPDATE_PROCESSOR.waiting_in(cls), update_class=cls)
+
+# --- 5e. UPDATE RECORDER ---
+# Opt-in: RECORD_UPDATES=<path> appends every incoming update, anonymized, to a
+# rotating JSONL log that tools/replay.py can feed back into the Application.
+# User ids become stable HMAC pseudonyms, names and message text are masked
+# (commands and entity offsets are kept). Group/channel ids are kept as-is.
+RECORD_UPDATES = os.environ.get("RECORD_UPDATES", "")
+RECORD_MAX_BYTES = int(os.environ.get("RECORD_MAX_BYTES", str(50 * 1024 * 1024)))
+RECORD_BACKUPS = int(os.environ.get("RECORD_BACKUPS", "5"))
+RECORD_SALT = (os.environ.get("RECORD_SALT") or secrets.token_hex(16)).encode()
+RECORD_DROP = {"last_name", "bio", "phone_number", "contact", "location", "venue"}
+
+def pseudonym(uid):
+    digest = hmac.new(RECORD_SALT, str(uid).encode(), hashlib.sha256).digest()
+    return 1_000_000_000 + int.from_bytes(digest[:8], "big") % 9_000_000_000
+
+def mask_text(text):
+    """Keeps a leading /command; every other non-space char becomes x (UTF-16 length preserved)."""
+    head, rest = "", text
+    if text.startswith("/"):
+        head, _, rest = text.partition(" ")
+        head, rest = head + (" " if rest or text.endswith(" ") else ""), rest
+    return head + "".join(c if c.isspace() else "x" * (2 if ord(c) > 0xFFFF else 1) for c in rest)
+
+def anonymize(obj):
+    if isinstance(obj, list): return [anonymize(v) for v in obj]
+    if not isinstance(obj, dict): return obj
+    out = {}
+    for k, v in obj.items():
+        if k in RECORD_DROP: continue
+        if k in ("id", "user_id", "user_chat_id", "chat_id") and isinstance(v, int) and v > 0: v = pseudonym(v)
+        elif k in ("text", "caption") and isinstance(v, str): v = mask_text(v)
+        elif k == "first_name": v = "User"
+        elif k == "username" and "id" in obj: v = f"user{pseudonym(obj['id']) if obj['id'] > 0 else -obj['id']}"
+        elif k == "file_name": v = "file"
+        else: v = anonymize(v)
+        out[k] = v
+    return out
+
+class UpdateRecorder(logging.handlers.RotatingFileHandler):
+    """Rotating JSONL file; every new file starts with a meta line for replay."""
+
+    def _open(self):
+        stream = super()._open()
+        if stream.tell() == 0:
+            meta = {"owner": pseudonym(OWNER_ID), "support": SUPPORT_GROUP_ID, "mandatory": MANDATORY_CHANNEL_ID,
+                    "free": list(DB["FREE_CHANNELS"]), "paid": list(DB["PAID_CHANNELS"]), "started": time.time()}
+            stream.write(json.dumps({"meta": meta}) + "\n")
+        return stream
+
+RECORDER = None
+if RECORD_UPDATES:
+    RECORDER = logging.getLogger(f"{__name__}.recorder")
+    RECORDER.propagate = False
+    _recorder_handler = UpdateRecorder(RECORD_UPDATES, maxBytes=RECORD_MAX_BYTES, backupCount=RECORD_BACKUPS, delay=True)
+    _recorder_handler.setFormatter(logging.Formatter("%(message)s"))
+    RECORDER.addHandler(_recorder_handler)
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    RECORDER.info(json.dumps({"t": time.time(), "update": anonymize(update.to_dict())}, ensure_ascii=False))
+    METRICS.inc("bot_recorded_updates_total")
 
 # --- 6. CORE HELPERS (FIXED) ---
 
@@ -249,18 +1542,56 @@ def check_spam(uid):
     if now - last < 1.5: return True
     return False
 
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller starts the
+    work, later callers await the same in-flight task instead of repeating it.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._inflight = {}
+
+    async def do(self, key, fn):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._inflight.pop(k, None))
+            METRICS.inc("bot_singleflight_calls_total", op=self.name)
+        else:
+            METRICS.inc("bot_singleflight_coalesced_total", op=self.name)
+        # shield: a cancelled waiter must not cancel the shared call
+        return await asyncio.shield(task)
+
+TOPIC_FLIGHT = SingleFlight("create_topic")
+CHAT_FLIGHT = SingleFlight("get_chat")
+MEMBER_FLIGHT = SingleFlight("get_chat_member")
+INVITE_FLIGHT = SingleFlight("create_invite_link")
+
+async def fetch_chat(bot, chat_id):
+    return await CHAT_FLIGHT.do(chat_id, lambda: bot.get_chat(chat_id))
+
+async def fetch_member(bot, chat_id, user_id):
+    return await MEMBER_FLIGHT.do((chat_id, user_id), lambda: bot.get_chat_member(chat_id, user_id))
+
+async def create_invite_link(bot, chat_id, user_id, kind, **kwargs):
+    return await INVITE_FLIGHT.do(
+        (chat_id, user_id, kind), lambda: bot.create_chat_invite_link(chat_id, creates_join_request=True, **kwargs)
+    )
+
 async def check_membership(user_id, context):
     """Checks if user is in Mandatory Channel."""
     if is_admin(user_id) or not MANDATORY_CHANNEL_ID: return True
     try:
-        m = await context.bot.get_chat_member(MANDATORY_CHANNEL_ID, user_id)
+        m = await fetch_member(context.bot, MANDATORY_CHANNEL_ID, user_id)
         return m.status in [ChatMember.MEMBER, ChatMember.ADMINISTRATOR, ChatMember.OWNER]
     except: return False
 
 async def is_already_in_channel(context, chat_id, user_id):
     """Checks if user is ALREADY in the target batch."""
     try:
-        member = await context.bot.get_chat_member(chat_id, user_id)
+        member = await fetch_member(context.bot, chat_id, user_id)
         if member.status in [ChatMember.MEMBER, ChatMember.ADMINISTRATOR, ChatMember.OWNER]:
             return True
         return False
@@ -269,14 +1600,51 @@ async def is_already_in_channel(context, chat_id, user_id):
     except Exception:
         return False
 
-async def delete_later(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    try: await context.bot.delete_message(chat_id=job.data['chat_id'], message_id=job.data['msg_id'])
-    except: pass
+# Auto-delete: message ids are grouped per chat into DELETE_BUCKET_SECONDS
+# time buckets in DB["PENDING_DELETES"] (so they survive redeploys) and
+# removed by flush_deletes with deleteMessages, up to 100 ids per call.
+# Each worker owns its own slot, so multi-worker merges never conflict.
+# The queue is persisted lazily (mark_dirty(lazy=True)) with the next save.
+DELETE_AFTER = 1200
+DELETE_BUCKET_SECONDS = int(os.environ.get("DELETE_BUCKET_SECONDS", "30"))
+DELETE_BATCH = 100
+
+async def schedule_delete(context, message, delay=DELETE_AFTER):
+    if not message: return
+    due = int(time.time() + delay)
+    bucket = str(due - due % DELETE_BUCKET_SECONDS + DELETE_BUCKET_SECONDS)
+    slot = DB["PENDING_DELETES"].setdefault(str(WORKER_INDEX), {})
+    slot.setdefault(str(message.chat.id), {}).setdefault(bucket, []).append(message.message_id)
+    mark_dirty(lazy=True)
+
+async def delete_batch(bot, chat_id, message_ids):
+    await PACER.wait(chat_id)
+    try: await call_with_retry(bot.delete_messages, chat_id, message_ids)
+    except Exception as e:
+        METRICS.inc("bot_delete_failures_total")
+        logger.warning(f"Bulk delete in {chat_id} failed: {e}")
 
-async def schedule_delete(context, message):
-    if message:
-        context.job_queue.run_once(delete_later, 1200, data={'chat_id': message.chat.id, 'msg_id': message.message_id})
+async def flush_deletes(context: ContextTypes.DEFAULT_TYPE):
+    """Deletes every due bucket. The leader also drains slots of workers that no longer exist."""
+    now = time.time()
+    pending = DB["PENDING_DELETES"]
+    mine = str(WORKER_INDEX)
+    slots = [mine] + ([w for w in pending if w != mine and int(w) >= WORKER_COUNT] if IS_LEADER else [])
+    batches = []
+    for w in slots:
+        chats = pending.get(w, {})
+        for chat, buckets in list(chats.items()):
+            ids = []
+            for bucket in [b for b in buckets if int(b) <= now]: ids += buckets.pop(bucket)
+            if not buckets: del chats[chat]
+            batches += [(int(chat), ids[i:i + DELETE_BATCH]) for i in range(0, len(ids), DELETE_BATCH)]
+        if not chats and w != mine: pending.pop(w, None)
+
+    if batches:
+        await run_paced(batches, lambda b: delete_batch(bulk_bot(context.bot), *b))
+        METRICS.inc("bot_delete_calls_total", len(batches))
+        METRICS.inc("bot_deleted_messages_total", sum(len(b[1]) for b in batches))
+        mark_dirty(lazy=True)
 
 async def get_or_create_topic(user, context):
     """
@@ -288,12 +1656,11 @@ async def get_or_create_topic(user, context):
     # 1. Check DB first (To avoid creating duplicate if already known)
     if user.id in DB["USER_TOPICS"]: return DB["USER_TOPICS"][user.id]
 
-    # 2. Lock to prevent race conditions
-    if user.id in TOPIC_CREATION_LOCK:
-        await asyncio.sleep(1) 
-        if user.id in DB["USER_TOPICS"]: return DB["USER_TOPICS"][user.id]
-    
-    TOPIC_CREATION_LOCK.add(user.id)
+    # 2. Concurrent callers share one creation
+    return await TOPIC_FLIGHT.do(user.id, lambda: _create_topic(user, context))
+
+async def _create_topic(user, context):
+    if user.id in DB["USER_TOPICS"]: return DB["USER_TOPICS"][user.id]
     try:
         # Create new topic
         name = f"{user.first_name[:20]} ({user.id})"
@@ -328,8 +1695,50 @@ async def get_or_create_topic(user, context):
     except Exception as e:
         logger.error(f"Topic Creation Error: {e}")
         return None
-    finally:
-        TOPIC_CREATION_LOCK.discard(user.id)
+
+# --- 6b. PACED API WORKERS ---
+# Bulk jobs (demo expiry waves, bulk approvals, removals) fan out over a
+# bounded number of workers, space calls per chat and sleep through flood-waits.
+BULK_WORKERS = int(os.environ.get("BULK_WORKERS", "8"))
+CHAT_PACE_SECONDS = float(os.environ.get("CHAT_PACE_SECONDS", "0.1"))
+FLOOD_RETRIES = 3
+
+class ChatPacer:
+    """Reserves time slots so calls against one chat are at least `interval` apart."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._next = {}  # chat_id -> loop time of the next free slot
+
+    async def wait(self, chat_id):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next.get(chat_id, 0.0))
+        self._next[chat_id] = slot + self.interval
+        if len(self._next) > 10000:
+            self._next = {c: t for c, t in self._next.items() if t > now}
+        if slot > now: await asyncio.sleep(slot - now)
+
+PACER = ChatPacer(CHAT_PACE_SECONDS)
+
+async def call_with_retry(fn, *args, **kwargs):
+    """Calls a Bot API method, sleeping through flood-waits (RetryAfter)."""
+    for attempt in range(FLOOD_RETRIES + 1):
+        try:
+            return await fn(*args, **kwargs)
+        except RetryAfter as e:
+            if attempt == FLOOD_RETRIES: raise
+            delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            METRICS.inc("bot_flood_wait_retries_total", method=getattr(fn, "__name__", "api"))
+            logger.warning(f"Flood-wait {delay}s on {getattr(fn, '__name__', 'api')}, retrying")
+            await asyncio.sleep(delay)
+
+async def run_paced(items, worker, concurrency=BULK_WORKERS):
+    """Runs `await worker(item)` for every item with bounded concurrency. Exceptions are returned, not raised."""
+    sem = asyncio.Semaphore(concurrency)
+    async def one(item):
+        async with sem: return await worker(item)
+    return await asyncio.gather(*(one(i) for i in items), return_exceptions=True)
 
 # --- 7. AUTO-TRACK CHATS (NEW) ---
 
@@ -410,26 +1819,436 @@ async def cmd_del_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await schedule_delete(context, update.message)
     await schedule_delete(context, msg)
 
-async def cmd_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Owner-only profiler (/profile)
+PROFILE_STATE = {"running": False}
+
+def _sample_main_thread(seconds, interval=0.005):
+    """Samples the main (event loop) thread's stack from a helper thread."""
+    main_id = threading.main_thread().ident
+    leaf, inclusive = collections.Counter(), collections.Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(main_id)
+        seen = set()
+        top = True
+        while frame is not None:
+            code = frame.f_code
+            key = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            if top:
+                leaf[key] += 1
+                top = False
+            if key not in seen:
+                inclusive[key] += 1
+                seen.add(key)
+            frame = frame.f_back
+        samples += 1
+        time.sleep(interval)
+
+    lines = [f"SAMPLING PROFILE - {seconds}s, {samples} samples every {interval * 1000:.0f} ms", ""]
+    for title, counter in (("TOP SELF (leaf frames)", leaf), ("TOP INCLUSIVE", inclusive)):
+        lines.append(f"--- {title} ---")
+        for key, n in counter.most_common(40):
+            lines.append(f"{n / max(samples, 1) * 100:6.2f}%  {n:>7}  {key}")
+        lines.append("")
+    return "\n".join(lines)
+
+async def _profile_cprofile(seconds):
+    prof = cProfile.Profile()
+    prof.enable()
+    try: await asyncio.sleep(seconds)
+    finally: prof.disable()
+    out = io.StringIO()
+    out.write(f"CPROFILE - {seconds}s\n\n--- BY CUMULATIVE TIME ---\n")
+    pstats.Stats(prof, stream=out).sort_stats("cumulative").print_stats(40)
+    out.write("\n--- BY OWN TIME ---\n")
+    pstats.Stats(prof, stream=out).sort_stats("tottime").print_stats(40)
+    return out.getvalue()
+
+async def _run_profile(bot, chat_id, seconds, mode):
+    try:
+        if mode == "cprofile": report = await _profile_cprofile(seconds)
+        else: report = await asyncio.to_thread(_sample_main_thread, seconds)
+        f = io.BytesIO(report.encode("utf-8"))
+        f.name = f"profile_{mode}_{int(time.time())}.txt"
+        await bot.send_document(chat_id, document=f, caption=f"🔬 {mode} profile ({seconds}s)")
+    except Exception as e:
+        logger.error(f"Profiling Error: {e}")
+        try: await bot.send_message(chat_id, f"❌ Profiling failed: {e}")
+        except: pass
+    finally:
+        PROFILE_STATE["running"] = False
+
+async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Profiles the whole bot for N seconds in the background.
+    Usage: /profile [seconds] [cprofile|sample]
+    """
     if update.effective_user.id != OWNER_ID: return
-    save_data_sync()
-    if os.path.exists(DATA_FILE):
-        await update.message.reply_document(document=open(DATA_FILE, "rb"), caption="DB Backup (JSON)")
+    try:
+        seconds = int(context.args[0]) if context.args else 30
+        mode = context.args[1].lower() if len(context.args) > 1 else "cprofile"
+        if not 1 <= seconds <= 600 or mode not in ("cprofile", "sample"): raise ValueError
+    except:
+        msg = await update.message.reply_text("Usage: /profile [seconds 1-600] [cprofile|sample]")
+        await schedule_delete(context, update.message)
+        await schedule_delete(context, msg)
+        return
+
+    if PROFILE_STATE["running"]:
+        msg = await update.message.reply_text("⚠️ A profile is already running.")
     else:
-        msg = await update.message.reply_text("No DB file found locally.")
+        PROFILE_STATE["running"] = True
+        # Run in the background so the profiled period sees normal traffic
+        context.application.create_task(_run_profile(context.bot, update.effective_chat.id, seconds, mode))
+        msg = await update.message.reply_text(f"🔬 Profiling ({mode}) for {seconds}s...")
+    await schedule_delete(context, update.message)
+    await schedule_delete(context, msg)
+
+# Owner-only memory profiler (/memprofile)
+MEMORY_LOG_INTERVAL = float(os.environ.get("MEMORY_LOG_INTERVAL", "3600"))  # seconds; 0 disables
+MEMPROFILE_STATE = {"running": False}
+
+def memory_structures():
+    """Global structures worth watching, name -> object."""
+    structures = {f"DB.{k}": v for k, v in DB.items()}
+    structures.update({
+        "MESSAGE_MAP": MESSAGE_MAP, "SPAM_CACHE": SPAM_CACHE, "ADMIN_WIZARD": ADMIN_WIZARD,
+        "BROADCAST_STATE": BROADCAST_STATE, "BATCH_MENUS": BATCH_MENUS, "ALBUMS": ALBUMS,
+        "RELAY_QUEUES": RELAY_QUEUES, "RELAY_BUCKETS": RELAY_BUCKETS, "RELAY_NOTICES": RELAY_NOTICES,
+        "SHED_NOTICES": SHED_NOTICES,
+        "PACER": PACER._next, "METRICS": [METRICS.counters, METRICS.gauges, METRICS.histograms],
+    })
+    if APP is not None and APP.job_queue:
+        structures["JobQueue"] = [job.data for job in APP.job_queue.jobs()]
+    return structures
+
+def deep_size(obj):
+    """
+    Bytes held by obj and everything reachable through dicts, lists, tuples,
+    sets and deques. Other objects count shallow, so handler contexts and
+    telegram objects inside queues are not walked.
+    """
+    seen, total, stack = set(), 0, [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen: continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict): stack.extend(itertools.chain.from_iterable(list(o.items())))
+        elif isinstance(o, (list, tuple, set, frozenset, collections.deque)): stack.extend(list(o))
+    return total
+
+def memory_breakdown(deep=True):
+    """[(name, entries, bytes or None)], largest first."""
+    rows = [(name, len(obj) if hasattr(obj, "__len__") else 0, deep_size(obj) if deep else None)
+            for name, obj in memory_structures().items()]
+    return sorted(rows, key=lambda r: (r[2] or 0, r[1]), reverse=True)
+
+def format_breakdown(rows):
+    lines = [f"RSS: {process_rss_bytes() / 1e6:.1f} MB | GC objects: {len(gc.get_objects())}", "",
+             f"{'STRUCTURE':<24} {'ENTRIES':>10} {'DEEP SIZE':>12}"]
+    for name, entries, size in rows:
+        lines.append(f"{name:<24} {entries:>10} {size / 1e6:>9.2f} MB")
+    return "\n".join(lines)
+
+def _tracemalloc_diff(first, second, top=40):
+    lines = ["", f"--- TOP {top} GROWING ALLOCATION SITES ---"]
+    for stat in second.compare_to(first, "traceback")[:top]:
+        if stat.size_diff <= 0: break
+        lines.append(f"{stat.size_diff / 1024:+10.1f} KiB  {stat.count_diff:+8} blocks  (now {stat.size / 1024:.1f} KiB)")
+        lines.extend(f"      {line}" for line in stat.traceback.format()[-6:])
+    return "\n".join(lines)
+
+async def _run_memprofile(bot, chat_id, minutes):
+    started_tracing = False
+    try:
+        report = await asyncio.to_thread(lambda: format_breakdown(memory_breakdown()))
+        if minutes:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+                started_tracing = True
+            first = tracemalloc.take_snapshot()
+            await asyncio.sleep(minutes * 60)
+            second = tracemalloc.take_snapshot()
+            report += "\n" + await asyncio.to_thread(_tracemalloc_diff, first, second)
+        f = io.BytesIO(report.encode("utf-8"))
+        f.name = f"memprofile_{int(time.time())}.txt"
+        await bot.send_document(chat_id, document=f, caption=f"🧠 Memory profile (RSS {process_rss_bytes() / 1e6:.0f} MB)")
+    except Exception as e:
+        logger.error(f"Memory Profiling Error: {e}")
+        try: await bot.send_message(chat_id, f"❌ Memory profiling failed: {e}")
+        except: pass
+    finally:
+        if started_tracing: tracemalloc.stop()
+        MEMPROFILE_STATE["running"] = False
+
+async def cmd_memprofile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Deep size and entry count of each global structure; with N minutes, also
+    the allocation sites that grew between two tracemalloc snapshots.
+    Usage: /memprofile [minutes]
+    """
+    if update.effective_user.id != OWNER_ID: return
+    try:
+        minutes = float(context.args[0]) if context.args else 0
+        if not 0 <= minutes <= 60: raise ValueError
+    except:
+        msg = await update.message.reply_text("Usage: /memprofile [minutes 0-60]")
+        await schedule_delete(context, update.message)
         await schedule_delete(context, msg)
+        return
+
+    if MEMPROFILE_STATE["running"]:
+        msg = await update.message.reply_text("⚠️ A memory profile is already running.")
+    else:
+        MEMPROFILE_STATE["running"] = True
+        context.application.create_task(_run_memprofile(context.bot, update.effective_chat.id, minutes))
+        note = f", tracing allocations for {minutes:g} min" if minutes else ""
+        msg = await update.message.reply_text(f"🧠 Measuring memory{note}...")
     await schedule_delete(context, update.message)
+    await schedule_delete(context, msg)
+
+async def log_memory(context: ContextTypes.DEFAULT_TYPE):
+    """Periodic memory line in the logs (entry counts only; deep sizes are for /memprofile)."""
+    rss = process_rss_bytes()
+    METRICS.set("bot_process_rss_bytes", rss)
+    top = ", ".join(f"{name}={entries}" for name, entries, _ in memory_breakdown(deep=False)[:8])
+    logger.info(f"🧠 Memory: RSS {rss / 1e6:.1f} MB | {top}")
+
+# --- 8b. REPORT EXPORTS ---
+# Reports are streamed row by row to a temp file in a worker thread and
+# uploaded when done, instead of being built as one string on the event loop.
+EXPORT_FORMATS = ("txt", "csv", "jsonl")
+EXPORT_MAX_BYTES = 49 * 1024 * 1024  # Bot API upload limit is 50 MB
+METRICS.buckets["bot_report_bytes"] = (1e4, 1e5, 1e6, 1e7, 5e7)
+
+def parse_export_args(args, filters=True):
+    """`csv gz after=2024-01-31 active batch=-100123` -> options dict. filters=False rejects the user filters."""
+    opts = {"fmt": "txt", "gz": False, "after": None, "active": False, "batch": None}
+    for arg in args:
+        arg = arg.lower()
+        if arg in EXPORT_FORMATS: opts["fmt"] = arg
+        elif arg in ("gz", "gzip"): opts["gz"] = True
+        elif not filters: raise ValueError(arg)
+        elif arg == "active": opts["active"] = True
+        elif arg.startswith("after="): opts["after"] = datetime.strptime(arg[6:], "%Y-%m-%d").timestamp()
+        elif arg.startswith("batch="): opts["batch"] = str(int(arg[6:]))
+        else: raise ValueError(arg)
+    return opts
+
+def stream_report(rows, columns, opts, header="", txt_row=None, footer=None):
+    """Writes rows to a temp file (worker thread). Returns (path, row count)."""
+    fd, path = tempfile.mkstemp(prefix="report_")
+    os.close(fd)
+    opener = gzip.open if opts["gz"] else open
+    count = 0
+    try:
+        with opener(path, "wt", encoding="utf-8", newline="") as f:
+            if opts["fmt"] == "csv":
+                writer = csv.writer(f)
+                writer.writerow(columns)
+            elif opts["fmt"] == "txt":
+                f.write(header)
+            for row in rows:
+                if opts["fmt"] == "csv": writer.writerow(row)
+                elif opts["fmt"] == "jsonl": f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+                else: f.write(txt_row(row) + "\n")
+                count += 1
+            if opts["fmt"] == "txt" and footer: f.write(footer(count))
+    except:
+        os.remove(path)
+        raise
+    return path, count
+
+async def send_report(update, name, caption, rows, columns, opts, **txt):
+    """Streams the report off-loop, uploads it and removes the temp file."""
+    path, count = await asyncio.to_thread(stream_report, rows, columns, opts, **txt)
+    try:
+        size = os.path.getsize(path)
+        METRICS.observe("bot_report_bytes", size, report=name)
+        if size > EXPORT_MAX_BYTES:
+            await update.message.reply_text(f"⚠️ Report is {size // 1048576} MB, over the upload limit. Use `gz` or filters.", parse_mode=ParseMode.MARKDOWN)
+            return
+        filename = f"{name}.{opts['fmt']}" + (".gz" if opts["gz"] else "")
+        with open(path, "rb") as f:
+            # Large uploads go over the bulk pool
+            if BULK_BOT is None: await update.message.reply_document(document=f, filename=filename, caption=caption.format(count=count))
+            else: await BULK_BOT.send_document(update.effective_chat.id, document=f, filename=filename, caption=caption.format(count=count))
+    finally:
+        os.remove(path)
+
+def user_rows(items, opts):
+    """Rows for /allusers. `items` is a snapshot list of USER_DATA items."""
+    now = time.time()
+    for uid, data in items:
+        joined = data.get("joined_at") or 0
+        if opts["after"] and joined < opts["after"]: continue
+        demos = dict(data.get("demos") or {})
+        active = [bid for bid, d in demos.items() if demo_expiry(d) > now]
+        if opts["active"] and not active: continue
+        if opts["batch"] and opts["batch"] not in active and opts["batch"] not in demos \
+                and opts["batch"] not in map(str, data.get("demo_history") or []): continue
+        yield (uid, data.get("name"), data.get("username"),
+               datetime.fromtimestamp(joined).isoformat(timespec="seconds") if joined else "", ";".join(active))
+
+def batch_rows(keys):
+    for cid in keys:
+        cname = DB["ALL_CHATS"].get(cid) or DB["FREE_CHANNELS"].get(cid) or DB["PAID_CHANNELS"].get(cid) or "Unknown"
+
+        b_type = "OTHER"
+        if cid in DB["FREE_CHANNELS"]: b_type = "FREE"
+        elif cid in DB["PAID_CHANNELS"]: b_type = "PAID"
+        elif cid == SUPPORT_GROUP_ID: b_type = "SUPPORT"
+        elif cid == MANDATORY_CHANNEL_ID: b_type = "MAIN"
+        elif cid == LOG_CHANNEL_ID: b_type = "LOG"
+        yield (b_type, cid, cname)
+
+EXPORT_USAGE = "Usage: /{cmd} [txt|csv|jsonl] [gz]"
+
+async def delete_progress(context, msg):
+    """Removes a "⏳ ..." progress message, also after a failed report."""
+    try: await context.bot.delete_message(msg.chat.id, msg.message_id)
+    except Exception: pass
 
 async def cmd_all_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != OWNER_ID: return
+    try: opts = parse_export_args(context.args)
+    except:
+        msg = await update.message.reply_text(EXPORT_USAGE.format(cmd="allusers") + " [after=YYYY-MM-DD] [active] [batch=ID]")
+        await schedule_delete(context, update.message)
+        await schedule_delete(context, msg)
+        return
     msg = await update.message.reply_text("⏳ Generating report...")
-    report = f"ALL USERS DUMP - {datetime.now()}\n" + "-" * 40 + "\nID | Name | Username\n"
-    for uid, data in DB["USER_DATA"].items():
-        report += f"{uid} | {data.get('name')} | @{data.get('username')}\n"
-    f = io.BytesIO(report.encode("utf-8"))
-    f.name = "all_users.txt"
-    await update.message.reply_document(document=f, caption="✅ All Users List")
-    await context.bot.delete_message(update.effective_chat.id, msg.message_id)
+    # Shallow snapshot on the loop; the worker thread never iterates the live dict
+    items = list(DB["USER_DATA"].items())
+    try:
+        await send_report(
+            update, "all_users", "✅ All Users List ({count})", user_rows(items, opts),
+            ("id", "name", "username", "joined_at", "active_demos"), opts,
+            header=f"ALL USERS DUMP - {datetime.now()}\n" + "-" * 40 + "\nID | Name | Username\n",
+            txt_row=lambda r: f"{r[0]} | {r[1]} | @{r[2]}")
+    finally:
+        await delete_progress(context, msg)
+        await schedule_delete(context, update.message)
+
+# --- 8c. BACKUPS ---
+# Backups copy DB under data_lock (freeze_db, as in save_data_async), then
+# restore, diff, compress and split the copy in a worker thread. A "delta" holds what changed since
+# the last full backup (per setting and per user), so a restore needs the
+# full backup plus only the newest delta (tools/restore_backup.py).
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BACKUP_INTERVAL = int(os.environ.get("BACKUP_INTERVAL", "0"))  # Seconds between scheduled backups (0 = off)
+BACKUP_FULL_EVERY = int(os.environ.get("BACKUP_FULL_EVERY", "24"))  # Every Nth scheduled backup is full
+BACKUP_DIR = os.environ.get("BACKUP_DIR", "")  # Scheduled target; unset = owner chat
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", "7"))  # Full backups (with their deltas) kept in BACKUP_DIR
+BACKUP_COMPRESSION = os.environ.get("BACKUP_COMPRESSION", "zstd" if zstandard else "gzip")
+BACKUP_CHUNK_BYTES = int(os.environ.get("BACKUP_CHUNK_BYTES", str(EXPORT_MAX_BYTES)))
+BACKUP_STATE = {"base": None, "fingerprints": None, "since_full": 0, "running": False}
+
+def compress_backup(raw):
+    if BACKUP_COMPRESSION == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=10).compress(raw), ".zst"
+    return gzip.compress(raw, 6), ".gz"
+
+def build_backup(frozen, full):
+    """Worker thread: returns (kind, file name, chunks, fingerprints, raw size) for a freeze_db() copy."""
+    data = thaw_snapshot(frozen)
+    prints = snapshot_fingerprints(data)
+    base = None if full else BACKUP_STATE["fingerprints"]
+    if base is None:
+        # Chunked like a save: one json.dumps of the whole DB would hold the GIL
+        kind, head = "full", json.dumps({"type": "full", "created": time.time()})
+        raw = f'{head[:-1]}, "data": {dumps_snapshot(data)}}}'.encode("utf-8")
+    else:
+        kind, raw = "delta", json.dumps({
+            "type": "delta", "base": BACKUP_STATE["base"], "created": time.time(),
+            "keys": {k: v for k, v in data.items() if k != "USER_DATA" and base["keys"].get(k) != prints["keys"][k]},
+            "users": {u: e for u, e in data["USER_DATA"].items() if base["users"].get(u) != prints["users"][u]},
+            "removed_users": [u for u in base["users"] if u not in prints["users"]],
+        }, separators=(",", ":")).encode("utf-8")
+    blob, ext = compress_backup(raw)
+    name = f"backup-{datetime.now():%Y%m%d-%H%M%S}-{kind}.json{ext}"
+    chunks = [blob[i:i + BACKUP_CHUNK_BYTES] for i in range(0, len(blob), BACKUP_CHUNK_BYTES)]
+    return kind, name, chunks, prints, len(raw)
+
+def chunk_names(name, chunks):
+    if len(chunks) == 1: return [name]
+    return [f"{name}.{i:03d}" for i in range(1, len(chunks) + 1)]
+
+def write_backup_files(name, chunks):
+    """Worker thread: writes a backup into BACKUP_DIR and applies retention."""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    for fname, chunk in zip(chunk_names(name, chunks), chunks):
+        tmp = os.path.join(BACKUP_DIR, fname + ".tmp")
+        with open(tmp, "wb") as f: f.write(chunk)
+        os.replace(tmp, os.path.join(BACKUP_DIR, fname))
+    # Names sort by time; keep the newest BACKUP_KEEP fulls and everything after the oldest kept one
+    files = sorted(f for f in os.listdir(BACKUP_DIR) if f.startswith("backup-") and not f.endswith(".tmp"))
+    fulls = sorted({f.split(".json")[0] for f in files if "-full.json" in f})
+    if len(fulls) > BACKUP_KEEP:
+        cutoff = fulls[-BACKUP_KEEP]
+        for f in files:
+            if f.split(".json")[0] < cutoff: os.remove(os.path.join(BACKUP_DIR, f))
+
+async def run_backup(bot, full=False, chat_id=None):
+    """
+    Creates one backup and sends it to chat_id, or to the scheduled target
+    (BACKUP_DIR, else the owner chat). Returns a summary line, or None if one is already running.
+    """
+    if BACKUP_STATE["running"]: return None
+    BACKUP_STATE["running"] = True
+    started = time.perf_counter()
+    try:
+        async with data_lock:
+            frozen = freeze_db()
+        kind, name, chunks, prints, raw_size = await asyncio.to_thread(build_backup, frozen, full)
+        to_dir = chat_id is None and BACKUP_DIR
+        if to_dir:
+            await asyncio.to_thread(write_backup_files, name, chunks)
+        else:
+            names = chunk_names(name, chunks)
+            for i, (fname, chunk) in enumerate(zip(names, chunks), 1):
+                caption = f"🗄 DB Backup ({kind}, part {i}/{len(chunks)})" if len(chunks) > 1 else f"🗄 DB Backup ({kind})"
+                await call_with_retry(bot.send_document, chat_id or OWNER_ID, document=chunk, filename=fname, caption=caption)
+        # Deltas are relative to the last full backup sent to the scheduled target
+        if kind == "full" and (to_dir or not BACKUP_DIR):
+            BACKUP_STATE.update(base=name, fingerprints=prints, since_full=0)
+        elif kind == "delta":
+            BACKUP_STATE["since_full"] += 1
+        size = sum(len(c) for c in chunks)
+        METRICS.inc("bot_backups_total", kind=kind)
+        METRICS.set("bot_backup_bytes", size, kind=kind)
+        METRICS.observe("bot_backup_seconds", time.perf_counter() - started)
+        return f"✅ {kind.title()} backup {name}: {raw_size // 1024} KB -> {size // 1024} KB in {len(chunks)} file(s)"
+    except Exception as e:
+        METRICS.inc("bot_backup_errors_total")
+        logger.error(f"Backup failed: {e}")
+        return f"❌ Backup failed: {e}"
+    finally:
+        BACKUP_STATE["running"] = False
+
+async def scheduled_backup(context: ContextTypes.DEFAULT_TYPE):
+    full = BACKUP_STATE["since_full"] + 1 >= BACKUP_FULL_EVERY
+    result = await run_backup(bulk_bot(context.bot), full=full)
+    if result: logger.info(result)
+
+async def _backup_and_report(bot, chat_id, full):
+    result = await run_backup(bot, full=full, chat_id=chat_id)
+    try: await bot.send_message(chat_id, result or "⚠️ A backup is already running.")
+    except: pass
+
+async def cmd_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/backup [full|delta] - compressed backup to this chat (full by default)."""
+    if update.effective_user.id != OWNER_ID: return
+    full = not (context.args and context.args[0].lower() == "delta")
+    context.application.create_task(_backup_and_report(bulk_bot(context.bot), update.effective_chat.id, full))
+    msg = await update.message.reply_text("⏳ Creating backup...")
+    await schedule_delete(context, msg)
     await schedule_delete(context, update.message)
 
 # --- 9. NEW MANAGEMENT COMMANDS ---
@@ -506,7 +2325,7 @@ async def cmd_batch_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Get total members from Telegram API
         try:
-            count = await context.bot.get_chat_member_count(cid)
+            count = await bulk_bot(context.bot).get_chat_member_count(cid)
         except:
             count = "N/A"
             
@@ -568,7 +2387,7 @@ async def cmd_extend_demo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             # Notify User
             try:
-                chat_info = await context.bot.get_chat(int(bid))
+                chat_info = await fetch_chat(context.bot, int(bid))
                 cname = chat_info.title
                 await context.bot.send_message(uid, f"🎁 **Demo Extended!**\nAdmin added {hours} hours to your access in **{cname}**.")
             except: pass
@@ -593,6 +2412,7 @@ async def cmd_kick_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         await context.bot.ban_chat_member(bid, uid)
         await context.bot.unban_chat_member(bid, uid) # Allow rejoin later
+        record_event("kick", bid)
         msg = await update.message.reply_text(f"✅ User {uid} kicked from {bid}.")
         
         # Also remove from Demo DB if exists
@@ -638,11 +2458,293 @@ async def cmd_myinfo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif update.message:
         await update.message.reply_text(txt, parse_mode=ParseMode.MARKDOWN)
 
+# --- 9b. TRENDS (ROLLUPS) ---
+# Event counts per batch, bucketed by hour and by day (UTC) and updated as the
+# events happen, so /trends never scans USER_DATA. Buckets are sparse
+# {period index: count} rings: periods older than ROLLUP_HOURS / ROLLUP_DAYS
+# are dropped when a new period starts. Saved with the next regular save.
+ROLLUP_EVENTS = {
+    "req": "Access requests", "demo": "Demos granted", "expired": "Demos expired",
+    "conv": "Demo → permanent", "free": "Free joins", "kick": "Kicks",
+}
+ROLLUP_HOURS = 168
+ROLLUP_DAYS = 90
+ROLLUP_HEAD = {}  # "h"/"d" -> newest period seen, to prune once per period
+
+def rollup_slot():
+    return DB["ROLLUPS"].setdefault(str(WORKER_INDEX), {"h": {}, "d": {}})
+
+def prune_rollups(res, oldest):
+    for slot in DB["ROLLUPS"].values():
+        for bid, events in list(slot.get(res, {}).items()):
+            for event, buckets in list(events.items()):
+                for period in [p for p in buckets if int(p) < oldest]: del buckets[period]
+                if not buckets: del events[event]
+            if not events: del slot[res][bid]
+
+def record_event(event, batch_id, n=1, now=None):
+    """Adds n to the hourly and daily buckets of one batch."""
+    now = time.time() if now is None else now
+    slot = rollup_slot()
+    for res, length, keep in (("h", 3600, ROLLUP_HOURS), ("d", 86400, ROLLUP_DAYS)):
+        period = int(now // length)
+        if period != ROLLUP_HEAD.get(res):
+            ROLLUP_HEAD[res] = period
+            prune_rollups(res, period - keep + 1)
+        buckets = slot[res].setdefault(str(batch_id), {}).setdefault(event, {})
+        buckets[str(period)] = buckets.get(str(period), 0) + n
+
+def rollup_series(res, periods, batch=None, now=None):
+    """{event: [count per period, oldest first]} summed over workers (and batches)."""
+    now = time.time() if now is None else now
+    last = int(now // (3600 if res == "h" else 86400))
+    series = {event: [0] * periods for event in ROLLUP_EVENTS}
+    for slot in DB["ROLLUPS"].values():
+        for bid, events in slot.get(res, {}).items():
+            if batch is not None and bid != str(batch): continue
+            for event, buckets in events.items():
+                if event not in series: continue
+                for period, count in buckets.items():
+                    i = int(period) - last + periods - 1
+                    if 0 <= i < periods: series[event][i] += count
+    return series
+
+def rollup_top(event, res, periods, top=5, now=None):
+    """Batches with the most `event`s in the last `periods`."""
+    now = time.time() if now is None else now
+    first = int(now // (3600 if res == "h" else 86400)) - periods + 1
+    totals = collections.Counter()
+    for slot in DB["ROLLUPS"].values():
+        for bid, events in slot.get(res, {}).items():
+            totals[bid] += sum(c for p, c in events.get(event, {}).items() if int(p) >= first)
+    return [(bid, n) for bid, n in totals.most_common(top) if n]
+
+def sparkline(values):
+    bars = "▁▂▃▄▅▆▇█"
+    peak = max(values) or 1
+    return "".join(bars[min(7, int(v / peak * 7.999))] if v else " " for v in values)
+
+async def cmd_trends(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/trends [batch_id] - event totals for 24h/7d/30d with daily and hourly sparklines."""
+    if not is_admin(update.effective_user.id): return
+    batch = None
+    if context.args:
+        try: batch = int(context.args[0])
+        except ValueError:
+            msg = await update.message.reply_text("Usage: /trends [batch_id]")
+            await schedule_delete(context, update.message)
+            await schedule_delete(context, msg)
+            return
+
+    hourly = rollup_series("h", 24, batch)
+    daily = rollup_series("d", 30, batch)
+    scope = f"{DB['ALL_CHATS'].get(batch, batch)}" if batch is not None else "All Batches"
+    lines = [f"📈 Trends - {scope}", "", f"{'':<17} {'24h':>6} {'7d':>6} {'30d':>6}"]
+    for event, label in ROLLUP_EVENTS.items():
+        d = daily[event]
+        lines.append(f"{label:<17} {sum(hourly[event]):>6} {sum(d[-7:]):>6} {sum(d):>6}")
+    lines += ["", "Last 14 days (daily):"]
+    for event in ("req", "demo", "conv", "free"):
+        lines.append(f"{ROLLUP_EVENTS[event]:<17} |{sparkline(daily[event][-14:])}|")
+    lines += ["", "Last 24 hours (hourly):"]
+    for event in ("req", "demo"):
+        lines.append(f"{ROLLUP_EVENTS[event]:<17} |{sparkline(hourly[event])}|")
+    reqs, demos = sum(daily["req"][-7:]), sum(daily["demo"][-7:])
+    if reqs or demos: lines.append("")
+    if reqs: lines.append(f"7d demo rate: {demos / reqs * 100:.0f}% of requests")
+    if demos: lines.append(f"7d conversion: {sum(daily['conv'][-7:]) / demos * 100:.0f}% of demos")
+    if batch is None:
+        top = rollup_top("req", "d", 7)
+        if top:
+            lines += ["", "Top batches by requests (7d):"]
+            lines += [f"  {n:>5}  {DB['ALL_CHATS'].get(int(bid), bid)}" for bid, n in top]
+    text = "\n".join(lines)
+    msg = await update.message.reply_text(f"```\n{text}\n```", parse_mode=ParseMode.MARKDOWN)
+    await schedule_delete(context, update.message)
+    await schedule_delete(context, msg)
+
 # --- 10. MANUAL APPROVAL SYSTEM (ROBUST) ---
 
+# Pending join requests for paid batches: {batch_id: {str(user_id): requested_at}}
+def add_pending(batch_id, user_id):
+    DB["PENDING_REQUESTS"].setdefault(batch_id, {})[str(user_id)] = time.time()
+
+def drop_pending(batch_id, user_id):
+    reqs = DB["PENDING_REQUESTS"].get(batch_id)
+    if reqs and reqs.pop(str(user_id), None) is not None and not reqs:
+        del DB["PENDING_REQUESTS"][batch_id]
+
+async def grant_access(bot, uid, batch_id, demo):
+    """
+    Approves a pending join request, as a DEMO_DURATION demo or permanently,
+    and updates DB (caller saves). Raises if Telegram rejects the approval.
+    """
+    await call_with_retry(bot.approve_chat_join_request, chat_id=batch_id, user_id=uid)
+    drop_pending(batch_id, uid)
+    data = DB["USER_DATA"].setdefault(uid, {"demos": {}})
+    if demo: record_event("demo", batch_id)
+    elif batch_id in data.get("demo_history", []): record_event("conv", batch_id)
+    if demo:
+        # START TIMER - New structure: expiry + warned flag
+        data.setdefault("demos", {})[str(batch_id)] = {"expiry": time.time() + DEMO_DURATION, "warned": False}
+        # UPDATE HISTORY
+        history = data.setdefault("demo_history", [])
+        if batch_id not in history: history.append(batch_id)
+    else:
+        # REMOVE TIMER IF EXISTS
+        data.get("demos", {}).pop(str(batch_id), None)
+
+async def notify_granted(bot, uid, batch_id, demo):
+    # Get accurate batch name
+    batch_name = DB["ALL_CHATS"].get(batch_id)
+    if not batch_name:
+        try:
+            c = await fetch_chat(bot, batch_id)
+            batch_name = c.title
+        except:
+            batch_name = "Premium Channel"
+
+    try:
+        # Custom Welcome
+        welcome_msg = DB["CUSTOM_WELCOMES"].get(batch_id, "")
+        if demo:
+            user_msg = (
+                f"✅ **Your request has been approved for {DEMO_HOURS}hrs!**\n"
+                f"Welcome to {batch_name}.\n"
+                f"You will be removed automatically after {DEMO_HOURS} hours."
+            )
+        else:
+            user_msg = (
+                f"✅ **Your request has been approved Permanent!**\n"
+                f"Welcome to {batch_name}.\n"
+                f"You have lifetime access."
+            )
+        if welcome_msg: user_msg += f"\n\n{welcome_msg}"
+        await PACER.wait(uid)
+        await call_with_retry(bot.send_message, uid, user_msg, parse_mode=ParseMode.MARKDOWN)
+    except: pass
+
+def parse_age(text):
+    """'90s', '30m', '2h', '1d' -> seconds."""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    return float(text[:-1]) * units[text[-1]] if text[-1] in units else float(text)
+
+def format_age(seconds):
+    if seconds < 3600: return f"{int(seconds // 60)}m"
+    if seconds < 86400: return f"{seconds / 3600:.1f}h"
+    return f"{seconds / 86400:.1f}d"
+
+def select_pending(batch=None, older=None, newer=None, limit=None):
+    """Pending (batch_id, user_id, requested_at), oldest first."""
+    now = time.time()
+    rows = [
+        (bid, int(uid), ts) for bid, reqs in DB["PENDING_REQUESTS"].items() if batch is None or bid == batch
+        for uid, ts in reqs.items()
+        if (older is None or now - ts >= older) and (newer is None or now - ts <= newer)
+    ]
+    rows.sort(key=lambda r: r[2])
+    return rows[:limit] if limit else rows
+
+# Errors meaning the request is gone; the entry is dropped instead of retried later
+STALE_REQUEST_ERRORS = ("hide_requester_missing", "user_already_participant", "user_not_found")
+BULK_APPROVAL = {"running": False}
+
+async def cmd_pending(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/pending [batch_id] - pending join requests per batch, or the oldest in one batch."""
+    if not is_admin(update.effective_user.id): return
+    now = time.time()
+    if context.args:
+        try: batch = int(context.args[0])
+        except ValueError:
+            msg = await update.message.reply_text("Usage: /pending [batch_id]")
+            await schedule_delete(context, update.message)
+            await schedule_delete(context, msg)
+            return
+        rows = select_pending(batch=batch)
+        text = f"⏳ **Pending in {DB['ALL_CHATS'].get(batch, batch)}:** {len(rows)}\n\n"
+        for _, uid, ts in rows[:50]:
+            name = DB["USER_DATA"].get(uid, {}).get("name") or "Unknown"
+            text += f"• `{uid}` {name} - {format_age(now - ts)}\n"
+        if len(rows) > 50: text += f"... and {len(rows) - 50} more\n"
+    else:
+        text = "⏳ **Pending Join Requests**\n\n"
+        for bid, reqs in DB["PENDING_REQUESTS"].items():
+            if not reqs: continue
+            oldest = now - min(reqs.values())
+            text += f"📂 {DB['ALL_CHATS'].get(bid, bid)} (`{bid}`): **{len(reqs)}**, oldest {format_age(oldest)}\n"
+        if not DB["PENDING_REQUESTS"]: text += "No pending requests."
+        else: text += "\nApprove: `/approveall demo|perm [batch=ID] [older=2h] [newer=1d] [limit=N]`"
+    msg = await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+    await schedule_delete(context, update.message)
+    await schedule_delete(context, msg)
+
+async def _bulk_approve(bot, chat_id, rows, demo):
+    started = time.perf_counter()
+    failures = collections.Counter()
+    approved = []
+
+    async def approve(row):
+        bid, uid, _ = row
+        try:
+            await PACER.wait(bid)
+            await grant_access(bot, uid, bid, demo)
+            approved.append((uid, bid))
+        except Exception as e:
+            reason = str(e)[:60]
+            failures[reason] += 1
+            if any(s in reason.lower() for s in STALE_REQUEST_ERRORS): drop_pending(bid, uid)
+
+    try:
+        await run_paced(rows, approve)
+        await save_data_async()
+        # Notifications go out after the state is saved; they do not block the summary
+        await run_paced(approved, lambda a: notify_granted(bot, a[0], a[1], demo))
+    finally:
+        BULK_APPROVAL["running"] = False
+    METRICS.inc("bot_bulk_approvals_total", len(approved), kind="demo" if demo else "perm")
+    text = (
+        f"✅ **Bulk Approval Done ({'DEMO' if demo else 'PERMANENT'})**\n"
+        f"Approved: {len(approved)} / {len(rows)}\n"
+        f"Time: {time.perf_counter() - started:.1f}s\n"
+    )
+    if failures:
+        text += "\n❌ **Failed:**\n" + "\n".join(f"• {n}× {reason}" for reason, n in failures.most_common(10))
+    try: await bot.send_message(chat_id, text, parse_mode=ParseMode.MARKDOWN)
+    except: await bot.send_message(chat_id, text)
+
+async def cmd_approve_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/approveall demo|perm [batch=ID] [older=2h] [newer=1d] [limit=N]"""
+    if not is_admin(update.effective_user.id): return
+    try:
+        kind = context.args[0].lower()
+        if kind not in ("demo", "perm"): raise ValueError
+        opts = dict(a.split("=", 1) for a in context.args[1:])
+        rows = select_pending(
+            batch=int(opts["batch"]) if "batch" in opts else None,
+            older=parse_age(opts["older"]) if "older" in opts else None,
+            newer=parse_age(opts["newer"]) if "newer" in opts else None,
+            limit=int(opts["limit"]) if "limit" in opts else None,
+        )
+    except (IndexError, ValueError, KeyError):
+        msg = await update.message.reply_text("Usage: `/approveall demo|perm [batch=ID] [older=2h] [newer=1d] [limit=N]`", parse_mode=ParseMode.MARKDOWN)
+        await schedule_delete(context, update.message)
+        await schedule_delete(context, msg)
+        return
+
+    if BULK_APPROVAL["running"]:
+        msg = await update.message.reply_text("⚠️ A bulk approval is already running.")
+    elif not rows:
+        msg = await update.message.reply_text("No pending requests match.")
+    else:
+        BULK_APPROVAL["running"] = True
+        context.application.create_task(_bulk_approve(bulk_bot(context.bot), update.effective_chat.id, rows, kind == "demo"))
+        msg = await update.message.reply_text(f"⏳ Approving {len(rows)} requests ({kind})...")
+    await schedule_delete(context, update.message)
+    await schedule_delete(context, msg)
+
 async def cmd_approve_demo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Approves a user for a 3-HOUR DEMO based on the Invite Link provided.
+    Approves a user for a DEMO_DURATION (3-hour) demo based on the Invite Link provided.
     Usage: /demo <invite_link> (Can be sent anywhere if bot is Admin)
     """
     # ADMIN CHECK - allows Owner OR Added Admins
@@ -666,8 +2768,9 @@ async def cmd_approve_demo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await msg.reply_text("Usage: `/demo <invite_link>`")
         return
 
-    # 2. Lookup Link Map
+    # 2. Lookup Link Map (another worker may have created it moments ago)
     link_data = DB["LINK_MAP"].get(link)
+    if link_data is None and await refresh_shared_state(): link_data = DB["LINK_MAP"].get(link)
     
     # Fallback to old behavior (Topic Based) if link not in map
     target_uid = None
@@ -681,9 +2784,7 @@ async def cmd_approve_demo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # OLD STRUCTURE (Migration fallback)
         batch_id = link_data
         # Try finding user via Topic if available
-        if msg.message_thread_id:
-            for u, t in DB["USER_TOPICS"].items():
-                if t == msg.message_thread_id: target_uid = int(u); break
+        if msg.message_thread_id: target_uid = topic_owner(msg.message_thread_id)
     else:
         await msg.reply_text("❌ Link not found in database. Ensure it was generated by this bot.")
         return
@@ -700,47 +2801,14 @@ async def cmd_approve_demo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # 4. APPROVE
     try:
-        await context.bot.approve_chat_join_request(chat_id=batch_id, user_id=target_uid)
-        
-        # START TIMER
-        expiry = time.time() + (3 * 3600)
-        
-        if "demos" not in DB["USER_DATA"][target_uid]: DB["USER_DATA"][target_uid]["demos"] = {}
-        # New structure: expiry + warned flag
-        DB["USER_DATA"][target_uid]["demos"][str(batch_id)] = {"expiry": expiry, "warned": False}
-        
-        # UPDATE HISTORY
-        if "demo_history" not in DB["USER_DATA"][target_uid]: DB["USER_DATA"][target_uid]["demo_history"] = []
-        if batch_id not in DB["USER_DATA"][target_uid]["demo_history"]:
-            DB["USER_DATA"][target_uid]["demo_history"].append(batch_id)
-        
+        await grant_access(context.bot, target_uid, batch_id, demo=True)
         await save_data_async()
         
         # Admin Confirmation
-        await msg.reply_text(f"✅ **APPROVED (DEMO)**\nUser `{target_uid}` added to Batch `{batch_id}` for 3 Hours.")
+        await msg.reply_text(f"✅ **APPROVED (DEMO)**\nUser `{target_uid}` added to Batch `{batch_id}` for {DEMO_HOURS} Hours.")
         
         # User Notification
-        # Get accurate batch name
-        batch_name = DB["ALL_CHATS"].get(batch_id)
-        if not batch_name:
-             try:
-                 c = await context.bot.get_chat(batch_id)
-                 batch_name = c.title
-             except:
-                 batch_name = "Premium Channel"
-
-        try: 
-            # Custom Welcome
-            welcome_msg = DB["CUSTOM_WELCOMES"].get(batch_id, "")
-            user_msg = (
-                f"✅ **Your request has been approved for 3hrs!**\n"
-                f"Welcome to {batch_name}.\n"
-                f"You will be removed automatically after 3 hours."
-            )
-            if welcome_msg: user_msg += f"\n\n{welcome_msg}"
-            
-            await context.bot.send_message(target_uid, user_msg, parse_mode=ParseMode.MARKDOWN)
-        except: pass
+        await notify_granted(context.bot, target_uid, batch_id, demo=True)
 
     except Exception as e:
         await msg.reply_text(f"❌ **Approval Error:** {e}\n(Tip: Ensure User has clicked 'Join' and is pending approval.)")
@@ -767,8 +2835,9 @@ async def cmd_approve_perm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await msg.reply_text("Usage: `/per <invite_link>`")
         return
 
-    # 2. Lookup Link Map
+    # 2. Lookup Link Map (another worker may have created it moments ago)
     link_data = DB["LINK_MAP"].get(link)
+    if link_data is None and await refresh_shared_state(): link_data = DB["LINK_MAP"].get(link)
     
     target_uid = None
     batch_id = None
@@ -778,9 +2847,7 @@ async def cmd_approve_perm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         batch_id = link_data.get("b")
     elif link_data and isinstance(link_data, int):
         batch_id = link_data
-        if msg.message_thread_id:
-            for u, t in DB["USER_TOPICS"].items():
-                if t == msg.message_thread_id: target_uid = int(u); break
+        if msg.message_thread_id: target_uid = topic_owner(msg.message_thread_id)
     else:
         await msg.reply_text("❌ Link not found in database.")
         return
@@ -791,37 +2858,14 @@ async def cmd_approve_perm(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # 3. APPROVE
     try:
-        await context.bot.approve_chat_join_request(chat_id=batch_id, user_id=target_uid)
-        
-        # REMOVE TIMER IF EXISTS
-        if "demos" in DB["USER_DATA"][target_uid] and str(batch_id) in DB["USER_DATA"][target_uid]["demos"]:
-            del DB["USER_DATA"][target_uid]["demos"][str(batch_id)]
-            await save_data_async()
+        await grant_access(context.bot, target_uid, batch_id, demo=False)
+        await save_data_async()
             
         # Admin Confirmation
         await msg.reply_text(f"✅ **APPROVED (PERMANENT)**\nUser `{target_uid}` added to Batch `{batch_id}` permanently.")
         
         # User Notification
-        batch_name = DB["ALL_CHATS"].get(batch_id)
-        if not batch_name:
-             try:
-                 c = await context.bot.get_chat(batch_id)
-                 batch_name = c.title
-             except:
-                 batch_name = "Premium Channel"
-
-        try: 
-            # Custom Welcome
-            welcome_msg = DB["CUSTOM_WELCOMES"].get(batch_id, "")
-            user_msg = (
-                f"✅ **Your request has been approved Permanent!**\n"
-                f"Welcome to {batch_name}.\n"
-                f"You have lifetime access."
-            )
-            if welcome_msg: user_msg += f"\n\n{welcome_msg}"
-            
-            await context.bot.send_message(target_uid, user_msg, parse_mode=ParseMode.MARKDOWN)
-        except: pass
+        await notify_granted(context.bot, target_uid, batch_id, demo=False)
 
     except Exception as e:
         await msg.reply_text(f"❌ **Approval Error:** {e}\n(Tip: Ensure User has clicked 'Join'.)")
@@ -865,7 +2909,7 @@ async def cmd_user_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
         elif cid == LOG_CHANNEL_ID: b_type = "LOG"
         
         try:
-            m = await context.bot.get_chat_member(cid, target_id)
+            m = await fetch_member(bulk_bot(context.bot), cid, target_id)
             # FIX 2: Filter to ONLY show Joined/Admin status
             if m.status in [ChatMember.MEMBER, ChatMember.ADMINISTRATOR, ChatMember.OWNER, ChatMember.RESTRICTED]:
                 report += f"[{b_type}] {cname}: {m.status.upper()} ✅\n"
@@ -892,41 +2936,33 @@ async def cmd_user_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # /batches (NEW COMMAND)
 async def cmd_batches(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id): return
-    
+    try: opts = parse_export_args(context.args, filters=False)
+    except:
+        msg = await update.message.reply_text(EXPORT_USAGE.format(cmd="batches"))
+        await schedule_delete(context, update.message)
+        await schedule_delete(context, msg)
+        return
+
     msg = await update.message.reply_text("⏳ Compiling list of ALL connected batches...")
     
-    report = f"ALL CONNECTED BATCHES REPORT - {datetime.now()}\n"
-    report += "This list includes every group/channel the bot knows about.\n"
-    report += "=" * 60 + "\n"
-    report += f"{'TYPE':<10} | {'ID':<15} | {'NAME'}\n"
-    report += "-" * 60 + "\n"
+    header = f"ALL CONNECTED BATCHES REPORT - {datetime.now()}\n"
+    header += "This list includes every group/channel the bot knows about.\n"
+    header += "=" * 60 + "\n"
+    header += f"{'TYPE':<10} | {'ID':<15} | {'NAME'}\n"
+    header += "-" * 60 + "\n"
     
     # Use ALL_CHATS as the source of truth for "connected" chats
     all_keys = set(list(DB["ALL_CHATS"].keys()) + list(DB["FREE_CHANNELS"].keys()) + list(DB["PAID_CHANNELS"].keys()))
     
-    count = 0
-    for cid in all_keys:
-        cname = DB["ALL_CHATS"].get(cid) or DB["FREE_CHANNELS"].get(cid) or DB["PAID_CHANNELS"].get(cid) or "Unknown"
-        
-        b_type = "OTHER"
-        if cid in DB["FREE_CHANNELS"]: b_type = "FREE"
-        elif cid in DB["PAID_CHANNELS"]: b_type = "PAID"
-        elif cid == SUPPORT_GROUP_ID: b_type = "SUPPORT"
-        elif cid == MANDATORY_CHANNEL_ID: b_type = "MAIN"
-        elif cid == LOG_CHANNEL_ID: b_type = "LOG"
-        
-        report += f"{b_type:<10} | {cid:<15} | {cname}\n"
-        count += 1
-        
-    report += "=" * 60 + "\n"
-    report += f"Total Connected Batches: {count}"
-    
-    f = io.BytesIO(report.encode("utf-8"))
-    f.name = "all_batches_list.txt"
-    
-    await update.message.reply_document(document=f, caption=f"✅ Found {count} connected batches/chats.")
-    await context.bot.delete_message(update.effective_chat.id, msg.message_id)
-    await schedule_delete(context, update.message)
+    try:
+        await send_report(
+            update, "all_batches_list", "✅ Found {count} connected batches/chats.", batch_rows(all_keys),
+            ("type", "id", "name"), opts, header=header,
+            txt_row=lambda r: f"{r[0]:<10} | {r[1]:<15} | {r[2]}",
+            footer=lambda count: "=" * 60 + f"\nTotal Connected Batches: {count}")
+    finally:
+        await delete_progress(context, msg)
+        await schedule_delete(context, update.message)
 
 # /stats (Admin)
 async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -961,6 +2997,7 @@ async def cmd_delbatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
         d = DB["FREE_CHANNELS"] if t == "free" else DB["PAID_CHANNELS"]
         if cid in d: 
             del d[cid]
+            invalidate_batch_menus()
             await save_data_async()
             msg = await update.message.reply_text("✅ Batch Deleted")
         else: msg = await update.message.reply_text("❌ Batch ID not found in that category.")
@@ -1015,7 +3052,7 @@ async def wizard_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             cid = int(txt)
             try:
-                chat_obj = await context.bot.get_chat(cid)
+                chat_obj = await fetch_chat(context.bot, cid)
                 batch_name = chat_obj.title or f"Batch {cid}"
             except Exception:
                 await update.message.reply_text("❌ **Error:** Could not fetch Channel.\nEnsure Bot is Admin there first!", parse_mode=ParseMode.MARKDOWN)
@@ -1025,6 +3062,7 @@ async def wizard_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             target[cid] = batch_name
             # Also add to ALL_CHATS
             DB["ALL_CHATS"][cid] = batch_name
+            invalidate_batch_menus()
             await save_data_async()
             
             msg = await update.message.reply_text(f"✅ **Batch Added!**\n\n📛 Name: {batch_name}\n🆔 ID: `{cid}`", parse_mode=ParseMode.MARKDOWN)
@@ -1040,6 +3078,11 @@ async def wizard_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id): return
+    if BROADCAST_STATE.get(update.effective_user.id, {}).get("step") == "sending":
+        msg = await update.message.reply_text("⚠️ A broadcast/post is still sending. Stop it first or wait.")
+        await schedule_delete(context, update.message)
+        await schedule_delete(context, msg)
+        return
     BROADCAST_STATE[update.effective_user.id] = {"type": "broadcast", "step": "wait_msg"}
     msg = await update.message.reply_text("📢 **Broadcast Mode**\nSend the message (Text/Photo/Video) to send to ALL users.\nType /cancel to stop.")
     await schedule_delete(context, update.message)
@@ -1047,6 +3090,11 @@ async def cmd_broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def cmd_post_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id): return
+    if BROADCAST_STATE.get(update.effective_user.id, {}).get("step") == "sending":
+        msg = await update.message.reply_text("⚠️ A broadcast/post is still sending. Stop it first or wait.")
+        await schedule_delete(context, update.message)
+        await schedule_delete(context, msg)
+        return
     BROADCAST_STATE[update.effective_user.id] = {"type": "post", "step": "wait_msg"}
     msg = await update.message.reply_text("📝 **Post Mode**\nSend the message (Text/Photo/Video) to post to ALL Batches.\nType /cancel to stop.")
     await schedule_delete(context, update.message)
@@ -1068,6 +3116,33 @@ async def handle_broadcast_flow(update: Update, context: ContextTypes.DEFAULT_TY
         return True
     return False
 
+async def _run_broadcast(bot, uid, state):
+    """Background send loop for a confirmed broadcast/post; stops when the state is cancelled or replaced."""
+    msg_obj = state["content"]
+    count = 0
+    if state["type"] == "broadcast":
+        targets, pause = list(DB["USER_DATA"].keys()), 0.05
+    else:
+        # Post to ALL known chats (Free + Paid + Others)
+        targets, pause = list(DB["FREE_CHANNELS"].keys()) + list(DB["PAID_CHANNELS"].keys()), 0.5
+    try:
+        for target_id in targets:
+            if BROADCAST_STATE.get(uid) is not state: break  # Cancelled
+            try:
+                # UPDATED: Use copy_message for broadcast to handle media
+                await bot.copy_message(target_id, uid, msg_obj.message_id)
+                count += 1
+                await asyncio.sleep(pause)
+            except: pass
+        stopped = BROADCAST_STATE.get(uid) is not state
+        if state["type"] == "broadcast":
+            text = f"{'🛑 **Broadcast Stopped**' if stopped else '✅ **Broadcast Done**'}\nSent: {count}"
+        else:
+            text = f"{'🛑 **Posting Stopped**' if stopped else '✅ **Posting Done**'}\nPosted in {count} channels."
+        await bot.send_message(uid, text)
+    finally:
+        if BROADCAST_STATE.get(uid) is state: del BROADCAST_STATE[uid]
+
 async def broadcast_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     uid = q.from_user.id
@@ -1076,37 +3151,19 @@ async def broadcast_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     state = BROADCAST_STATE[uid]
     
     if data == "bc_no":
-        del BROADCAST_STATE[uid]
-        await q.edit_message_text("❌ Action Cancelled")
+        del BROADCAST_STATE[uid]  # A running send loop sees this and stops
+        await q.answer()
+        await q.edit_message_text("🛑 Stopping..." if state["step"] == "sending" else "❌ Action Cancelled")
         return
         
     if data == "bc_yes":
-        await q.edit_message_text("⏳ Processing...")
-        msg_obj = state["content"]
-        count = 0
-        
-        if state["type"] == "broadcast":
-            for target_id in list(DB["USER_DATA"].keys()):
-                try:
-                    # UPDATED: Use copy_message for broadcast to handle media
-                    await context.bot.copy_message(target_id, uid, msg_obj.message_id)
-                    count += 1
-                    await asyncio.sleep(0.05)
-                except: pass
-            await context.bot.send_message(uid, f"✅ **Broadcast Done**\nSent: {count}")
-
-        elif state["type"] == "post":
-            # Post to ALL known chats (Free + Paid + Others)
-            targets = list(DB["FREE_CHANNELS"].keys()) + list(DB["PAID_CHANNELS"].keys())
-            for cid in targets:
-                try:
-                    await context.bot.copy_message(cid, uid, msg_obj.message_id)
-                    count += 1
-                    await asyncio.sleep(0.5)
-                except: pass
-            await context.bot.send_message(uid, f"✅ **Posting Done**\nPosted in {count} channels.")
-            
-        del BROADCAST_STATE[uid]
+        if state["step"] != "confirm": await q.answer("⏳ Already sending..."); return
+        state["step"] = "sending"
+        await q.answer()
+        # Runs outside this handler so the admin's other updates are not queued behind it
+        context.application.create_task(_run_broadcast(bulk_bot(context.bot), uid, state))
+        kb = [[InlineKeyboardButton("🛑 Stop", callback_data="bc_no")]]
+        await q.edit_message_text("⏳ Processing...", reply_markup=InlineKeyboardMarkup(kb))
 
 # --- 14. SYNC & MESSAGE HANDLER ---
 
@@ -1131,6 +3188,168 @@ async def handle_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try: await context.bot.edit_message_caption(tc, tm, caption=txt)
             except: pass
 
+# Albums: messages sharing a media_group_id arrive as separate updates.
+# They are buffered for ALBUM_WINDOW seconds and relayed with one copy_messages call.
+ALBUM_WINDOW = float(os.environ.get("ALBUM_WINDOW", "1.0"))
+ALBUMS = {}  # (from_chat_id, media_group_id) -> {"ids": [...], "deadline": t, "flush": fn(ids)}
+
+async def copy_batch(bot, to_chat, from_chat, message_ids, thread_id=None):
+    """Copies one message or a whole album. Returns the new message ids."""
+    if len(message_ids) == 1:
+        sent = await bot.copy_message(to_chat, from_chat, message_ids[0], message_thread_id=thread_id)
+        return [sent.message_id]
+    sent = await bot.copy_messages(to_chat, from_chat, message_ids, message_thread_id=thread_id)
+    return [m.message_id for m in sent]
+
+def map_messages(src_chat, src_ids, dst_chat, dst_ids):
+    for src, dst in zip(src_ids, dst_ids):
+        MESSAGE_MAP[(src_chat, src)] = (dst_chat, dst)
+        MESSAGE_MAP[(dst_chat, dst)] = (src_chat, src)
+
+def buffer_album(key, message_id, flush):
+    entry = ALBUMS.get(key)
+    if entry is None:
+        entry = ALBUMS[key] = {"ids": [], "deadline": 0.0, "flush": flush}
+        task = asyncio.create_task(_album_timer(key))
+        BACKGROUND_TASKS.add(task)
+        task.add_done_callback(BACKGROUND_TASKS.discard)
+    entry["ids"].append(message_id)
+    entry["deadline"] = asyncio.get_running_loop().time() + ALBUM_WINDOW
+
+async def _album_timer(key):
+    loop = asyncio.get_running_loop()
+    while key in ALBUMS:
+        delay = ALBUMS[key]["deadline"] - loop.time()
+        if delay <= 0: break
+        await asyncio.sleep(delay)
+    await flush_album(key)
+
+async def flush_album(key):
+    entry = ALBUMS.pop(key, None)
+    if not entry: return
+    METRICS.inc("bot_albums_relayed_total")
+    try: await entry["flush"](sorted(entry["ids"]))
+    except Exception as e: logger.error(f"Album relay failed: {e}")
+
+async def flush_albums_from(chat_id):
+    """Relays pending albums of a chat first, so a later message can't overtake them."""
+    for key in [k for k in ALBUMS if k[0] == chat_id]:
+        await flush_album(key)
+
+async def relay_to_topic(context, user, chat_id, message_ids, text=None):
+    """
+    User -> Admin: copies messages into the user's support topic.
+    With `text`, the messages were coalesced and are sent as one message.
+    """
+    async def send(topic_id):
+        if text is None:
+            return await call_with_retry(copy_batch, context.bot, SUPPORT_GROUP_ID, chat_id, message_ids, topic_id)
+        sent = await call_with_retry(context.bot.send_message, SUPPORT_GROUP_ID, text, message_thread_id=topic_id)
+        return [sent.message_id] * len(message_ids)
+
+    # Safe Topic Retrieval
+    topic_id = await get_or_create_topic(user, context)
+    if not topic_id: return
+    try:
+        sent = await send(topic_id)
+    except Exception as e:
+        # Retry if topic seems gone
+        if "thread not found" not in str(e).lower(): return
+        if user.id in DB["USER_TOPICS"]: del DB["USER_TOPICS"][user.id]
+        topic_id = await get_or_create_topic(user, context)
+        if not topic_id: return
+        try: sent = await send(topic_id)
+        except: return
+    # Coalesced: every source maps to the combined message, which maps back to the last one
+    map_messages(chat_id, message_ids, SUPPORT_GROUP_ID, sent)
+
+# Inbound relay queue: private messages are queued per user and forwarded in
+# order by a paced sender instead of being dropped by the 1.5 s spam gate.
+# Only a sustained rate above RELAY_RATE_PER_MIN (after a RELAY_BURST) is dropped.
+RELAY_PACE = float(os.environ.get("RELAY_PACE", "0.3"))
+RELAY_COALESCE = os.environ.get("RELAY_COALESCE", "0") == "1"
+RELAY_COALESCE_WINDOW = float(os.environ.get("RELAY_COALESCE_WINDOW", "1.5"))
+RELAY_RATE_PER_MIN = float(os.environ.get("RELAY_RATE_PER_MIN", "30"))
+RELAY_BURST = float(os.environ.get("RELAY_BURST", "15"))
+RELAY_QUEUES = {}  # uid -> {"items": deque, "last": t, "context": ctx, "user": User}
+RELAY_BUCKETS = {}  # uid -> [tokens, last refill]
+RELAY_NOTICES = {}  # uid -> last "slow down" notice
+MAX_TEXT = 4096
+
+def relay_allowed(uid):
+    """Token bucket: RELAY_BURST messages at once, refilled at RELAY_RATE_PER_MIN."""
+    now = time.monotonic()
+    tokens, last = RELAY_BUCKETS.get(uid, (RELAY_BURST, now))
+    tokens = min(RELAY_BURST, tokens + (now - last) * RELAY_RATE_PER_MIN / 60)
+    allowed = tokens >= 1
+    RELAY_BUCKETS[uid] = (tokens - 1 if allowed else tokens, now)
+    return allowed
+
+async def enqueue_relay(context, user, chat_id, item):
+    """Queues ("copy", ids) or ("text", id, text) for the user's paced sender."""
+    if not relay_allowed(user.id):
+        METRICS.inc("bot_relay_dropped_total")
+        now = time.time()
+        if now - RELAY_NOTICES.get(user.id, 0) > 60:
+            RELAY_NOTICES[user.id] = now
+            try: await context.bot.send_message(chat_id, "⚠️ You are sending messages too fast. Some were not delivered - please slow down.")
+            except: pass
+        return
+    q = RELAY_QUEUES.get(user.id)
+    if q is None:
+        q = RELAY_QUEUES[user.id] = {"items": collections.deque()}
+        task = asyncio.create_task(_relay_worker(user.id))
+        BACKGROUND_TASKS.add(task)
+        task.add_done_callback(BACKGROUND_TASKS.discard)
+    q.update(context=context, user=user, chat_id=chat_id, last=asyncio.get_running_loop().time())
+    q["items"].append(item)
+    METRICS.set("bot_relay_queued", sum(len(v["items"]) for v in RELAY_QUEUES.values()))
+
+async def _relay_worker(uid):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            q = RELAY_QUEUES[uid]
+            items = q["items"]
+            if not items: break
+            if RELAY_COALESCE and items[0][0] == "text":
+                # Let a burst of short texts finish arriving before sending
+                wait = q["last"] + RELAY_COALESCE_WINDOW - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(min(wait, RELAY_COALESCE_WINDOW))
+                    continue
+                ids, parts = [], []
+                while items and items[0][0] == "text" and sum(len(p) + 2 for p in parts) + len(items[0][2]) <= MAX_TEXT:
+                    _, mid, text = items.popleft()
+                    ids.append(mid)
+                    parts.append(text)
+                if len(ids) > 1:
+                    METRICS.inc("bot_relay_coalesced_total", len(ids) - 1)
+                    await relay_to_topic(q["context"], q["user"], q["chat_id"], ids, "\n\n".join(parts))
+                else:
+                    await relay_to_topic(q["context"], q["user"], q["chat_id"], ids)
+            else:
+                item = items.popleft()
+                ids = item[1] if item[0] == "copy" else [item[1]]
+                await relay_to_topic(q["context"], q["user"], q["chat_id"], ids)
+            METRICS.inc("bot_relay_sent_total")
+            await asyncio.sleep(RELAY_PACE)
+    except Exception as e:
+        logger.error(f"Relay worker for {uid} failed: {e}")
+    finally:
+        RELAY_QUEUES.pop(uid, None)
+
+async def relay_to_user(context, topic_id, message_ids):
+    """Admin -> User: copies topic messages to the ticket owner."""
+    target_uid = topic_owner(topic_id)
+    if not target_uid: return
+    try:
+        sent = await copy_batch(context.bot, target_uid, SUPPORT_GROUP_ID, message_ids)
+        map_messages(SUPPORT_GROUP_ID, message_ids, target_uid, sent)
+    except Forbidden:
+        await context.bot.send_message(SUPPORT_GROUP_ID, "❌ User has blocked the bot.", message_thread_id=topic_id)
+    except: pass
+
 async def main_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     chat = update.effective_chat
@@ -1146,53 +3365,34 @@ async def main_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     
     # NEW: BLOCK CHECK
     if user.id in DB["BLOCKED_USERS"]: return
-    
-    # FEATURE 5: Anti-Spam Check
-    if check_spam(user.id): return
+
+    msg = update.message
+    album_key = (chat.id, msg.media_group_id) if msg and msg.media_group_id else None
 
     if await wizard_message(update, context): return
     if await handle_broadcast_flow(update, context): return
 
-    # User -> Admin
+    # User -> Admin (queued per user; see enqueue_relay for rate limiting)
     if chat.type == ChatType.PRIVATE:
-        if user.id in DB["BLOCKED_USERS"]: return
-        
-        # Safe Topic Retrieval
-        topic_id = await get_or_create_topic(user, context)
-        if topic_id:
-            try:
-                sent = await context.bot.copy_message(SUPPORT_GROUP_ID, chat.id, update.message.id, message_thread_id=topic_id)
-                MESSAGE_MAP[(chat.id, update.message.id)] = (SUPPORT_GROUP_ID, sent.message_id)
-                MESSAGE_MAP[(SUPPORT_GROUP_ID, sent.message_id)] = (chat.id, update.message.id)
-            except Exception as e:
-                # Retry if topic seems gone
-                if "thread not found" in str(e).lower():
-                    if user.id in DB["USER_TOPICS"]: del DB["USER_TOPICS"][user.id]
-                    topic_id = await get_or_create_topic(user, context)
-                    if topic_id:
-                        try:
-                            sent = await context.bot.copy_message(SUPPORT_GROUP_ID, chat.id, update.message.id, message_thread_id=topic_id)
-                            MESSAGE_MAP[(chat.id, update.message.id)] = (SUPPORT_GROUP_ID, sent.message_id)
-                            MESSAGE_MAP[(SUPPORT_GROUP_ID, sent.message_id)] = (chat.id, update.message.id)
-                        except: pass
+        if album_key:
+            buffer_album(album_key, msg.message_id, lambda ids: enqueue_relay(context, user, chat.id, ("copy", ids)))
+            return
+        await flush_albums_from(chat.id)
+        if msg.text and not msg.media_group_id:
+            await enqueue_relay(context, user, chat.id, ("text", msg.message_id, msg.text))
+        else:
+            await enqueue_relay(context, user, chat.id, ("copy", [msg.message_id]))
 
     # Admin -> User
-    elif chat.id == SUPPORT_GROUP_ID and update.message.message_thread_id:
-        if update.message.from_user.id == context.bot.id: return 
-        
-        topic_id = update.message.message_thread_id
-        target_uid = None
-        for u, t in DB["USER_TOPICS"].items():
-            if t == topic_id: target_uid = int(u); break
+    elif chat.id == SUPPORT_GROUP_ID and msg.message_thread_id:
+        if msg.from_user.id == context.bot.id: return 
         
-        if target_uid:
-            try:
-                sent = await context.bot.copy_message(target_uid, chat.id, update.message.id)
-                MESSAGE_MAP[(SUPPORT_GROUP_ID, update.message.id)] = (target_uid, sent.message_id)
-                MESSAGE_MAP[(target_uid, sent.message_id)] = (SUPPORT_GROUP_ID, update.message.id)
-            except Forbidden:
-                await context.bot.send_message(SUPPORT_GROUP_ID, "❌ User has blocked the bot.", message_thread_id=topic_id)
-            except: pass
+        topic_id = msg.message_thread_id
+        if album_key:
+            buffer_album(album_key, msg.message_id, lambda ids: relay_to_user(context, topic_id, ids))
+            return
+        await flush_albums_from(chat.id)
+        await relay_to_user(context, topic_id, [msg.message_id])
 
 # --- 15. JOIN & DEMO LOGIC (MODIFIED) ---
 
@@ -1215,6 +3415,9 @@ async def handle_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE
         if await check_membership(user.id, context):
             try:
                 await context.bot.approve_chat_join_request(chat.id, user.id)
+                note_free_member(user.id, chat.id, True)
+                record_event("free", chat.id)
+                mark_dirty()
                 
                 # FEATURE 3: Custom Welcome for Free Batch
                 w_msg = DB["CUSTOM_WELCOMES"].get(chat.id, f"✅ **Approved!**\nWelcome to {chat.title}")
@@ -1227,6 +3430,9 @@ async def handle_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE
             except: pass
     elif chat.id in DB["PAID_CHANNELS"]:
         # MANUAL APPROVAL FLOW
+        # 0. Queue it for /pending and /approveall
+        add_pending(chat.id, user.id)
+        mark_dirty()
         # 1. Revoke the link so no one else can use it (Simulates Single-Use)
         # Note: Pending Request REMAINS VALID even if link is revoked.
         if req.invite_link:
@@ -1238,97 +3444,317 @@ async def handle_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE
                 except Exception as e:
                     logger.error(f"Failed to revoke link: {e}")
 
+# Auto-kick: leaving the Mandatory Channel removes the user from every free
+# batch listed for them in DB["FREE_MEMBERS"] (kept up to date from join
+# approvals and chat_member updates), after a grace period to allow a rejoin.
+# Memberships from before the record existed are found when the kick runs:
+# free batches not listed for the user are checked with getChatMember.
+# Leave times are kept in DB["LEFT_MANDATORY"] and the leader scans them, so
+# pending kicks survive redeploys and work whichever worker saw the leave.
+AUTO_KICK_GRACE = float(os.environ.get("AUTO_KICK_GRACE", "300"))  # seconds; negative disables auto-kick
+AUTO_KICK_SCAN = max(1.0, min(60.0, AUTO_KICK_GRACE))  # seconds between scans for expired grace periods
+AUTO_KICK_IN_FLIGHT = set()  # (user_id, chat_id) removals in progress
+
+def is_member_status(member):
+    return member.status in [ChatMember.MEMBER, ChatMember.ADMINISTRATOR, ChatMember.OWNER] or (
+        member.status == ChatMember.RESTRICTED and getattr(member, "is_member", False)
+    )
+
+def note_free_member(user_id, chat_id, joined):
+    """Updates the free-batch membership record. Returns True if it changed (caller saves)."""
+    chats = DB["FREE_MEMBERS"].get(user_id, [])
+    if joined == (chat_id in chats): return False
+    if joined:
+        DB["FREE_MEMBERS"][user_id] = chats + [chat_id]
+    else:
+        chats = [c for c in chats if c != chat_id]
+        if chats: DB["FREE_MEMBERS"][user_id] = chats
+        else: DB["FREE_MEMBERS"].pop(user_id, None)
+    return True
+
 async def on_join_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # This function logs when a user actually joins.
-    # Logic for starting timers is now moved to cmd_approve_demo.
-    pass
+    """
+    chat_member updates: keeps the free-batch membership record and starts
+    (or cancels, on rejoin) the auto-kick when a user leaves the Mandatory Channel.
+    """
+    cmu = update.chat_member
+    if not cmu: return
+    chat_id, user = cmu.chat.id, cmu.new_chat_member.user
+    was, now = is_member_status(cmu.old_chat_member), is_member_status(cmu.new_chat_member)
+    if was == now or user.is_bot: return
+
+    if chat_id in DB["FREE_CHANNELS"]:
+        if note_free_member(user.id, chat_id, now): mark_dirty()
+        return
+
+    if chat_id != MANDATORY_CHANNEL_ID or AUTO_KICK_GRACE < 0 or is_admin(user.id): return
+    left = DB["LEFT_MANDATORY"]
+    if now:
+        if left.pop(user.id, None) is not None:
+            mark_dirty()
+            METRICS.inc("bot_auto_kicks_total", result="rejoined")
+            logger.info(f"User {user.id} rejoined the Mandatory Channel; auto-kick cancelled")
+    elif user.id not in left:
+        # Dedupe: repeated leave events keep the first leave time
+        left[user.id] = time.time()
+        mark_dirty()
+        logger.info(f"User {user.id} left the Mandatory Channel; auto-kick in {AUTO_KICK_GRACE:.0f}s")
+
+async def kick_from_free(bot, user_id, chat_id):
+    """Removes the user from one free batch (ban + unban so they can come back). Returns True on success."""
+    key = (user_id, chat_id)
+    if key in AUTO_KICK_IN_FLIGHT: return False
+    AUTO_KICK_IN_FLIGHT.add(key)
+    try:
+        await PACER.wait(chat_id)
+        await call_with_retry(bot.ban_chat_member, chat_id, user_id)
+        await call_with_retry(bot.unban_chat_member, chat_id, user_id)
+        note_free_member(user_id, chat_id, False)
+        record_event("kick", chat_id)
+        return True
+    except Exception as e:
+        METRICS.inc("bot_auto_kicks_total", result="failed")
+        logger.error(f"Auto-kick of {user_id} from {chat_id} failed: {e}")
+        return False
+    finally:
+        AUTO_KICK_IN_FLIGHT.discard(key)
+
+async def auto_kick_scan(context: ContextTypes.DEFAULT_TYPE):
+    """Job (leader): auto-kicks every user whose grace period after leaving the Mandatory Channel is over."""
+    cutoff = time.time() - AUTO_KICK_GRACE
+    due = [uid for uid, left_at in DB["LEFT_MANDATORY"].items() if left_at <= cutoff]
+    if not due: return
+    # Taken off the list first, so an overlapping scan cannot start the same kick
+    due = [(uid, DB["LEFT_MANDATORY"].pop(uid)) for uid in due]
+    mark_dirty()
+    await run_paced(due, lambda item: auto_kick(context.bot, *item))
+
+async def in_free_batch(bot, user_id, chat_id):
+    await PACER.wait(chat_id)
+    return is_member_status(await call_with_retry(bot.get_chat_member, chat_id, user_id))
+
+async def auto_kick(bot, user_id, left_at):
+    """Removes a user who left the Mandatory Channel from all free batches they are in."""
+    # Re-check: a rejoin may have been missed, and an API error must not kick anyone
+    try:
+        if is_member_status(await bot.get_chat_member(MANDATORY_CHANNEL_ID, user_id)): return
+    except Exception as e:
+        # Back on the list (unless a new leave/rejoin came in), so the next scan retries
+        if DB["LEFT_MANDATORY"].setdefault(user_id, left_at) == left_at: mark_dirty()
+        logger.warning(f"Auto-kick of {user_id} postponed, membership check failed: {e}")
+        return
+
+    chats = [c for c in DB["FREE_MEMBERS"].get(user_id, []) if c in DB["FREE_CHANNELS"]]
+    # Batches not in the record (joined before it was kept, or the update was missed)
+    unknown = [c for c in DB["FREE_CHANNELS"] if c not in chats]
+    found = await run_paced(unknown, lambda cid: in_free_batch(bulk_bot(bot), user_id, cid))
+    chats += [c for c, r in zip(unknown, found) if r is True]
+    DB["FREE_MEMBERS"][user_id] = chats  # drop deleted batches, add found ones
+    results = await run_paced(chats, lambda cid: kick_from_free(bulk_bot(bot), user_id, cid))
+    kicked = sum(r is True for r in results)
+    if not DB["FREE_MEMBERS"].get(user_id): DB["FREE_MEMBERS"].pop(user_id, None)
+    mark_dirty()
+
+    METRICS.inc("bot_auto_kicks_total", kicked, result="kicked")
+    logger.info(f"Auto-kick: removed {user_id} from {kicked}/{len(chats)} free batches")
+    if kicked:
+        try:
+            await PACER.wait(user_id)
+            await call_with_retry(
+                bot.send_message, user_id,
+                f"⚠️ **Removed from {kicked} free batch(es).**\nYou left the Main Channel. Join again to get access back:\n{MANDATORY_CHANNEL_LINK}",
+                parse_mode=ParseMode.MARKDOWN
+            )
+        except Exception: pass
+
+# Demo entries currently being expired; guards against overlapping runs
+EXPIRY_IN_FLIGHT = set()
+METRICS.buckets["bot_demo_kick_latency_seconds"] = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+def demo_expiry(d_data):
+    """Expiry timestamp of a demo entry (dict or legacy float)."""
+    return d_data["expiry"] if isinstance(d_data, dict) else float(d_data)
+
+async def expire_demo(bot, user_id, bid, expiry):
+    """
+    Kicks one expired demo user. Idempotent: skipped if the entry is already
+    being processed or was changed meanwhile (/per, /extend), and only the
+    exact entry that expired is removed afterwards.
+    Returns True if the DB entry was removed.
+    """
+    key = (user_id, bid)
+    if key in EXPIRY_IN_FLIGHT: return False
+    EXPIRY_IN_FLIGHT.add(key)
+    try:
+        demos = DB["USER_DATA"].get(user_id, {}).get("demos", {})
+        if bid not in demos or demo_expiry(demos[bid]) != expiry: return False
+
+        chat_id = int(bid)
+        logger.info(f"⏳ Processing Demo Expiry: User {user_id} in Batch {chat_id}")
+        try:
+            # 1. Kick (ban + unban to allow rejoin later)
+            await PACER.wait(chat_id)
+            await call_with_retry(bot.ban_chat_member, chat_id, user_id)
+            await call_with_retry(bot.unban_chat_member, chat_id, user_id)
+            METRICS.observe("bot_demo_kick_latency_seconds", time.time() - expiry)
+            record_event("expired", chat_id)
+            logger.info(f"✅ User {user_id} kicked from {chat_id}")
+
+            # 2. Send Notification
+            try:
+                await PACER.wait(user_id)
+                await call_with_retry(bot.send_message, user_id, "⏰ **Demo Ended.**\nHope you enjoyed! Contact Admin for permanent access.")
+            except Exception:
+                pass
+
+        except Exception as e:
+            METRICS.inc("bot_demo_kick_failures_total")
+            logger.error(f"❌ KICK FAILED for {user_id} in {chat_id}: {e}")
+            # Notify Admin Channel if configured
+            if LOG_CHANNEL_ID:
+                try:
+                    err_msg = (
+                        f"⚠️ **DEMO KICK FAILED**\n"
+                        f"👤 User: `{user_id}`\n"
+                        f"🆔 Batch: `{chat_id}`\n"
+                        f"❓ Reason: `{e}`\n"
+                        f"ℹ️ *Make sure Bot is Admin with Ban rights!*"
+                    )
+                    await PACER.wait(LOG_CHANNEL_ID)
+                    await call_with_retry(bot.send_message, LOG_CHANNEL_ID, err_msg, parse_mode=ParseMode.MARKDOWN)
+                except: pass
+
+        # 3. Remove from database (only if nobody changed it meanwhile)
+        demos = DB["USER_DATA"].get(user_id, {}).get("demos", {})
+        if bid in demos and demo_expiry(demos[bid]) == expiry:
+            del demos[bid]
+            return True
+        return False
+    finally:
+        EXPIRY_IN_FLIGHT.discard(key)
+
+async def send_demo_reminder(bot, user_id, bid, expiry):
+    """30-minute reminder. Returns True if the entry was marked as warned."""
+    try:
+        batch_name = DB["ALL_CHATS"].get(int(bid), "Batch")
+        await PACER.wait(user_id)
+        await call_with_retry(
+            bot.send_message,
+            user_id, 
+            f"⏳ **Reminder:** Your demo for **{batch_name}** expires in less than 30 minutes!"
+        )
+    except Exception:
+        return False
+    demos = DB["USER_DATA"].get(user_id, {}).get("demos", {})
+    if bid in demos and isinstance(demos[bid], dict) and demos[bid]["expiry"] == expiry:
+        demos[bid]["warned"] = True
+        return True
+    return False
 
 async def check_demos(context: ContextTypes.DEFAULT_TYPE):
+    """Job (leader): one check_demos run, with the heartbeat /healthz watches."""
+    HEALTH["check_demos_running"] = True
+    HEALTH["check_demos_heartbeat"] = time.time()
+    try: await _check_demos(context)
+    finally: HEALTH["check_demos_running"] = False
+
+def _demo_heartbeat(job):
+    """Wraps a run_paced job so every finished kick/reminder counts as progress."""
+    async def run(item):
+        try: return await job(item)
+        finally: HEALTH["check_demos_heartbeat"] = time.time()
+    return run
+
+async def _check_demos(context: ContextTypes.DEFAULT_TYPE):
     """
-    Checks for expired demos every 60 seconds.
-    Updated to log errors and alert admins on failure.
+    Checks for expired demos every DEMO_CHECK_INTERVAL seconds.
+    The scan is synchronous; kicks and reminders then run through the
+    paced worker pool so an expiry wave is cleared within one run.
     """
+    started = time.perf_counter()
     now = time.time()
     mod = False
+    expired, reminders = [], []
     
     # Use list() to avoid runtime error if dictionary changes size during iteration
     for uid, data in list(DB["USER_DATA"].items()):
         if "demos" not in data or not data["demos"]: 
             continue
         
-        # Create a copy of the demos dict to iterate while modifying the original
-        demos_copy = data["demos"].copy()
-        
-        for bid, d_data in demos_copy.items():
+        for bid, d_data in list(data["demos"].items()):
             # NEW: Handle migration from float to dict
-            if isinstance(d_data, dict): 
-                expiry = d_data["expiry"]
-                warned = d_data.get("warned", False)
-            else: 
-                expiry = float(d_data)
-                warned = False
-                data["demos"][bid] = {"expiry": expiry, "warned": False}
+            if not isinstance(d_data, dict): 
+                d_data = data["demos"][bid] = {"expiry": float(d_data), "warned": False}
                 mod = True
 
-            chat_id = int(bid)
-            user_id = int(uid)
-            
+            expiry = d_data["expiry"]
             # 1. CHECK EXPIRY
             if now > expiry:
-                logger.info(f"⏳ Processing Demo Expiry: User {user_id} in Batch {chat_id}")
-                
-                try:
-                    # 1. Attempt to Ban (Kick)
-                    await context.bot.ban_chat_member(chat_id, user_id)
-                    logger.info(f"✅ User {user_id} kicked from {chat_id}")
-                    
-                    # 2. Attempt to Unban (Allow rejoin)
-                    await context.bot.unban_chat_member(chat_id, user_id)
-                    
-                    # 3. Send Notification
-                    try:
-                        await context.bot.send_message(user_id, "⏰ **Demo Ended.**\nHope you enjoyed! Contact Admin for permanent access.")
-                    except Exception:
-                        pass 
-                        
-                except Exception as e:
-                    logger.error(f"❌ KICK FAILED for {user_id} in {chat_id}: {e}")
-                    # Notify Admin Channel if configured
-                    if LOG_CHANNEL_ID:
-                        try:
-                            err_msg = (
-                                f"⚠️ **DEMO KICK FAILED**\n"
-                                f"👤 User: `{user_id}`\n"
-                                f"🆔 Batch: `{chat_id}`\n"
-                                f"❓ Reason: `{e}`\n"
-                                f"ℹ️ *Make sure Bot is Admin with Ban rights!*"
-                            )
-                            await context.bot.send_message(LOG_CHANNEL_ID, err_msg, parse_mode=ParseMode.MARKDOWN)
-                        except: pass
-                
-                # 4. Remove from database
-                if bid in data["demos"]:
-                    del data["demos"][bid]
-                    mod = True
-            
+                expired.append((int(uid), bid, expiry))
             # 2. FEATURE 1: AUTO-EXPIRY REMINDER (30 Mins)
-            elif (expiry - now) <= 1800 and not warned:
-                try:
-                    batch_name = DB["ALL_CHATS"].get(chat_id, "Batch")
-                    await context.bot.send_message(
-                        user_id, 
-                        f"⏳ **Reminder:** Your demo for **{batch_name}** expires in less than 30 minutes!"
-                    )
-                    # Mark as warned
-                    data["demos"][bid]["warned"] = True
-                    mod = True
-                except: pass
+            elif (expiry - now) <= 1800 and not d_data.get("warned", False):
+                reminders.append((int(uid), bid, expiry))
+
+    if expired or reminders:
+        results = await run_paced(
+            [(expire_demo, item) for item in expired] + [(send_demo_reminder, item) for item in reminders],
+            _demo_heartbeat(lambda job: job[0](bulk_bot(context.bot), *job[1])),
+        )
+        mod = mod or any(r is True for r in results)
+        for r in results:
+            if isinstance(r, Exception): logger.error(f"Demo worker error: {r}")
 
     if mod: 
         await save_data_async()
 
+    METRICS.observe("bot_check_demos_seconds", time.perf_counter() - started)
+    HEALTH["last_check_demos"] = time.time()
+    METRICS.inc("bot_demos_expired_total", len(expired))
+    METRICS.inc("bot_demo_reminders_total", len(reminders))
+    if expired:
+        logger.info(f"check_demos: {len(expired)} expired, {len(reminders)} reminders in {time.perf_counter() - started:.1f}s")
+
 # --- 16. USER UI (UPDATED) ---
 
+# Batch menus are built once per category and paginated; rebuilt only after
+# batches are added/deleted (invalidate_batch_menus) or reloaded from another worker.
+BATCH_PAGE_SIZE = int(os.environ.get("BATCH_PAGE_SIZE", "10"))
+
+def invalidate_batch_menus():
+    BATCH_MENUS.clear()
+
+STATE_RELOAD_HOOKS.append(invalidate_batch_menus)
+
+def build_batch_menu(kind):
+    if kind == "free":
+        batches, title, icon, action = DB["FREE_CHANNELS"], "📂 **Free Batches", "🔗", "get_f_"
+    else:
+        batches, title, icon, action = DB["PAID_CHANNELS"], "💎 **Premium Batches", "💎", "view_p_"
+    # Sorted by name, so each page covers a letter range
+    items = sorted(batches.items(), key=lambda kv: str(kv[1]).casefold())
+    chunks = [items[i:i + BATCH_PAGE_SIZE] for i in range(0, len(items), BATCH_PAGE_SIZE)]
+    pages = []
+    for n, chunk in enumerate(chunks):
+        kb = [[InlineKeyboardButton(f"{icon} {name}", callback_data=f"{action}{cid}")] for cid, name in chunk]
+        text = f"{title}:**"
+        if len(chunks) > 1:
+            first, last = str(chunk[0][1])[:1].upper(), str(chunk[-1][1])[:1].upper()
+            text = f"{title} ({first}–{last}):**" if first != last else f"{title} ({first}):**"
+            nav = []
+            if n > 0: nav.append(InlineKeyboardButton("⬅️", callback_data=f"u_{kind}_p{n - 1}"))
+            nav.append(InlineKeyboardButton(f"📄 {n + 1}/{len(chunks)}", callback_data="u_page"))
+            if n < len(chunks) - 1: nav.append(InlineKeyboardButton("➡️", callback_data=f"u_{kind}_p{n + 1}"))
+            kb.append(nav)
+        kb.append([InlineKeyboardButton("🔙 Back", callback_data="u_main")])
+        pages.append((text, InlineKeyboardMarkup(kb)))
+    return pages
+
+def batch_menu_pages(kind):
+    if kind not in BATCH_MENUS:
+        BATCH_MENUS[kind] = build_batch_menu(kind)
+        METRICS.inc("bot_batch_menu_builds_total", kind=kind)
+    return BATCH_MENUS[kind]
+
 async def general_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     uid = q.from_user.id
@@ -1351,16 +3777,18 @@ async def general_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await show_user_menu(update)
         else: await q.answer("❌ Join Main Channel First!", show_alert=True)
     elif data == "u_main": await show_user_menu(update)
-    elif data == "u_free":
-        if not DB["FREE_CHANNELS"]: await q.answer("Empty", show_alert=True); return
-        kb = [[InlineKeyboardButton(f"🔗 {n}", callback_data=f"get_f_{i}")] for i, n in DB["FREE_CHANNELS"].items()]
-        kb.append([InlineKeyboardButton("🔙 Back", callback_data="u_main")])
-        await q.edit_message_text("📂 **Free Batches:**", reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN)
-    elif data == "u_paid":
-        if not DB["PAID_CHANNELS"]: await q.answer("Empty", show_alert=True); return
-        kb = [[InlineKeyboardButton(f"💎 {n}", callback_data=f"view_p_{i}")] for i, n in DB["PAID_CHANNELS"].items()]
-        kb.append([InlineKeyboardButton("🔙 Back", callback_data="u_main")])
-        await q.edit_message_text("💎 **Premium Batches:**", reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN)
+    elif data.startswith(("u_free", "u_paid")):
+        # "u_free" / "u_paid" open page 0, "u_free_p3" opens page 3
+        kind, _, page = data[2:].partition("_p")
+        pages = batch_menu_pages(kind)
+        if not pages: await q.answer("Empty", show_alert=True); return
+        try: n = max(0, int(page or 0))
+        except ValueError:
+            n = 0  # Malformed/stale callback data
+            await q.answer()
+        text, markup = pages[min(n, len(pages) - 1)]
+        await q.edit_message_text(text, reply_markup=markup, parse_mode=ParseMode.MARKDOWN)
+    elif data == "u_page": await q.answer()
     elif data == "my_info":
         await cmd_myinfo(update, context)
         return
@@ -1372,7 +3800,7 @@ async def general_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await q.answer("⚠️ Already Joined!", show_alert=True) 
             return
         try:
-            l = await context.bot.create_chat_invite_link(cid, creates_join_request=True, name=f"Free-{uid}")
+            l = await create_invite_link(context.bot, cid, uid, "free", name=f"Free-{uid}")
             await context.bot.send_message(uid, f"🔗 **Link:**\n{l.invite_link}\n\nℹ️ *Request auto-approved.*")
             await q.answer("Sent to DM")
         except: await q.answer("Bot Error", show_alert=True)
@@ -1403,15 +3831,15 @@ async def general_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.answer("🔄 Generating Link...")
         try:
             # Create link: NO member limit (Telegram constraint with join request)
-            l = await context.bot.create_chat_invite_link(
-                cid, 
-                creates_join_request=True, 
+            l = await create_invite_link(
+                context.bot, cid, uid, "paid",
                 name=f"Req-{uid}-{int(time.time())}" # Add timestamp to ensure unique
             )
             
             # STORE LINK IN DB with METADATA
             # NEW: Stores User ID and Batch ID in Link Map directly
             DB["LINK_MAP"][l.invite_link] = {"u": uid, "b": cid}
+            record_event("req", cid)
             await save_data_async()
             
             # Fetch Batch Name for Display
@@ -1478,10 +3906,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user.id == OWNER_ID:
         await update.message.reply_text(
             f"👑 **WELCOME BOSS!**\n"
-            f"**⚙️ Owner:** `/addadmin`, `/deladmin`, `/backup`, `/allusers`\n"
+            f"**⚙️ Owner:** `/addadmin`, `/deladmin`, `/backup`, `/allusers`, `/profile`, `/memprofile`\n"
             f"**🛠 Manage:** `/find`, `/ban`, `/unban`, `/kick`, `/extend`\n"
-            f"**✅ Approve:** `/demo <link>`, `/per <link>`\n"
-            f"**📊 Tools:** `/stats`, `/batchstats`\n"
+            f"**✅ Approve:** `/demo <link>`, `/per <link>`, `/pending`, `/approveall`\n"
+            f"**📊 Tools:** `/stats`, `/batchstats`, `/trends`\n"
             f"**📢 Broadcast:** `/broadcast`, `/post`, `/setwelcome`",
             parse_mode=ParseMode.MARKDOWN
         )
@@ -1490,8 +3918,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(
             f"👮‍♂️ **WELCOME ADMIN!**\n"
             f"**🛠 Manage:** `/find`, `/ban`, `/unban`, `/kick`, `/extend`\n"
-            f"**✅ Approve:** `/demo <link>`, `/per <link>`\n"
-            f"**📊 Tools:** `/stats`, `/batchstats`\n"
+            f"**✅ Approve:** `/demo <link>`, `/per <link>`, `/pending`, `/approveall`\n"
+            f"**📊 Tools:** `/stats`, `/batchstats`, `/trends`\n"
             f"**📢 Broadcast:** `/broadcast`, `/post`, `/setwelcome`",
             parse_mode=ParseMode.MARKDOWN
         )
@@ -1503,10 +3931,26 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
               [InlineKeyboardButton("✅ Verified", callback_data="verify")]]
         await update.message.reply_text("⚠️ **Join Main Channel First**", reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN)
 
-def main():
-    load_data()
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+def build_app():
+    """Builds the Application with all handlers and jobs (also used by tools/replay.py)."""
+    global APP, BULK_BOT
+    builder = (
+        ApplicationBuilder().token(TELEGRAM_BOT_TOKEN)
+        .request(make_request("interactive"))
+        .get_updates_request(make_request("updates"))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if UPDATE_PROCESSOR is not None: builder = builder.concurrent_updates(UPDATE_PROCESSOR)
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+    app = builder.build()
+    APP = app
+    base_url = f"{TELEGRAM_API_BASE_URL}/bot" if TELEGRAM_API_BASE_URL else "https://api.telegram.org/bot"
+    BULK_BOT = ExtBot(TELEGRAM_BOT_TOKEN, base_url=base_url, request=make_request("bulk"))
     
+    app.add_handler(TypeHandler(Update, mark_update_received), group=-1)
+    if RECORDER is not None: app.add_handler(TypeHandler(Update, record_update), group=-2)
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("id", cmd_id))
     app.add_handler(MessageHandler(filters.Regex(r"^/id(@\w+)?$") & filters.ChatType.CHANNEL, cmd_id))
@@ -1515,6 +3959,8 @@ def main():
     app.add_handler(CommandHandler("deladmin", cmd_del_admin))
     app.add_handler(CommandHandler("backup", cmd_backup))
     app.add_handler(CommandHandler("allusers", cmd_all_users))
+    app.add_handler(CommandHandler("profile", cmd_profile))
+    app.add_handler(CommandHandler("memprofile", cmd_memprofile))
     
     # User Mgmt
     app.add_handler(CommandHandler("ban", cmd_ban))
@@ -1531,8 +3977,11 @@ def main():
     # Approval
     app.add_handler(CommandHandler("demo", cmd_approve_demo))
     app.add_handler(CommandHandler("per", cmd_approve_perm))
+    app.add_handler(CommandHandler("pending", cmd_pending))
+    app.add_handler(CommandHandler("approveall", cmd_approve_all))
     
     app.add_handler(CommandHandler("stats", cmd_stats))
+    app.add_handler(CommandHandler("trends", cmd_trends))
     app.add_handler(CommandHandler("user", cmd_user_details))
     app.add_handler(CommandHandler("batches", cmd_batches))
     app.add_handler(CommandHandler("addbatch", cmd_addbatch_start))
@@ -1548,11 +3997,34 @@ def main():
     app.add_handler(MessageReactionHandler(handle_reaction))
     app.add_handler(MessageHandler(filters.UpdateType.EDITED_MESSAGE, handle_edit))
     app.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, main_message_handler))
+    instrument_app(app)
     
-    if app.job_queue: app.job_queue.run_repeating(check_demos, interval=60, first=10)
+    if app.job_queue:
+        app.job_queue.run_repeating(leader_only(check_demos), interval=DEMO_CHECK_INTERVAL, first=10)
+        app.job_queue.run_repeating(flush_deletes, interval=DELETE_BUCKET_SECONDS, first=DELETE_BUCKET_SECONDS)
+        app.job_queue.run_repeating(flush_saves, interval=SAVE_INTERVAL, first=SAVE_INTERVAL)
+        if AUTO_KICK_GRACE >= 0:
+            app.job_queue.run_repeating(leader_only(auto_kick_scan), interval=AUTO_KICK_SCAN, first=AUTO_KICK_SCAN)
+        if MEMORY_LOG_INTERVAL > 0:
+            app.job_queue.run_repeating(log_memory, interval=MEMORY_LOG_INTERVAL, first=60)
+        if BACKUP_INTERVAL > 0:
+            app.job_queue.run_repeating(leader_only(scheduled_backup), interval=BACKUP_INTERVAL, first=BACKUP_INTERVAL)
+        if LEASE is not None:
+            app.job_queue.run_repeating(renew_lease, interval=LEASE_TTL / 3, first=0)
+            app.job_queue.run_repeating(sync_shared_state, interval=STATE_SYNC_INTERVAL, first=STATE_SYNC_INTERVAL)
+    return app
+
+def main():
+    if WORKER_COUNT > 1 and not WEBHOOK_MODE:
+        raise SystemExit("WORKER_COUNT > 1 requires UPDATE_MODE=webhook (getUpdates allows only one consumer).")
+    if WORKER_COUNT > 1 and not os.environ.get("WEBHOOK_SECRET"):
+        raise SystemExit("WORKER_COUNT > 1 requires WEBHOOK_SECRET (the same on every worker, or updates are rejected).")
+    load_data()
+    app = build_app()
     
     print("Bot v13.1 Enhanced Started...")
-    app.run_polling()
+    if WEBHOOK_MODE: asyncio.run(run_webhook(app))
+    else: app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()
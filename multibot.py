@@ -0,0 +1,169 @@
+"""
+Hosts several copies of the bot (one per community) in one process and one event loop.
+
+Each bot is a separate instance of bot.py, loaded under its own module name
+with its own environment, so DB, MESSAGE_MAP, jobs and settings stay isolated.
+The HTTP connection pools to the Bot API and the health/webhook server on
+PORT are shared. bots.json:
+
+    {
+      "shared": {"MONGO_URL": "mongodb+srv://...", "UPDATE_MODE": "polling"},
+      "bots": {
+        "physics": {"TELEGRAM_BOT_TOKEN": "123:abc", "OWNER_ID": "111", "SUPPORT_GROUP_ID": "-100..."},
+        "chemistry": {"TELEGRAM_BOT_TOKEN": "456:def", "OWNER_ID": "222", "SUPPORT_GROUP_ID": "-100..."}
+      }
+    }
+
+    python multibot.py bots.json
+
+Every bot gets namespaced storage unless set explicitly: DATA_FILE
+bot_data_<name>.json, MONGO_COLLECTION bot_settings_<name>, BACKUP_DIR
+backups/<name>, webhook path /<name>/webhook. The shared server answers
+/healthz for all bots and /<name>/healthz, /<name>/metrics per bot.
+WORKER_COUNT is always 1 here.
+"""
+import asyncio
+import contextlib
+import importlib.util
+import json
+import logging
+import os
+import re
+import signal
+import sys
+
+import httpx
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+logger = logging.getLogger("multibot")
+
+
+@contextlib.contextmanager
+def patched_environ(values):
+    """os.environ is exactly `values` inside the block (bot.py reads its settings at import)."""
+    saved = dict(os.environ)
+    os.environ.clear()
+    os.environ.update(values)
+    try: yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+def tenant_env(name, shared, own, first):
+    env = {**os.environ, **shared, **own}
+    defaults = {
+        "DATA_FILE": f"bot_data_{name}.json",
+        "MONGO_COLLECTION": f"bot_settings_{name}",
+        "BACKUP_DIR": os.path.join("backups", name),
+        "WEBHOOK_PATH": f"/{name}/webhook",
+        # One stall watchdog samples the shared loop for everyone
+        "STALL_THRESHOLD": env.get("STALL_THRESHOLD", "1") if first else "0",
+    }
+    for key, value in defaults.items():
+        if key not in own: env[key] = value
+    if env.get("RECORD_UPDATES") and "RECORD_UPDATES" not in own:
+        root, ext = os.path.splitext(env["RECORD_UPDATES"])
+        env["RECORD_UPDATES"] = f"{root}-{name}{ext}"
+    env.update(PORT="0", WORKER_COUNT="1", WORKER_INDEX="0")
+    return {k: str(v) for k, v in env.items()}
+
+
+def load_tenant(name, env):
+    """Imports a fresh copy of bot.py as module bot_<name>."""
+    spec = importlib.util.spec_from_file_location(f"bot_{name}", os.path.join(ROOT, "bot.py"))
+    module = importlib.util.module_from_spec(spec)
+    with patched_environ(env):
+        spec.loader.exec_module(module)
+    sys.modules[spec.name] = module
+    return module
+
+
+def shared_clients(bots):
+    """
+    One client per bot.py HTTP pool (interactive, bulk, and getUpdates with one
+    long-poll connection per bot), shared by all bots.
+    """
+    timeout = httpx.Timeout(connect=5.0, read=5.0, write=5.0, pool=1.0)
+    sizes = {
+        "interactive": int(os.environ.get("SHARED_POOL_SIZE", "256")),
+        "bulk": int(os.environ.get("SHARED_BULK_POOL_SIZE", "32")),
+        "updates": bots + 1,
+    }
+    return {pool: httpx.AsyncClient(timeout=timeout, limits=httpx.Limits(max_connections=n, max_keepalive_connections=n))
+            for pool, n in sizes.items()}
+
+
+class Host:
+    def __init__(self, tenants):
+        self.tenants = tenants  # name -> bot module
+        self.apps = {}
+
+    async def route(self, method, path, headers, body):
+        """Shared health server: /healthz for all bots, /<name>/... for one bot."""
+        if method == "GET" and path == "/":
+            return 200, "text/plain", f"Bot Host Running - {len(self.apps)}/{len(self.tenants)} bots"
+        if method == "GET" and path in ("/health", "/healthz"):
+            reports = {name: self.tenants[name].health_report() for name in self.apps}
+            ok = reports and all(r["status"] == "ok" for r in reports.values()) and len(reports) == len(self.tenants)
+            body = {"status": "ok" if ok else "unhealthy", "bots": reports,
+                    "not_running": sorted(set(self.tenants) - set(self.apps))}
+            return (200 if ok else 503), "application/json", json.dumps(body)
+        name, _, rest = path.lstrip("/").partition("/")
+        module = self.tenants.get(name) if name in self.apps else None
+        if module is None: return 404, "text/plain", "Not Found"
+        return await module.handle_http(method, path if path == module.WEBHOOK_PATH else "/" + rest, headers, body)
+
+    async def serve(self, port, clients):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try: loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError: pass
+
+        first = next(iter(self.tenants.values()))
+        server = first.HealthServer(port, self.route)
+        await server.start()
+        try:
+            for name, module in self.tenants.items():
+                app = module.build_app()
+                try:
+                    await module.start_app(app)
+                    self.apps[name] = app
+                    logger.info(f"Bot {name} started")
+                except Exception as e:
+                    # One bad token must not take the other communities down
+                    logger.error(f"Bot {name} failed to start: {e}")
+                    with contextlib.suppress(Exception): await module.stop_app(app)
+            await stop.wait()
+        finally:
+            for name, app in self.apps.items():
+                try: await self.tenants[name].stop_app(app)
+                except Exception as e: logger.error(f"Bot {name} did not stop cleanly: {e}")
+            for client in clients.values(): await client.aclose()
+            await server.stop()
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else os.environ.get("BOTS_CONFIG", "bots.json")
+    with open(path) as f: config = json.load(f)
+    shared, bots = config.get("shared", {}), config.get("bots", {})
+    if not bots: raise SystemExit(f"No bots configured in {path}")
+    for name in bots:
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", name): raise SystemExit(f"Invalid bot name: {name!r}")
+
+    tenants = {}
+    for i, (name, own) in enumerate(bots.items()):
+        module = load_tenant(name, tenant_env(name, shared, own, first=i == 0))
+        module.load_data()
+        tenants[name] = module
+    clients = shared_clients(len(tenants))
+    for module in tenants.values(): module.SHARED_HTTP.update(clients)
+
+    port = int(shared.get("PORT", os.environ.get("PORT", "8080")))
+    print(f"Bot host started with {len(tenants)} bots...")
+    asyncio.run(Host(tenants).serve(port, clients))
+
+
+if __name__ == "__main__":
+    main()
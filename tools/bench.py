@@ -0,0 +1,209 @@
+"""
+Benchmark suite for bot.py.
+
+Generates a synthetic database (tools/synthdb.py), runs the hot paths against
+an in-process stub bot (tools/stubbot.py) and prints machine-readable JSON:
+
+    python tools/bench.py --users 50000 --demos 5000 -o bench.json
+    python tools/bench.py --compare bench.json      # exit 1 on regressions
+
+Each benchmark reports min/median/mean/max seconds over --repeat runs and the
+Bot API calls made by one run. Setup (DB reset) is excluded from the timings.
+"""
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+OWNER_ID = 42
+SUPPORT_GROUP_ID = -1009999999999
+
+import synthdb  # noqa: E402
+from stubbot import StubBot, make_context, make_update  # noqa: E402
+
+
+def import_bot(data_file):
+    """Imports bot.py configured for an isolated, unpaced local run."""
+    os.environ.update({
+        "OWNER_ID": str(OWNER_ID),
+        "SUPPORT_GROUP_ID": str(SUPPORT_GROUP_ID),
+        "DATA_FILE": data_file,
+        "UPDATE_MODE": "polling",
+        "WORKER_COUNT": "1",
+        "CHAT_PACE_SECONDS": "0",
+        "RELAY_PACE": "0",
+        "RELAY_BURST": "1000000000",
+    })
+    os.environ.pop("MONGO_URL", None)
+    import bot
+    logging.disable(logging.CRITICAL)
+    return bot
+
+
+class Suite:
+    def __init__(self, bot, base_db, args):
+        self.bot = bot
+        self.base_db = base_db
+        self.args = args
+        self.stub = StubBot(latency=args.latency)
+        self.results = {}
+
+    def reset_db(self, users=None):
+        db = copy.deepcopy(self.base_db)
+        if users is not None:
+            db["USER_DATA"] = dict(list(db["USER_DATA"].items())[:users])
+        self.bot.DB.update(db)
+        self.bot.DB["ADMIN_IDS"] = [OWNER_ID]
+        self.bot.MESSAGE_MAP.clear()
+
+    async def measure(self, name, fn, setup=None):
+        times = []
+        for _ in range(self.args.repeat):
+            if setup: setup()
+            self.stub.reset()
+            started = time.perf_counter()
+            result = fn()
+            if asyncio.iscoroutine(result): await result
+            times.append(time.perf_counter() - started)
+        self.results[name] = {
+            "runs": len(times),
+            "min": min(times),
+            "median": statistics.median(times),
+            "mean": statistics.fmean(times),
+            "max": max(times),
+            "api_calls": sum(self.stub.calls.values()),
+        }
+        print(f"  {name:<20} median {self.results[name]['median'] * 1000:9.2f} ms", file=sys.stderr)
+
+    async def run(self):
+        bot, stub = self.bot, self.stub
+        ctx = lambda *a: make_context(stub, a)
+
+        self.reset_db()
+        await self.measure("save_data_sync", bot.save_data_sync)
+        await self.measure("load_data", bot.load_data)
+        await self.measure("check_demos", lambda: bot.check_demos(ctx()), setup=self.reset_db)
+
+        self.reset_db()
+        await self.measure("cmd_batch_stats", lambda: bot.cmd_batch_stats(make_update(stub, OWNER_ID), ctx()))
+        await self.measure("cmd_find_user", lambda: bot.cmd_find_user(make_update(stub, OWNER_ID), ctx("a1")))
+        await self.measure("relay_user_to_admin", self.relay_in, setup=self.reset_db)
+        await self.measure("relay_admin_to_user", self.relay_out, setup=self.reset_db)
+        await self.measure("broadcast", self.broadcast, setup=lambda: self.reset_db(self.args.broadcast_users))
+        self.reset_db()
+
+    def _topic_users(self):
+        return list(self.bot.DB["USER_TOPICS"].items())[:self.args.relay_users]
+
+    async def relay_in(self):
+        """Private messages routed into support topics, until the relay queues drain."""
+        bot = self.bot
+        for n in range(self.args.relay_messages):
+            uid, _ = self._topic_users()[n % self.args.relay_users]
+            await bot.main_message_handler(make_update(self.stub, uid, text=f"message {n}"), make_context(self.stub))
+        while bot.RELAY_QUEUES:
+            await asyncio.sleep(0.001)
+
+    async def relay_out(self):
+        """Admin replies inside topics routed back to the ticket owners."""
+        users = self._topic_users()
+        for n in range(self.args.relay_messages):
+            _, topic = users[n % len(users)]
+            update = make_update(self.stub, OWNER_ID, chat_id=SUPPORT_GROUP_ID, text=f"reply {n}",
+                                 chat_type="supergroup", thread_id=topic)
+            await self.bot.main_message_handler(update, make_context(self.stub))
+
+    async def broadcast(self):
+        owner = make_update(self.stub, OWNER_ID)
+        self.bot.BROADCAST_STATE[OWNER_ID] = {"type": "broadcast", "step": "confirm", "content": owner.message}
+
+        async def noop(*a, **k): pass
+        owner.callback_query = SimpleNamespace(from_user=owner.effective_user, data="bc_yes",
+                                               answer=noop, edit_message_text=noop)
+        await self.bot.broadcast_callback(owner, make_context(self.stub))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+def compare(report, baseline_path, threshold):
+    """Prints per-benchmark ratios against a baseline; returns True if any regressed."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    regressed = False
+    for name, res in report["results"].items():
+        old = baseline.get(name)
+        if not old: continue
+        ratio = res["median"] / old["median"] if old["median"] else float("inf")
+        flag = "REGRESSION" if ratio > 1 + threshold else ""
+        regressed = regressed or bool(flag)
+        print(f"  {name:<20} {old['median'] * 1000:9.2f} -> {res['median'] * 1000:9.2f} ms  x{ratio:.2f} {flag}",
+              file=sys.stderr)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--demos", type=int, default=1000)
+    parser.add_argument("--expired", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated seconds per Bot API call")
+    parser.add_argument("--relay-users", type=int, default=50)
+    parser.add_argument("--relay-messages", type=int, default=500)
+    parser.add_argument("--broadcast-users", type=int, default=100,
+                        help="Users reached by the broadcast benchmark (it sleeps 50 ms per user)")
+    parser.add_argument("-o", "--output", help="Write JSON here instead of stdout")
+    parser.add_argument("--compare", metavar="BASELINE", help="Compare medians against a previous JSON report")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed slowdown before --compare fails")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bot = import_bot(os.path.join(tmp, "bot_data.json"))
+        base_db = synthdb.generate(args.users, args.batches, args.demos, args.expired, seed=args.seed)
+        print(f"Benchmarking {args.users} users / {args.batches} batches / {args.demos} demos", file=sys.stderr)
+        suite = Suite(bot, base_db, args)
+        asyncio.run(suite.run())
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.time(),
+            "params": vars(args),
+        },
+        "results": suite.results,
+    }
+    out = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f: f.write(out + "\n")
+    else:
+        print(out)
+
+    if args.compare and compare(report, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
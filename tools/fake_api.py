@@ -0,0 +1,266 @@
+"""
+Local stand-in for the Telegram Bot API, for load tests.
+
+Implements the methods this bot uses (getUpdates, sendMessage, copyMessage(s),
+getChatMember, createChatInviteLink, approveChatJoinRequest, banChatMember,
+createForumTopic, setMessageReaction, ...) with in-memory chat state, plus
+configurable latency, error rate and 429 retry_after injection.
+
+Point the bot at it with TELEGRAM_API_BASE_URL=http://127.0.0.1:8081, then
+feed updates through the control endpoints:
+
+    POST /control/updates   [{"message": {...}}, ...]   queue updates for getUpdates
+    GET  /control/stats                                  calls, faults, queue depth
+
+tools/loadgen.py runs it in-process and drives simulated users end to end.
+"""
+import argparse
+import asyncio
+import collections
+import email.parser
+import itertools
+import json
+import random
+import time
+import urllib.parse
+
+# Never fail these, or the bot cannot even start polling
+FAULT_EXEMPT = {"getMe", "getUpdates", "deleteWebhook", "setWebhook", "getWebhookInfo", "close", "logOut"}
+
+
+class FakeBotAPI:
+    def __init__(self, latency=0.0, jitter=0.5, error_rate=0.0, flood_rate=0.0, retry_after=1,
+                 mandatory_chat=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.mandatory_chat = mandatory_chat
+        self.rng = random.Random(seed)
+
+        self.updates = collections.deque()
+        self.update_ids = itertools.count(1)
+        self._new_updates = asyncio.Event()
+
+        self.message_ids = itertools.count(1)
+        self.topic_ids = itertools.count(1000)
+        self.members = {}         # (chat_id, user_id) -> status
+        self.invite_links = {}    # link -> createChatInviteLink params
+        self.calls = collections.Counter()
+        self.faults = collections.Counter()
+        self.listeners = []       # fn(method, params) called for every successful call
+        self._server = None
+        self._writers = set()
+
+    # --- control ---
+
+    def push_update(self, update):
+        update = dict(update, update_id=next(self.update_ids))
+        self.updates.append(update)
+        self._new_updates.set()
+        return update["update_id"]
+
+    def stats(self):
+        return {"calls": dict(self.calls), "faults": dict(self.faults), "queued_updates": len(self.updates),
+                "members": len(self.members), "invite_links": len(self.invite_links)}
+
+    # --- Bot API ---
+
+    def _user(self, user_id):
+        return {"id": int(user_id), "is_bot": False, "first_name": f"User{user_id}"}
+
+    def _chat(self, chat_id):
+        chat_id = int(chat_id)
+        if chat_id > 0: return {"id": chat_id, "type": "private", "first_name": f"User{chat_id}"}
+        return {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}", "is_forum": True}
+
+    def _message(self, chat_id, text=None, thread_id=None):
+        msg = {"message_id": next(self.message_ids), "date": int(time.time()), "chat": self._chat(chat_id),
+               "from": {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}}
+        if text is not None: msg["text"] = text
+        if thread_id: msg["message_thread_id"] = int(thread_id)
+        return msg
+
+    def _invite(self, link, params):
+        return {"invite_link": link, "creator": self._user(1), "is_primary": False, "is_revoked": False,
+                "creates_join_request": bool(params.get("creates_join_request")), "name": params.get("name")}
+
+    def _status(self, chat_id, user_id):
+        if self.mandatory_chat is not None and int(chat_id) == self.mandatory_chat:
+            return self.members.get((int(chat_id), int(user_id)), "member")
+        return self.members.get((int(chat_id), int(user_id)), "left")
+
+    async def get_updates(self, p):
+        offset, timeout = int(p.get("offset") or 0), float(p.get("timeout") or 0)
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates and timeout:
+            self._new_updates.clear()
+            try: await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError: pass
+        return list(itertools.islice(self.updates, int(p.get("limit") or 100)))
+
+    def call(self, method, p):
+        """Result for one (non-getUpdates) call; updates the fake chat state."""
+        chat_id = p.get("chat_id")
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot",
+                    "can_join_groups": True, "can_read_all_group_messages": True, "supports_inline_queries": False}
+        if method in ("sendMessage", "sendPhoto", "sendDocument", "sendVideo", "sendAudio", "sendVoice"):
+            return self._message(chat_id, p.get("text") or p.get("caption"), p.get("message_thread_id"))
+        if method in ("editMessageText", "editMessageCaption"):
+            return self._message(chat_id or 0, p.get("text") or p.get("caption"))
+        if method in ("copyMessage", "forwardMessage"):
+            return {"message_id": next(self.message_ids)}
+        if method in ("copyMessages", "forwardMessages"):
+            return [{"message_id": next(self.message_ids)} for _ in p.get("message_ids") or []]
+        if method == "getChat":
+            return dict(self._chat(chat_id), accent_color_id=0, max_reaction_count=11)
+        if method == "getChatMember":
+            return {"status": self._status(chat_id, p["user_id"]), "user": self._user(p["user_id"]), "until_date": 0}
+        if method == "getChatMemberCount":
+            return sum(1 for (c, _), s in self.members.items() if c == int(chat_id) and s == "member")
+        if method == "createChatInviteLink":
+            link = f"https://t.me/+fake{next(self.message_ids):08d}"
+            self.invite_links[link] = p
+            return self._invite(link, p)
+        if method in ("revokeChatInviteLink", "editChatInviteLink"):
+            return dict(self._invite(p["invite_link"], self.invite_links.get(p["invite_link"], {})), is_revoked=True)
+        if method == "approveChatJoinRequest":
+            self.members[(int(chat_id), int(p["user_id"]))] = "member"
+            return True
+        if method == "banChatMember":
+            self.members[(int(chat_id), int(p["user_id"]))] = "kicked"
+            return True
+        if method == "unbanChatMember":
+            if self.members.get((int(chat_id), int(p["user_id"]))) == "kicked":
+                self.members[(int(chat_id), int(p["user_id"]))] = "left"
+            return True
+        if method == "createForumTopic":
+            return {"message_thread_id": next(self.topic_ids), "name": p.get("name", ""), "icon_color": 7322096}
+        # setMessageReaction, answerCallbackQuery, deleteMessage(s), declineChatJoinRequest, setMyCommands, ...
+        return True
+
+    async def dispatch(self, method, params):
+        """Returns (http status, response dict)."""
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": await self.get_updates(params)}
+        if self.latency:
+            await asyncio.sleep(self.latency * self.rng.uniform(1 - self.jitter, 1 + self.jitter))
+        if method not in FAULT_EXEMPT:
+            roll = self.rng.random()
+            if roll < self.flood_rate:
+                self.faults["flood"] += 1
+                return 429, {"ok": False, "error_code": 429, "parameters": {"retry_after": self.retry_after},
+                             "description": f"Too Many Requests: retry after {self.retry_after}"}
+            if roll < self.flood_rate + self.error_rate:
+                self.faults["error"] += 1
+                return 400, {"ok": False, "error_code": 400, "description": "Bad Request: injected error"}
+        try:
+            result = self.call(method, params)
+        except (KeyError, TypeError, ValueError) as e:
+            return 400, {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"}
+        for listener in self.listeners:
+            listener(method, params)
+        return 200, {"ok": True, "result": result}
+
+    # --- HTTP ---
+
+    @staticmethod
+    def parse_params(ctype, body, query):
+        params = dict(urllib.parse.parse_qsl(query))
+        if ctype.startswith("application/json") and body:
+            params.update(json.loads(body))
+            return params
+        if ctype.startswith("multipart/form-data"):
+            msg = email.parser.BytesParser().parsebytes(b"Content-Type: " + ctype.encode() + b"\r\n\r\n" + body)
+            for part in msg.get_payload():
+                name = part.get_param("name", header="content-disposition")
+                if name and not part.get_filename():
+                    params[name] = part.get_payload(decode=True).decode("utf-8")
+        elif body:
+            params.update(urllib.parse.parse_qsl(body.decode("utf-8"), keep_blank_values=True))
+        # python-telegram-bot sends non-string values JSON-encoded
+        for k, v in params.items():
+            if isinstance(v, str):
+                try: params[k] = json.loads(v)
+                except ValueError: pass
+        return params
+
+    async def handle_http(self, method, path, query, headers, body):
+        if path == "/control/stats":
+            return 200, self.stats()
+        if path == "/control/updates" and method == "POST":
+            return 200, {"ok": True, "update_ids": [self.push_update(u) for u in json.loads(body or b"[]")]}
+        parts = path.strip("/").split("/")
+        if len(parts) != 2 or not parts[0].startswith("bot"):
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+        params = self.parse_params(headers.get("content-type", ""), body, query)
+        return await self.dispatch(parts[1], params)
+
+    async def _handle(self, reader, writer):
+        # HTTP/1.1 with keep-alive; the bot reuses pooled connections
+        self._writers.add(writer)
+        try:
+            while True:
+                try: head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError): return
+                lines = head.decode("latin-1").split("\r\n")
+                method, target = lines[0].split(" ")[:2]
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        k, v = line.split(":", 1)
+                        headers[k.strip().lower()] = v.strip()
+                length = int(headers.get("content-length") or 0)
+                body = await reader.readexactly(length) if length else b""
+                path, _, query = target.partition("?")
+                status, payload = await self.handle_http(method.upper(), path, query, headers, body)
+                data = json.dumps(payload).encode("utf-8")
+                writer.write(f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(data)}\r\n\r\n".encode("latin-1") + data)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close": return
+        except (Exception, asyncio.CancelledError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=8081):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            for writer in list(self._writers): writer.close()
+            await self._server.wait_closed()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.05, help="Mean seconds per call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls failing with 400")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="Fraction of calls failing with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--mandatory-chat", type=int, help="Chat where every user is a member by default")
+    args = parser.parse_args()
+
+    async def serve():
+        api = FakeBotAPI(args.latency, error_rate=args.error_rate, flood_rate=args.flood_rate,
+                         retry_after=args.retry_after, mandatory_chat=args.mandatory_chat)
+        port = await api.start(args.host, args.port)
+        print(f"Fake Bot API on http://{args.host}:{port}")
+        await asyncio.Event().wait()
+
+    try: asyncio.run(serve())
+    except KeyboardInterrupt: pass
+
+
+if __name__ == "__main__":
+    main()
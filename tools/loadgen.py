@@ -0,0 +1,237 @@
+"""
+End-to-end load test: runs bot.py against tools/fake_api.py and drives
+simulated users through the full flow:
+
+    /start -> request paid access -> join request -> support message
+           -> admin /demo approval -> automatic demo expiry (kick)
+
+Each step is timed from injecting the update until the fake API sees the
+bot's reaction (reply, invite revoke, copy into the support group, approval,
+ban). Prints JSON with throughput and latency percentiles per step:
+
+    python tools/loadgen.py --users 2000 --rate 100 --latency 0.05 --flood-rate 0.01
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthdb  # noqa: E402
+from fake_api import FakeBotAPI  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OWNER_ID = 42
+SUPPORT_GROUP_ID = -1009999999999
+MANDATORY_CHANNEL_ID = -1008888888888
+USER_BASE = 7000000000
+STEPS = ("start", "request_access", "join_request", "support_message", "approve_demo", "demo_expiry")
+
+
+class Expectations:
+    """Futures resolved when the fake API sees a call matching (method, params subset)."""
+
+    def __init__(self):
+        self.pending = {}
+
+    def expect(self, method, **match):
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(method, []).append((match, fut))
+        return fut
+
+    def __call__(self, method, params):
+        waiters = self.pending.get(method)
+        if not waiters: return
+        for i, (match, fut) in enumerate(waiters):
+            if all(params.get(k) == v for k, v in match.items()):
+                del waiters[i]
+                if not fut.done(): fut.set_result(time.perf_counter())
+                return
+
+    def discard(self, method, fut):
+        self.pending[method] = [w for w in self.pending.get(method, []) if w[1] is not fut]
+
+
+def percentiles(values):
+    if not values: return {"count": 0}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {"count": len(values), "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": values[-1]}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.api = FakeBotAPI(args.latency, error_rate=args.error_rate, flood_rate=args.flood_rate,
+                              retry_after=args.retry_after, mandatory_chat=MANDATORY_CHANNEL_ID, seed=args.seed)
+        self.waits = Expectations()
+        self.api.listeners.append(self.waits)
+        self.latency = {step: [] for step in STEPS}
+        self.failures = {step: 0 for step in STEPS}
+        self.ready = asyncio.Event()
+        self.pushed = 0
+        self.message_ids = itertools.count(1)
+        self.api.listeners.append(lambda m, p: m == "deleteWebhook" and self.ready.set())
+        db = synthdb.generate(users=args.existing_users, batches=2, demos=0, seed=args.seed)
+        self.free_id, self.paid_id = next(iter(db["FREE_CHANNELS"])), next(iter(db["PAID_CHANNELS"]))
+        self.db = db
+
+    # --- update builders ---
+
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"Load{uid}", "username": f"load{uid}", "language_code": "en"}
+
+    def _message(self, uid, text, chat_id=None):
+        msg = {"message_id": next(self.message_ids), "date": int(time.time()), "from": self._user(uid),
+               "chat": {"id": chat_id or uid, "type": "private", "first_name": f"Load{uid}"}, "text": text}
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": msg}
+
+    def _callback(self, uid, data):
+        return {"callback_query": {"id": f"cb{uid}", "from": self._user(uid), "chat_instance": "load", "data": data,
+                                   "message": {"message_id": 1, "date": int(time.time()),
+                                               "chat": {"id": uid, "type": "private", "first_name": f"Load{uid}"}}}}
+
+    def _join_request(self, uid, link):
+        return {"chat_join_request": {
+            "chat": {"id": self.paid_id, "type": "channel", "title": "Paid"}, "from": self._user(uid),
+            "user_chat_id": uid, "date": int(time.time()),
+            "invite_link": {"invite_link": link, "creator": {"id": 1, "is_bot": True, "first_name": "FakeBot"},
+                            "creates_join_request": True, "is_primary": False, "is_revoked": False}}}
+
+    # --- flow ---
+
+    async def step(self, name, update, method, timeout=None, **match):
+        """Injects `update` (if any) and waits for the matching API call. Returns the start time."""
+        fut = self.waits.expect(method, **match)
+        started = time.perf_counter()
+        if update is not None:
+            self.api.push_update(update)
+            self.pushed += 1
+        try:
+            done = await asyncio.wait_for(fut, timeout or self.args.step_timeout)
+        except asyncio.TimeoutError:
+            self.waits.discard(method, fut)
+            self.failures[name] += 1
+            raise
+        self.latency[name].append(done - started)
+        return done
+
+    async def user_flow(self, uid):
+        try:
+            await self.step("start", self._message(uid, "/start"), "sendMessage", chat_id=uid)
+            await self.step("request_access", self._callback(uid, f"req_access_{self.paid_id}"), "sendMessage", chat_id=uid)
+            link = next((l for l, p in self.api.invite_links.items() if str(p.get("name", "")).startswith(f"Req-{uid}-")), None)
+            if link is None:
+                self.failures["join_request"] += 1
+                return False
+            await self.step("join_request", self._join_request(uid, link), "revokeChatInviteLink",
+                            chat_id=self.paid_id, invite_link=link)
+            await self.step("support_message", self._message(uid, f"hello from {uid}"), "copyMessage",
+                            chat_id=SUPPORT_GROUP_ID, from_chat_id=uid)
+            expiry = self.waits.expect("banChatMember", chat_id=self.paid_id, user_id=uid)
+            approved = await self.step("approve_demo", self._message(OWNER_ID, f"/demo {link}"), "approveChatJoinRequest",
+                                       chat_id=self.paid_id, user_id=uid)
+            # Kick latency: time past the scheduled expiry until the ban call
+            try:
+                kicked = await asyncio.wait_for(expiry, self.args.demo_seconds + self.args.step_timeout)
+                self.latency["demo_expiry"].append(kicked - approved - self.args.demo_seconds)
+            except asyncio.TimeoutError:
+                self.waits.discard("banChatMember", expiry)
+                self.failures["demo_expiry"] += 1
+                return False
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def start_bot(self, tmp, api_port):
+        data_file = os.path.join(tmp, "bot_data.json")
+        with open(data_file, "w") as f: json.dump(self.db, f)
+        env = dict(os.environ,
+                   TELEGRAM_BOT_TOKEN="123456:FAKE", TELEGRAM_API_BASE_URL=f"http://127.0.0.1:{api_port}",
+                   OWNER_ID=str(OWNER_ID), SUPPORT_GROUP_ID=str(SUPPORT_GROUP_ID),
+                   MANDATORY_CHANNEL_ID=str(MANDATORY_CHANNEL_ID), LOG_CHANNEL_ID="0", DATA_FILE=data_file,
+                   PORT=str(free_port()), UPDATE_MODE="polling", WORKER_COUNT="1",
+                   DEMO_DURATION=str(self.args.demo_seconds), DEMO_CHECK_INTERVAL="1")
+        env.pop("MONGO_URL", None)
+        self.bot_log = os.path.join(tmp, "bot.log")
+        log = open(self.bot_log, "w")
+        return subprocess.Popen([sys.executable, os.path.join(ROOT, "bot.py")], env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    async def run(self):
+        args = self.args
+        api_port = await self.api.start(port=0)
+        with tempfile.TemporaryDirectory() as tmp:
+            proc = self.start_bot(tmp, api_port)
+            try:
+                await asyncio.wait_for(self.ready.wait(), 30)
+                # Let the bot finish startup (the first demo check runs 10 s after start)
+                await asyncio.sleep(1)
+                started = time.perf_counter()
+                flows = []
+                for n in range(args.users):
+                    flows.append(asyncio.create_task(self.user_flow(USER_BASE + n)))
+                    await asyncio.sleep(1 / args.rate)
+                results = await asyncio.gather(*flows)
+                elapsed = time.perf_counter() - started
+            except asyncio.TimeoutError:
+                sys.exit(f"Bot did not start polling; see log:\n{open(self.bot_log).read()[-3000:]}")
+            finally:
+                proc.terminate()
+                try: proc.wait(10)
+                except subprocess.TimeoutExpired: proc.kill()
+                await self.api.stop()
+                if args.bot_log:
+                    with open(self.bot_log) as src, open(args.bot_log, "w") as dst: dst.write(src.read())
+
+        completed = sum(results)
+        return {
+            "meta": {"params": vars(args), "timestamp": time.time()},
+            "flows": {"started": args.users, "completed": completed, "failed": args.users - completed,
+                      "seconds": elapsed, "per_second": completed / elapsed if elapsed else 0},
+            "updates_per_second": self.pushed / elapsed if elapsed else 0,
+            "steps": {step: dict(percentiles(self.latency[step]), failures=self.failures[step]) for step in STEPS},
+            "api": self.api.stats(),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=50, help="New simulated users per second")
+    parser.add_argument("--existing-users", type=int, default=0, help="Synthetic users already in the database")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mean fake API latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--flood-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--demo-seconds", type=int, default=5, help="DEMO_DURATION passed to the bot")
+    parser.add_argument("--step-timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--bot-log", help="Keep the bot's log output here")
+    parser.add_argument("-o", "--output", help="Write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    report = asyncio.run(LoadTest(args).run())
+    out = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f: f.write(out + "\n")
+    else:
+        print(out)
+
+
+if __name__ == "__main__":
+    main()
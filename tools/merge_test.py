@@ -0,0 +1,90 @@
+"""
+Two-worker test of the shared-state merge (WORKER_COUNT > 1).
+
+Loads two copies of bot.py as workers 0 and 1 on one FileSharedState (a
+temp DATA_FILE), makes conflicting edits on both between syncs, saves both
+and checks that every edit survives on both workers and in the shared file:
+
+    python tools/merge_test.py
+"""
+import asyncio
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from multibot import patched_environ  # noqa: E402
+
+
+def load_worker(index, data_file):
+    env = dict(os.environ, TELEGRAM_BOT_TOKEN="123456:FAKE", OWNER_ID="42", SUPPORT_GROUP_ID="0",
+               DATA_FILE=data_file, PORT="0", WORKER_COUNT="2", WORKER_INDEX=str(index),
+               UPDATE_MODE="webhook", WEBHOOK_SECRET="test", RECORD_UPDATES="")
+    env.pop("MONGO_URL", None)
+    spec = importlib.util.spec_from_file_location(f"bot_worker{index}", os.path.join(ROOT, "bot.py"))
+    module = importlib.util.module_from_spec(spec)
+    with patched_environ(env):
+        spec.loader.exec_module(module)
+    module.load_data()
+    return module
+
+
+async def run(a, b):
+    # Common starting point, synced by both
+    a.DB["USER_DATA"].update({1: {"name": "one"}, 2: {"name": "two"}})
+    a.DB["LINK_MAP"]["+old"] = {"u": 1, "b": -100}
+    a.DB["PENDING_REQUESTS"][-100] = {"1": 1.0}
+    a.DB["BLOCKED_USERS"].append(7)
+    await a.save_data_async()
+    await b.refresh_shared_state()
+
+    # Conflicting edits between syncs
+    a.DB["LINK_MAP"]["+A"] = {"u": 10, "b": -100}
+    a.DB["USER_TOPICS"][10] = 1010
+    a.DB["USER_DATA"][1]["name"] = "one (A)"
+    a.DB["PENDING_REQUESTS"][-100]["10"] = 2.0
+    a.DB["BLOCKED_USERS"].append(8)
+    del a.DB["LINK_MAP"]["+old"]
+
+    b.DB["LINK_MAP"]["+B"] = {"u": 20, "b": -100}
+    b.DB["USER_TOPICS"][20] = 2020
+    b.DB["USER_DATA"][2]["name"] = "two (B)"
+    b.DB["PENDING_REQUESTS"][-100]["20"] = 3.0
+    b.DB["BLOCKED_USERS"].remove(7)
+
+    await a.save_data_async()
+    await b.save_data_async()  # Conflicts, merges A's edits, retries
+    await a.refresh_shared_state()
+
+    with open(a.DATA_FILE) as f: shared = json.load(f)
+    expect = {
+        "LINK_MAP": {"+A": {"u": 10, "b": -100}, "+B": {"u": 20, "b": -100}},
+        "USER_TOPICS": {"10": 1010, "20": 2020},
+        "USER_DATA": {"1": {"name": "one (A)"}, "2": {"name": "two (B)"}},
+        "PENDING_REQUESTS": {"-100": {"1": 1.0, "10": 2.0, "20": 3.0}},
+        "BLOCKED_USERS": [8],
+    }
+    failures = []
+    for name, view in (("worker 0", a.build_snapshot()), ("worker 1", b.build_snapshot()), ("shared file", shared)):
+        for key, value in expect.items():
+            got = sorted(view[key]) if isinstance(value, list) else view[key]
+            if got != value: failures.append(f"{name} {key}: {got!r} != {value!r}")
+    return failures
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        data_file = os.path.join(tmp, "bot_data.json")
+        a, b = load_worker(0, data_file), load_worker(1, data_file)
+        failures = asyncio.run(run(a, b))
+    for line in failures: print("FAIL", line)
+    print("OK" if not failures else f"{len(failures)} failure(s)")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Replays a recorded update log (RECORD_UPDATES) through the bot's Application.
+
+Updates are fed into the real handlers at the recorded pace, accelerated, or
+as fast as possible, while the bot talks to an in-process fake Bot API
+(tools/fake_api.py). Prints JSON with per-handler latency percentiles and a
+diff of the database state, so a recorded day can be re-run on every version:
+
+    python tools/replay.py updates.jsonl.1 updates.jsonl --speed 10 --state-out day1.state.json
+    python tools/replay.py updates.jsonl.1 updates.jsonl --speed max --reference day1.state.json
+
+Scheduled jobs (demo expiry) run on wall-clock time and are not accelerated.
+Invite links created during replay differ from the recorded ones, so recorded
+/demo and /per approvals are answered with "link not found".
+"""
+import argparse
+import asyncio
+import collections
+import functools
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_api import FakeBotAPI  # noqa: E402
+from loadgen import percentiles  # noqa: E402
+
+TIMINGS = collections.defaultdict(list)
+
+
+def read_logs(paths):
+    """Returns (meta of the first file, [(t, update), ...] in order)."""
+    meta, records = None, []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip(): continue
+                rec = json.loads(line)
+                if "meta" in rec: meta = meta or rec["meta"]
+                else: records.append((rec["t"], rec["update"]))
+    records.sort(key=lambda r: r[0])
+    return meta or {}, records
+
+
+def normalize(value):
+    """JSON round trip with timestamps blanked, so runs on different days compare equal."""
+    if isinstance(value, dict): return {k: normalize(v) for k, v in value.items()}
+    if isinstance(value, list): return [normalize(v) for v in value]
+    if isinstance(value, float) and value > 1e9: return "<ts>"
+    return value
+
+
+def snapshot(bot):
+    """Normalized DB. Invite links and topic ids come from the fake API in call order, so only their shape is kept."""
+    state = normalize(json.loads(json.dumps(bot.build_snapshot())))
+    state["LINK_MAP"] = sorted((json.dumps(v, sort_keys=True) for v in state.get("LINK_MAP", {}).values()))
+    state["USER_TOPICS"] = {uid: "<topic>" for uid in state.get("USER_TOPICS", {})}
+    return state
+
+
+def diff_state(old, new, sample=5):
+    out = {}
+    for key in sorted(set(old) | set(new)):
+        a, b = old.get(key), new.get(key)
+        if a == b: continue
+        if isinstance(a, dict) and isinstance(b, dict):
+            added = [k for k in b if k not in a]
+            removed = [k for k in a if k not in b]
+            changed = [k for k in b if k in a and a[k] != b[k]]
+            out[key] = {"added": len(added), "removed": len(removed), "changed": len(changed),
+                        "sample": (added + changed + removed)[:sample]}
+        elif isinstance(a, list) and isinstance(b, list):
+            sa, sb = {json.dumps(x) for x in a}, {json.dumps(x) for x in b}
+            out[key] = {"added": len(sb - sa), "removed": len(sa - sb)}
+        else:
+            out[key] = {"old": a, "new": b}
+    return out
+
+
+def timed(callback):
+    name = getattr(callback, "__name__", "handler")
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try: return await callback(update, context)
+        finally: TIMINGS[name].append(time.perf_counter() - started)
+    return wrapper
+
+
+async def replay(args, meta, records, tmp):
+    api = FakeBotAPI(args.latency, mandatory_chat=meta.get("mandatory"))
+    port = await api.start(port=0)
+    data_file = os.path.join(tmp, "bot_data.json")
+    if args.db: shutil.copy(args.db, data_file)
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": "123456:FAKE", "TELEGRAM_API_BASE_URL": f"http://127.0.0.1:{port}",
+        "OWNER_ID": str(meta.get("owner", 42)), "SUPPORT_GROUP_ID": str(meta.get("support", 0)),
+        "MANDATORY_CHANNEL_ID": str(meta.get("mandatory", 0)), "LOG_CHANNEL_ID": "0",
+        "DATA_FILE": data_file, "UPDATE_MODE": "polling", "WORKER_COUNT": "1", "RECORD_UPDATES": "",
+    })
+    os.environ.pop("MONGO_URL", None)
+    import bot
+    from telegram import Update
+    logging.getLogger().setLevel(logging.ERROR)
+
+    bot.load_data()
+    initial = snapshot(bot)
+    app = bot.build_app()
+    for handlers in app.handlers.values():
+        for handler in handlers: handler.callback = timed(handler.callback)
+
+    await app.initialize()
+    await app.start()
+    started = time.perf_counter()
+    base = records[0][0] if records else 0
+    for t, data in records:
+        if args.speed:
+            delay = (t - base) / args.speed - (time.perf_counter() - started)
+            if delay > 0: await asyncio.sleep(delay)
+        await app.update_queue.put(Update.de_json(data, app.bot))
+
+    # Drain: queued updates, in-flight handlers, relay queues and album buffers
+    proc = bot.UPDATE_PROCESSOR
+    while app.update_queue.qsize() or (proc is not None and proc.pending) or bot.RELAY_QUEUES or bot.ALBUMS:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    await app.stop()
+    await app.shutdown()
+    await api.stop()
+
+    final = snapshot(bot)
+    return initial, final, elapsed, api.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("logs", nargs="+", help="Recorded JSONL files, oldest first (e.g. updates.jsonl.1 updates.jsonl)")
+    parser.add_argument("--speed", default="1", help="Time acceleration (1, 10, ...) or 'max'")
+    parser.add_argument("--db", help="bot_data.json to start from (default: empty database)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Fake Bot API latency in seconds")
+    parser.add_argument("--state-out", help="Write the final (normalized) database state here")
+    parser.add_argument("--reference", help="Final state of an earlier replay to diff against")
+    parser.add_argument("-o", "--output", help="Write JSON here instead of stdout")
+    args = parser.parse_args()
+    args.speed = 0.0 if args.speed == "max" else float(args.speed)
+
+    meta, records = read_logs(args.logs)
+    if not records: sys.exit("No updates in the given logs.")
+    with tempfile.TemporaryDirectory() as tmp:
+        initial, final, elapsed, api_stats = asyncio.run(replay(args, meta, records, tmp))
+
+    report = {
+        "meta": {"logs": args.logs, "updates": len(records), "recorded_seconds": records[-1][0] - records[0][0],
+                 "replay_seconds": elapsed, "speed": args.speed or "max", "updates_per_second": len(records) / elapsed},
+        "handlers": {name: percentiles(times) for name, times in sorted(TIMINGS.items())},
+        "api": api_stats,
+        "state": {"changes": diff_state(initial, final)},
+    }
+    if args.reference:
+        with open(args.reference) as f:
+            report["state"]["vs_reference"] = diff_state(json.load(f), final)
+    if args.state_out:
+        with open(args.state_out, "w") as f: json.dump(final, f)
+
+    out = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f: f.write(out + "\n")
+    else:
+        print(out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Rebuilds bot_data.json from backups made by /backup or BACKUP_INTERVAL.
+
+Pass the full backup and optionally the newest delta taken after it (deltas
+are relative to the full backup, so older deltas are not needed). Split
+backups are reassembled from their .001, .002, ... parts automatically:
+
+    python tools/restore_backup.py backup-20240101-000000-full.json.zst \\
+        backup-20240101-180000-delta.json.zst -o bot_data.json
+"""
+import argparse
+import glob
+import gzip
+import json
+import os
+import re
+
+
+def read_backup(path):
+    if re.search(r"\.\d{3}$", path): path = path[:-4]
+    parts = sorted(glob.glob(glob.escape(path) + ".[0-9][0-9][0-9]"))
+    if parts and not os.path.exists(path):
+        blob = b"".join(open(p, "rb").read() for p in parts)
+    else:
+        with open(path, "rb") as f: blob = f.read()
+    if ".zst" in path:
+        import zstandard
+        raw = zstandard.ZstdDecompressor().decompressobj().decompress(blob)
+    elif ".gz" in path:
+        raw = gzip.decompress(blob)
+    else:
+        raw = blob
+    return json.loads(raw)
+
+
+def restore(full, delta=None):
+    if full.get("type") != "full": raise SystemExit("The first backup must be a full backup.")
+    data = full["data"]
+    if delta:
+        if delta.get("type") != "delta": raise SystemExit("The second backup must be a delta.")
+        data.update(delta["keys"])
+        users = data.setdefault("USER_DATA", {})
+        users.update(delta["users"])
+        for uid in delta["removed_users"]: users.pop(uid, None)
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("full", help="Full backup file (or its name without the .001 part suffix)")
+    parser.add_argument("delta", nargs="?", help="Newest delta backup taken after the full one")
+    parser.add_argument("-o", "--output", default="bot_data.json")
+    args = parser.parse_args()
+
+    full = read_backup(args.full)
+    delta = read_backup(args.delta) if args.delta else None
+    name = re.sub(r"\.\d{3}$", "", os.path.basename(args.full))
+    if delta and delta.get("base") and delta["base"] != name:
+        print(f"Warning: delta was taken against {delta['base']}, not {name}")
+    data = restore(full, delta)
+    with open(args.output, "w") as f: json.dump(data, f, indent=4)
+    print(f"Restored {len(data.get('USER_DATA', {}))} users to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+In-process stand-in for telegram.Bot used by the benchmarks.
+
+Every Bot API method is accepted, counted and answered with a minimal fake
+object, optionally after a simulated network latency. Nothing leaves the process.
+"""
+import asyncio
+import collections
+import itertools
+from types import SimpleNamespace
+
+
+class StubMessage(SimpleNamespace):
+    """Message-like object whose reply/edit helpers go back through the stub bot."""
+
+    def __init__(self, bot, chat_id, message_id, **fields):
+        defaults = dict(message_thread_id=None, media_group_id=None, text=None, caption=None, from_user=None)
+        super().__init__(chat=SimpleNamespace(id=chat_id, type="private", title=None), chat_id=chat_id,
+                         message_id=message_id, **{**defaults, **fields})
+        self._bot = bot
+
+    async def reply_text(self, text, **kwargs):
+        return await self._bot.send_message(self.chat.id, text, **kwargs)
+
+    async def reply_document(self, document=None, **kwargs):
+        return await self._bot.send_document(self.chat.id, document, **kwargs)
+
+    async def edit_text(self, text, **kwargs):
+        return await self._bot.edit_message_text(text, self.chat.id, self.message_id, **kwargs)
+
+    async def delete(self):
+        return await self._bot.delete_message(self.chat.id, self.message_id)
+
+
+class StubBot:
+    """Records calls per method; `latency` seconds are awaited per call."""
+
+    id = 1
+
+    def __init__(self, latency=0.0, member_status="member"):
+        self.latency = latency
+        self.member_status = member_status
+        self.calls = collections.Counter()
+        self._ids = itertools.count(1)
+
+    def reset(self):
+        self.calls.clear()
+
+    def _message(self, chat_id, **fields):
+        return StubMessage(self, chat_id, next(self._ids), **fields)
+
+    async def _call(self, method, *args, **kwargs):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = kwargs.get("chat_id", args[0] if args else 0)
+        if method == "copy_messages":
+            ids = kwargs.get("message_ids", args[2] if len(args) > 2 else [])
+            return tuple(SimpleNamespace(message_id=next(self._ids)) for _ in ids)
+        if method in ("copy_message", "forward_message"):
+            return SimpleNamespace(message_id=next(self._ids))
+        if method == "create_forum_topic":
+            return SimpleNamespace(message_thread_id=next(self._ids))
+        if method == "get_chat_member":
+            return SimpleNamespace(status=self.member_status)
+        if method == "get_chat_member_count":
+            return 1000
+        if method == "get_chat":
+            return SimpleNamespace(id=chat_id, title=f"Chat {chat_id}", type="supergroup")
+        if method in ("create_chat_invite_link", "export_chat_invite_link"):
+            return SimpleNamespace(invite_link=f"https://t.me/+stub{next(self._ids)}")
+        if method.startswith(("send_", "edit_message")):
+            return self._message(chat_id)
+        return True
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        async def call(*args, **kwargs):
+            return await self._call(method, *args, **kwargs)
+        call.__name__ = method
+        return call
+
+
+class StubJobQueue:
+    """Accepts scheduling calls without running them."""
+
+    def __init__(self):
+        self.scheduled = 0
+
+    def run_once(self, *args, **kwargs):
+        self.scheduled += 1
+
+    def run_repeating(self, *args, **kwargs):
+        self.scheduled += 1
+
+
+def make_context(bot, args=()):
+    return SimpleNamespace(bot=bot, args=list(args), job_queue=StubJobQueue(),
+                           application=SimpleNamespace(create_task=asyncio.create_task))
+
+
+def make_update(bot, user_id, chat_id=None, text=None, chat_type="private", thread_id=None, first_name="Bench"):
+    """A private (or group) text message update from `user_id`."""
+    chat_id = chat_id if chat_id is not None else user_id
+    user = SimpleNamespace(id=user_id, first_name=first_name, full_name=f"{first_name} User",
+                           username=f"user{user_id}", language_code="en", is_bot=False)
+    msg = bot._message(chat_id, text=text, from_user=user)
+    msg.chat.type = chat_type
+    msg.message_thread_id = thread_id
+    return SimpleNamespace(effective_user=user, effective_chat=msg.chat, message=msg,
+                           effective_message=msg, callback_query=None)
@@ -0,0 +1,96 @@
+"""
+Synthetic bot database generator.
+
+Builds realistic in-memory DB contents (users, batches, demos, invite links,
+support topics) for benchmarks and load tests, or writes them as a
+bot_data.json snapshot that the bot can load directly:
+
+    python tools/synthdb.py --users 100000 --batches 40 --demos 5000 -o bot_data.json
+"""
+import argparse
+import json
+import random
+import string
+import time
+
+BATCH_BASE = -1001000000000
+
+
+def _name(rng):
+    return rng.choice(string.ascii_uppercase) + "".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9)))
+
+
+def generate(users=10000, batches=20, demos=1000, expired=0.1, topics=0.2, links=0.05, seed=1, now=None):
+    """
+    Returns a DB dict in the bot's in-memory form (int keys where the bot uses them).
+    `demos` users get one demo each; `expired` is the fraction already past expiry.
+    `topics` and `links` are the fractions of users with a support topic / pending link.
+    """
+    rng = random.Random(seed)
+    now = now or time.time()
+    half = max(1, batches // 2)
+    free = {BATCH_BASE - i: f"Free Batch {i}" for i in range(half)}
+    paid = {BATCH_BASE - 1000 - i: f"Paid Batch {i}" for i in range(batches - half)}
+    batch_ids = list(free) + list(paid)
+
+    user_data = {}
+    uid_base = 5000000000
+    for i in range(users):
+        uid = uid_base + i
+        first = _name(rng)
+        user_data[uid] = {
+            "name": f"{first} {_name(rng)}",
+            "username": f"{first.lower()}{i}" if rng.random() < 0.7 else None,
+            "joined_at": now - rng.uniform(0, 365 * 86400),
+            "demos": {},
+        }
+
+    uids = list(user_data)
+    for uid in rng.sample(uids, min(demos, users)):
+        bid = rng.choice(batch_ids)
+        if rng.random() < expired:
+            expiry = now - rng.uniform(1, 3600)
+        else:
+            expiry = now + rng.uniform(60, 3 * 3600)
+        user_data[uid]["demos"][str(bid)] = {"expiry": expiry, "warned": expiry - now <= 1800 and rng.random() < 0.5}
+        user_data[uid]["demo_history"] = [bid]
+
+    user_topics = {uid: 1000 + n for n, uid in enumerate(rng.sample(uids, int(users * topics)))}
+    link_map = {
+        f"https://t.me/+{''.join(rng.choices(string.ascii_letters + string.digits, k=16))}": {"u": uid, "b": rng.choice(batch_ids)}
+        for uid in rng.sample(uids, int(users * links))
+    }
+
+    return {
+        "ADMIN_IDS": [],
+        "FREE_CHANNELS": free,
+        "PAID_CHANNELS": paid,
+        "ALL_CHATS": {**free, **paid},
+        "USER_DATA": user_data,
+        "BLOCKED_USERS": rng.sample(uids, min(users // 1000, users)),
+        "USER_TOPICS": user_topics,
+        "PENDING_REQUESTS": {},
+        "LINK_MAP": link_map,
+        "CUSTOM_WELCOMES": {bid: "Welcome to the batch!" for bid in batch_ids[:3]},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--demos", type=int, default=1000)
+    parser.add_argument("--expired", type=float, default=0.1, help="Fraction of demos already expired")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", default="bot_data.json")
+    args = parser.parse_args()
+
+    db = generate(args.users, args.batches, args.demos, args.expired, seed=args.seed)
+    with open(args.output, "w") as f:
+        # json converts the int dict keys to strings, as the bot's own snapshots do
+        json.dump(db, f)
+    print(f"Wrote {args.output}: {args.users} users, {args.batches} batches, {args.demos} demos")
+
+
+if __name__ == "__main__":
+    main()